@@ -276,6 +276,10 @@ export const meApi = {
     async getConversations() {
         return apiRequest('/api/me/conversations');
     },
+
+    async getUnread() {
+        return apiRequest('/api/me/unread');
+    },
 };
 
 export const usersApi = {
@@ -284,6 +288,12 @@ export const usersApi = {
         if (!q) return [];
         return apiRequest(`/api/users/search?q=${encodeURIComponent(q)}&limit=${encodeURIComponent(limit)}`);
     },
+
+    async typeahead(query, limit = 20) {
+        const q = (query || '').trim();
+        if (!q) return [];
+        return apiRequest(`/api/users/typeahead?q=${encodeURIComponent(q)}&limit=${encodeURIComponent(limit)}`);
+    },
 };
 
 export const conversationsApi = {
@@ -294,41 +304,124 @@ export const conversationsApi = {
         });
     },
 
-    async getMessages(conversationId, { limit = 50, before = null } = {}) {
+    async getMessages(conversationId, { limit = 50, before = null, after = null } = {}) {
         const params = new URLSearchParams();
         params.set('limit', String(limit));
         if (before) params.set('before', before);
+        if (after) params.set('after', after);
         return apiRequest(`/api/conversations/${conversationId}/messages?${params.toString()}`);
     },
 
+    async markRead(conversationId) {
+        return apiRequest(`/api/conversations/${conversationId}/read`, { method: 'POST' });
+    },
+
     async sendMessage(conversationId, text) {
         return apiRequest(`/api/conversations/${conversationId}/messages`, {
             method: 'POST',
             body: JSON.stringify({ text }),
         });
     },
+
+    async getUpdates(since = null, timeout = 25) {
+        const params = new URLSearchParams();
+        params.set('timeout', String(timeout));
+        if (since) params.set('since', since);
+        return apiRequest(`/api/me/dm/updates?${params.toString()}`);
+    },
+};
+
+export const chatApi = {
+    async getRooms() {
+        return apiRequest('/api/chat/rooms');
+    },
+
+    async getMessages({ room = 'general', limit = 50, before = null } = {}) {
+        const params = new URLSearchParams();
+        params.set('room', room);
+        params.set('limit', String(limit));
+        if (before) params.set('before', before);
+        return apiRequest(`/api/chat/messages?${params.toString()}`);
+    },
 };
 
-export function createChatWebSocket(token, onMessage, onOpen, onClose, onError) {
-    let wsUrl;
+function getWsBaseUrl() {
     if (API_URL) {
         const wsProtocol = API_URL.startsWith('https') ? 'wss' : 'ws';
-        wsUrl = API_URL.replace(/^https?/, wsProtocol);
-    } else {
-        const loc = window.location;
-        const wsProtocol = loc.protocol === 'https:' ? 'wss:' : 'ws:';
-        wsUrl = `${wsProtocol}//${loc.host}`;
+        return API_URL.replace(/^https?/, wsProtocol);
     }
-    
-    const ws = new WebSocket(`${wsUrl}/api/ws/chat?token=${token}`);
+    const loc = window.location;
+    const wsProtocol = loc.protocol === 'https:' ? 'wss:' : 'ws:';
+    return `${wsProtocol}//${loc.host}`;
+}
+
+export function createDmWebSocket(token, since, onMessage, onOpen, onClose, onError) {
+    const params = new URLSearchParams();
+    params.set('token', token);
+    if (since) params.set('since', since);
+
+    const ws = new WebSocket(`${getWsBaseUrl()}/api/ws/dm?${params.toString()}`);
+
+    ws.onopen = () => {
+        if (onOpen) onOpen();
+    };
+
+    ws.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        if (data.type === 'ping') {
+            ws.send(JSON.stringify({ type: 'pong' }));
+            return;
+        }
+        if (onMessage) onMessage(data);
+    };
+
+    ws.onclose = (event) => {
+        console.log('DM WebSocket closed', event.code, event.reason);
+        if (onClose) onClose(event);
+    };
+
+    ws.onerror = (error) => {
+        console.error('DM WebSocket error', error);
+        if (onError) onError(error);
+    };
+
+    return ws;
+}
+
+const CHAT_SUBPROTOCOL_JSON = 'chat.v1.json';
+const CHAT_SUBPROTOCOL_MSGPACK = 'chat.v1.msgpack';
+
+export function sendChatFrame(ws, payload) {
+    if (ws.protocol === CHAT_SUBPROTOCOL_MSGPACK) {
+        ws.send(window.MessagePack.encode(payload));
+        return;
+    }
+    ws.send(JSON.stringify(payload));
+}
+
+export function createChatWebSocket(token, room, onMessage, onOpen, onClose, onError) {
+    const protocols = window.MessagePack
+        ? [CHAT_SUBPROTOCOL_MSGPACK, CHAT_SUBPROTOCOL_JSON]
+        : [CHAT_SUBPROTOCOL_JSON];
+    const params = new URLSearchParams();
+    params.set('token', token);
+    params.set('room', room);
+    const ws = new WebSocket(`${getWsBaseUrl()}/api/ws/chat?${params.toString()}`, protocols);
+    ws.binaryType = 'arraybuffer';
     
     ws.onopen = () => {
-        console.log('WebSocket connected');
+        console.log('WebSocket connected', ws.protocol || CHAT_SUBPROTOCOL_JSON);
         if (onOpen) onOpen();
     };
     
     ws.onmessage = (event) => {
-        const data = JSON.parse(event.data);
+        const data = typeof event.data === 'string'
+            ? JSON.parse(event.data)
+            : window.MessagePack.decode(new Uint8Array(event.data));
+        if (data.type === 'ping') {
+            sendChatFrame(ws, { type: 'pong' });
+            return;
+        }
         if (onMessage) onMessage(data);
     };
     
@@ -392,13 +485,25 @@ export const coursesApi = {
     async getPartContent(courseId, partId) {
         return apiRequest(`/api/courses/${courseId}/parts/${partId}/content`);
     },
-    async purchaseCourse(courseId) {
-        return apiRequest(`/api/courses/${courseId}/purchase`, { method: 'POST' });
+    async getPartToc(courseId, partId) {
+        return apiRequest(`/api/courses/${courseId}/parts/${partId}/toc`);
+    },
+    async getPartSection(courseId, partId, position) {
+        return apiRequest(`/api/courses/${courseId}/parts/${partId}/sections/${encodeURIComponent(position)}`);
     },
-    async purchasePart(courseId, partId) {
+    async purchaseCourse(courseId, idempotencyKey) {
+        return apiRequest(`/api/courses/${courseId}/purchase`, {
+            method: 'POST',
+            headers: idempotencyKey ? { 'Idempotency-Key': idempotencyKey } : {},
+        });
+    },
+    async purchasePart(courseId, partId, idempotencyKey) {
         return apiRequest(
             `/api/courses/${courseId}/parts/${partId}/purchase`,
-            { method: 'POST' },
+            {
+                method: 'POST',
+                headers: idempotencyKey ? { 'Idempotency-Key': idempotencyKey } : {},
+            },
         );
     },
     async getMyPurchases() {
@@ -406,10 +511,50 @@ export const coursesApi = {
     },
 };
 
+function purchaseFilterParams(filters = {}) {
+    const params = new URLSearchParams();
+    Object.entries(filters).forEach(([key, value]) => {
+        if (value) params.set(key, value);
+    });
+    return params;
+}
+
 export const adminPurchasesApi = {
-    async getAll(status = null) {
-        const qs = status ? `?status=${encodeURIComponent(status)}` : '';
-        return apiRequest(`/api/admin/purchases${qs}`);
+    async getPage(filters = {}, before = null, limit = 50) {
+        const params = purchaseFilterParams(filters);
+        if (before) params.set('before', before);
+        params.set('limit', limit);
+        return apiRequest(`/api/admin/purchases?${params}`);
+    },
+    async exportFile(format, filters = {}) {
+        const params = purchaseFilterParams(filters);
+        params.set('format', format);
+        const token = getToken();
+        const response = await fetch(`${API_URL}/api/admin/purchases/export?${params}`, {
+            headers: token ? { Authorization: `Bearer ${token}` } : {},
+        });
+        if (!response.ok) {
+            const error = await response.json().catch(() => ({ detail: 'Unknown error' }));
+            throw new Error(error.detail || 'Request failed');
+        }
+        return response.blob();
+    },
+    async reconcile(file, dryRun = false) {
+        const token = getToken();
+        const formData = new FormData();
+        formData.append('file', file);
+        formData.append('dry_run', dryRun ? 'true' : 'false');
+
+        const response = await fetch(`${API_URL}/api/admin/purchases/reconcile`, {
+            method: 'POST',
+            headers: token ? { Authorization: `Bearer ${token}` } : {},
+            body: formData,
+        });
+        if (!response.ok) {
+            const error = await response.json().catch(() => ({ detail: 'Upload failed' }));
+            throw new Error(error.detail || 'Upload failed');
+        }
+        return response.json();
     },
     async updateStatus(purchaseId, status) {
         return apiRequest(
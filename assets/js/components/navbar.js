@@ -1,7 +1,24 @@
+import { meApi } from '../api.js';
 import { isAuthenticated, isAdmin, getUser, logout } from '../auth.js';
 import { router } from '../router.js';
 
 let mobileMenuOpen = false;
+let unreadTotal = 0;
+
+function renderUnreadBadge() {
+    const badge = document.getElementById('nav-chat-unread');
+    if (badge) badge.textContent = unreadTotal > 0 ? String(unreadTotal > 99 ? '99+' : unreadTotal) : '';
+}
+
+async function refreshUnreadTotal() {
+    try {
+        const result = await meApi.getUnread();
+        unreadTotal = result?.total_unread ?? 0;
+    } catch (error) {
+        unreadTotal = 0;
+    }
+    renderUnreadBadge();
+}
 
 export function renderNavbar() {
     const navbar = document.getElementById('navbar');
@@ -45,6 +62,7 @@ export function renderNavbar() {
                     <a href="${link.path}" class="nav-link ${currentPath === link.path ? 'active' : ''}" data-testid="nav-${link.path.replace('/', '') || 'home'}">
                         <i class="fas ${link.icon}"></i>
                         <span>${link.label}</span>
+                        ${link.path === '/chat' ? '<span class="nav-unread-badge" id="nav-chat-unread"></span>' : ''}
                     </a>
                 `).join('')}
                 
@@ -94,8 +112,20 @@ export function renderNavbar() {
             router.navigate('/');
         });
     }
+
+    if (authenticated) {
+        renderUnreadBadge();
+        refreshUnreadTotal();
+    } else {
+        unreadTotal = 0;
+    }
 }
 
+window.addEventListener('unread-changed', (event) => {
+    unreadTotal = event.detail?.total ?? 0;
+    renderUnreadBadge();
+});
+
 window.addEventListener('auth-changed', renderNavbar);
 window.addEventListener('route-changed', () => {
     mobileMenuOpen = false;
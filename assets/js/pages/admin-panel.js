@@ -1,13 +1,14 @@
 import { adminApi } from '../api.js';
 import { adminPurchasesApi } from '../api.js';
 import { showToast, escapeHtml, formatDate } from '../utils.js';
-import { confirmModal } from '../components/modal.js';
+import { closeModal, confirmModal, showModal } from '../components/modal.js';
 
 let users = [];
 let resetRequests = [];
 let purchases = [];
 let activeTab = 'users';
-let purchasesFilter = '';
+let purchasesFilters = { status: '', created_from: '', created_to: '' };
+let purchasesCursor = null;
 
 export function render() {
     return `
@@ -213,27 +214,44 @@ function renderPurchases() {
     const container = document.getElementById('admin-content');
     if (!container) return;
 
+    const status = purchasesFilters.status;
+    const toolbar = `
+        <div class="flex flex-wrap justify-end gap-2">
+            <input type="date" id="purchases-from-filter" class="input max-w-xs" value="${escapeHtml(purchasesFilters.created_from)}" title="С даты">
+            <input type="date" id="purchases-to-filter" class="input max-w-xs" value="${escapeHtml(purchasesFilters.created_to)}" title="По дату">
+            <select id="purchases-status-filter" class="input max-w-xs">
+                <option value="" ${status === '' ? 'selected' : ''}>Все статусы</option>
+                <option value="pending" ${status === 'pending' ? 'selected' : ''}>pending</option>
+                <option value="completed" ${status === 'completed' ? 'selected' : ''}>completed</option>
+                <option value="cancelled" ${status === 'cancelled' ? 'selected' : ''}>cancelled</option>
+            </select>
+            <button class="btn btn-secondary btn-sm purchases-export-btn" data-format="csv"><i class="fas fa-file-csv"></i> CSV</button>
+            <button class="btn btn-secondary btn-sm purchases-export-btn" data-format="ndjson"><i class="fas fa-file-code"></i> NDJSON</button>
+            <label class="btn btn-primary btn-sm cursor-pointer">
+                <i class="fas fa-file-import"></i> Сверка по выписке
+                <input type="file" id="purchases-statement-input" accept=".csv,text/csv" class="hidden">
+            </label>
+        </div>
+    `;
+
     if (purchases.length === 0) {
         container.innerHTML = `
-            <div class="empty-state">
-                <i class="fas fa-shopping-cart"></i>
-                <h3 class="text-xl font-semibold text-white mt-4">Покупок пока нет</h3>
-                <p class="text-discord-text mt-2">Здесь будут отображаться оплаты курсов и разделов</p>
+            <div class="space-y-4">
+                ${toolbar}
+                <div class="empty-state">
+                    <i class="fas fa-shopping-cart"></i>
+                    <h3 class="text-xl font-semibold text-white mt-4">Покупок пока нет</h3>
+                    <p class="text-discord-text mt-2">Здесь будут отображаться оплаты курсов и разделов</p>
+                </div>
             </div>
         `;
+        bindPurchaseToolbar();
         return;
     }
 
     container.innerHTML = `
         <div class="space-y-4">
-            <div class="flex justify-end">
-                <select id="purchases-status-filter" class="input max-w-xs">
-                    <option value="" ${purchasesFilter === '' ? 'selected' : ''}>Все статусы</option>
-                    <option value="pending" ${purchasesFilter === 'pending' ? 'selected' : ''}>pending</option>
-                    <option value="completed" ${purchasesFilter === 'completed' ? 'selected' : ''}>completed</option>
-                    <option value="cancelled" ${purchasesFilter === 'cancelled' ? 'selected' : ''}>cancelled</option>
-                </select>
-            </div>
+            ${toolbar}
 
             <div class="bg-discord-light rounded-lg overflow-hidden">
                 <table class="admin-table">
@@ -278,14 +296,22 @@ function renderPurchases() {
                     </tbody>
                 </table>
             </div>
+
+            ${purchasesCursor ? `
+                <div class="flex justify-center">
+                    <button class="btn btn-secondary btn-sm" id="purchases-more-btn">Показать ещё</button>
+                </div>
+            ` : ''}
         </div>
     `;
 
-    const filterSelect = document.getElementById('purchases-status-filter');
-    if (filterSelect) {
-        filterSelect.addEventListener('change', async () => {
-            purchasesFilter = filterSelect.value;
-            await loadPurchases(purchasesFilter || null);
+    bindPurchaseToolbar();
+
+    const moreButton = document.getElementById('purchases-more-btn');
+    if (moreButton) {
+        moreButton.addEventListener('click', async () => {
+            moreButton.disabled = true;
+            await loadPurchases({ append: true });
         });
     }
 
@@ -309,6 +335,134 @@ function renderPurchases() {
     });
 }
 
+function purchaseQuery() {
+    const { status, created_from: from, created_to: to } = purchasesFilters;
+    return {
+        status,
+        created_from: from ? `${from}T00:00:00` : '',
+        created_to: to ? `${to}T23:59:59.999999` : '',
+    };
+}
+
+async function exportPurchases(format, button) {
+    button.disabled = true;
+    try {
+        const blob = await adminPurchasesApi.exportFile(format, purchaseQuery());
+        const url = URL.createObjectURL(blob);
+        const link = document.createElement('a');
+        link.href = url;
+        link.download = `purchases.${format}`;
+        document.body.appendChild(link);
+        link.click();
+        link.remove();
+        URL.revokeObjectURL(url);
+    } catch (error) {
+        showToast(error.message || 'Ошибка экспорта', 'error');
+    } finally {
+        button.disabled = false;
+    }
+}
+
+const RECONCILE_LABELS = {
+    completed: 'Будут подтверждены',
+    already_completed: 'Уже подтверждены',
+    cancelled: 'Оплачены отменённые',
+    amount_mismatch: 'Сумма не совпадает',
+    not_found: 'Покупка не найдена',
+    duplicates: 'Повторы в выписке',
+    skipped_rows: 'Строки без комментария СБП',
+};
+
+function renderReconcileIssues(report) {
+    const issues = [
+        ...report.amount_mismatch.map((entry) => `${entry.sbp_comment}: оплачено ${entry.paid ?? '—'} ₽, ожидалось ${entry.amount} ₽`),
+        ...report.cancelled.map((entry) => `${entry.sbp_comment}: покупка отменена`),
+        ...report.not_found.map((entry) => `${entry.sbp_comment}: не найдена (строка ${entry.row})`),
+    ];
+    if (issues.length === 0) return '';
+    return `
+        <p class="text-white font-semibold mt-4 mb-2">Требуют ручной проверки</p>
+        <ul class="text-sm text-discord-text space-y-1 max-h-60 overflow-y-auto">
+            ${issues.map((issue) => `<li>${escapeHtml(issue)}</li>`).join('')}
+        </ul>
+    `;
+}
+
+async function reconcileStatement(file) {
+    try {
+        const preview = await adminPurchasesApi.reconcile(file, true);
+        const rows = Object.entries(RECONCILE_LABELS)
+            .map(([key, label]) => `<tr><td>${label}</td><td class="text-right">${Number(preview.summary[key] || 0)}</td></tr>`)
+            .join('');
+
+        showModal({
+            title: 'Сверка платежей СБП',
+            size: 'lg',
+            content: `
+                <table class="admin-table"><tbody>${rows}</tbody></table>
+                ${renderReconcileIssues(preview)}
+            `,
+            footer: `
+                <button class="btn btn-secondary" id="reconcile-cancel-btn">Отмена</button>
+                <button class="btn btn-success" id="reconcile-apply-btn" ${preview.summary.completed ? '' : 'disabled'}>
+                    Подтвердить ${Number(preview.summary.completed)}
+                </button>
+            `,
+        });
+
+        document.getElementById('reconcile-cancel-btn')?.addEventListener('click', closeModal);
+
+        const applyButton = document.getElementById('reconcile-apply-btn');
+        if (applyButton) {
+            applyButton.addEventListener('click', async () => {
+                applyButton.disabled = true;
+                try {
+                    const report = await adminPurchasesApi.reconcile(file, false);
+                    closeModal();
+                    showToast(`Подтверждено покупок: ${report.summary.completed}`, 'success');
+                    await loadPurchases();
+                } catch (error) {
+                    applyButton.disabled = false;
+                    showToast(error.message || 'Ошибка сверки', 'error');
+                }
+            });
+        }
+    } catch (error) {
+        showToast(error.message || 'Ошибка сверки', 'error');
+    }
+}
+
+function bindPurchaseToolbar() {
+    const filters = [
+        ['purchases-status-filter', 'status'],
+        ['purchases-from-filter', 'created_from'],
+        ['purchases-to-filter', 'created_to'],
+    ];
+    filters.forEach(([id, key]) => {
+        const input = document.getElementById(id);
+        if (!input) return;
+        input.addEventListener('change', async () => {
+            purchasesFilters = { ...purchasesFilters, [key]: input.value };
+            await loadPurchases();
+        });
+    });
+
+    document.querySelectorAll('.purchases-export-btn').forEach((button) => {
+        button.addEventListener('click', () => exportPurchases(button.dataset.format, button));
+    });
+
+    const statementInput = document.getElementById('purchases-statement-input');
+    if (statementInput) {
+        statementInput.addEventListener('change', async () => {
+            const [file] = statementInput.files || [];
+            statementInput.value = '';
+            if (file) {
+                await reconcileStatement(file);
+            }
+        });
+    }
+}
+
 function updateRequestsBadge() {
     const badge = document.getElementById('requests-badge');
     if (badge) {
@@ -412,7 +566,7 @@ async function updatePurchaseStatus(purchaseId, status, button = null) {
     try {
         await adminPurchasesApi.updateStatus(purchaseId, status);
         showToast('Статус покупки обновлён', 'success');
-        await loadPurchases(purchasesFilter || null);
+        await loadPurchases();
     } catch (error) {
         showToast(error.message || 'Ошибка обновления статуса', 'error');
     } finally {
@@ -446,9 +600,11 @@ async function loadResetRequests() {
     }
 }
 
-async function loadPurchases(status = null) {
+async function loadPurchases({ append = false } = {}) {
     try {
-        purchases = await adminPurchasesApi.getAll(status);
+        const page = await adminPurchasesApi.getPage(purchaseQuery(), append ? purchasesCursor : null);
+        purchases = append ? [...purchases, ...page.purchases] : page.purchases;
+        purchasesCursor = page.next_cursor;
         if (activeTab === 'purchases') {
             renderPurchases();
         }
@@ -459,7 +615,8 @@ async function loadPurchases(status = null) {
 
 export async function mount() {
     activeTab = 'users';
-    purchasesFilter = '';
+    purchasesFilters = { status: '', created_from: '', created_to: '' };
+    purchasesCursor = null;
 
     await Promise.all([
         loadUsers(),
@@ -489,5 +646,6 @@ export function unmount() {
     resetRequests = [];
     purchases = [];
     activeTab = 'users';
-    purchasesFilter = '';
+    purchasesFilters = { status: '', created_from: '', created_to: '' };
+    purchasesCursor = null;
 }
@@ -1,25 +1,41 @@
-import { conversationsApi, createChatWebSocket, getToken, meApi, usersApi } from '../api.js';
+import { chatApi, conversationsApi, createChatWebSocket, createDmWebSocket, getToken, meApi, sendChatFrame, usersApi } from '../api.js';
 import { getUser } from '../auth.js';
 import { debounce, escapeHtml, formatRelativeTime, formatTime, renderMarkdown, showToast } from '../utils.js';
 
 const MAX_RECONNECT_ATTEMPTS = 5;
-const DM_POLL_INTERVAL_MS = 2500;
 const SCROLL_BOTTOM_THRESHOLD = 72;
+const SCROLL_TOP_THRESHOLD = 48;
+const DEFAULT_ROOM = { id: 'general', title: 'Общая комната', kind: 'public' };
+const RESTART_CLOSE_CODES = new Set([1012, 1013]);
+const RESTART_RECONNECT_SPREAD_MS = 10000;
 
 let ws = null;
-let dmPollTimer = null;
+let dmWs = null;
+let dmCursor = null;
 let reconnectAttempts = 0;
+let dmReconnectAttempts = 0;
+let reconnectHintMs = null;
+// Global chat messages sent but not yet acked, keyed by client id; resent after a reconnect.
+const pendingGlobalSends = new Map();
+let dmReconnectHintMs = null;
+let dmLongPollActive = false;
 let mounted = false;
 
 let mode = 'global';
+let chatRooms = [DEFAULT_ROOM];
+let activeRoomId = DEFAULT_ROOM.id;
 let activeConversationId = null;
 let activeDmUserId = null;
 
 let globalConnectionState = 'connecting';
-let dmConnectionState = 'connected';
+let dmConnectionState = 'connecting';
 
 let globalMessages = [];
+let globalHistoryCursor = null;
+let onlineCount = 0;
+let isLoadingOlder = false;
 let dmMessages = [];
+let dmHistoryCursor = null;
 let conversations = [];
 let searchResults = [];
 let shouldStickToBottom = true;
@@ -203,6 +219,10 @@ function renderMessages(forceBottom = false) {
     updateScrollButton();
 }
 
+function currentRoom() {
+    return chatRooms.find((item) => item.id === activeRoomId) || DEFAULT_ROOM;
+}
+
 function currentConversation() {
     return conversations.find((item) => item.id === activeConversationId) || null;
 }
@@ -217,9 +237,11 @@ function updateHeader() {
         roomTitleEl.textContent = `Диалог с ${dialogName}`;
         roomSubtitleEl.textContent = 'Личные сообщения';
     } else {
-        roomIconEl.className = 'fas fa-hashtag chat-room-icon';
-        roomTitleEl.textContent = 'Общая комната';
-        roomSubtitleEl.textContent = 'Сообщения в реальном времени';
+        const room = currentRoom();
+        roomIconEl.className = `fas fa-${room.kind === 'course' ? 'graduation-cap' : 'hashtag'} chat-room-icon`;
+        roomTitleEl.textContent = room.title;
+        const subtitle = room.kind === 'course' ? 'Комната курса' : 'Сообщения в реальном времени';
+        roomSubtitleEl.textContent = onlineCount ? `${subtitle} · ${onlineCount} онлайн` : subtitle;
     }
     renderConnectionStatus();
     syncInputState();
@@ -245,13 +267,15 @@ function renderConversationsList() {
     if (!conversationsListEl) return;
 
     conversationsListEl.innerHTML = `
-        <button class="dm-item dm-item-global ${mode === 'global' ? 'is-active' : ''}" data-action="global-room">
-            <div class="dm-item-avatar"><span class="dm-item-avatar-fallback">#</span></div>
-            <div class="dm-item-content">
-                <div class="dm-item-row"><span class="dm-item-name">Общая комната</span></div>
-                <div class="dm-item-preview">Публичный чат сайта</div>
-            </div>
-        </button>
+        ${chatRooms.map((room) => `
+            <button class="dm-item dm-item-global ${mode === 'global' && room.id === activeRoomId ? 'is-active' : ''}" data-room-id="${escapeHtml(room.id)}">
+                <div class="dm-item-avatar"><span class="dm-item-avatar-fallback">${room.kind === 'course' ? '<i class="fas fa-graduation-cap"></i>' : '#'}</span></div>
+                <div class="dm-item-content">
+                    <div class="dm-item-row"><span class="dm-item-name">${escapeHtml(room.title)}</span></div>
+                    <div class="dm-item-preview">${room.kind === 'course' ? 'Чат участников курса' : 'Публичный чат сайта'}</div>
+                </div>
+            </button>
+        `).join('')}
 
         ${conversations.map((item) => {
             const active = mode === 'dm' && item.id === activeConversationId;
@@ -267,6 +291,7 @@ function renderConversationsList() {
                         <div class="dm-item-row">
                             <span class="dm-item-name">${escapeHtml(name)}</span>
                             <span class="dm-item-time">${escapeHtml(time)}</span>
+                            ${item.unread_count && !active ? `<span class="dm-item-unread">${item.unread_count}</span>` : ''}
                         </div>
                         <div class="dm-item-preview">${escapeHtml(preview)}</div>
                     </div>
@@ -304,6 +329,18 @@ function renderSearchResults() {
     `).join('');
 }
 
+async function loadRooms() {
+    try {
+        const rooms = await chatApi.getRooms();
+        chatRooms = rooms?.length ? rooms : [DEFAULT_ROOM];
+        if (!chatRooms.some((room) => room.id === activeRoomId)) activeRoomId = DEFAULT_ROOM.id;
+        renderConversationsList();
+        if (mode === 'global') updateHeader();
+    } catch (error) {
+        chatRooms = [DEFAULT_ROOM];
+    }
+}
+
 async function loadConversations(silent = false) {
     try {
         conversations = await meApi.getConversations();
@@ -317,34 +354,108 @@ async function loadConversations(silent = false) {
 async function loadDmMessages(forceBottom = false, silent = false) {
     if (!activeConversationId) return;
     try {
-        const items = await conversationsApi.getMessages(activeConversationId, { limit: 50 });
-        dmMessages = (items || []).map(normalizeMessage);
+        const page = await conversationsApi.getMessages(activeConversationId, { limit: 50 });
+        dmHistoryCursor = page?.next_cursor || null;
+        dmMessages = (page?.messages || []).map(normalizeMessage);
         if (mode === 'dm') renderMessages(forceBottom);
-        setDmConnectionState('connected');
     } catch (error) {
-        setDmConnectionState('disconnected');
         if (!silent) showToast(error.message || 'Не удалось загрузить DM сообщения', 'error');
     }
 }
 
-function stopDmPolling() {
-    if (dmPollTimer) clearInterval(dmPollTimer);
-    dmPollTimer = null;
+function touchConversation(raw) {
+    const conversation = conversations.find((item) => item.id === raw.conversation_id);
+    if (!conversation) {
+        loadConversations(true);
+        return;
+    }
+    if (conversation.last_message_id === raw.id) return;
+    const timestamp = raw.created_at || raw.timestamp;
+    conversation.last_message_id = raw.id;
+    if (raw.sender_id && raw.sender_id !== getUser()?.id) {
+        if (mode === 'dm' && conversation.id === activeConversationId) {
+            markConversationRead(conversation.id);
+        } else {
+            conversation.unread_count = (conversation.unread_count || 0) + 1;
+        }
+    }
+    conversation.last_message = raw.text ?? raw.message ?? '';
+    conversation.last_message_at = timestamp;
+    conversation.updated_at = timestamp;
+    conversations.sort((a, b) => (b.updated_at || '').localeCompare(a.updated_at || ''));
+    renderConversationsList();
 }
 
-function startDmPolling() {
-    stopDmPolling();
-    dmPollTimer = setInterval(() => {
-        if (!mounted || mode !== 'dm') return;
-        loadDmMessages(false, true);
-    }, DM_POLL_INTERVAL_MS);
+async function markConversationRead(conversationId) {
+    const conversation = conversations.find((item) => item.id === conversationId);
+    if (conversation) conversation.unread_count = 0;
+    try {
+        const result = await conversationsApi.markRead(conversationId);
+        window.dispatchEvent(new CustomEvent('unread-changed', { detail: { total: result?.total_unread ?? 0 } }));
+    } catch (error) {
+        // The counter is fixed up on the next successful read; nothing to show the user.
+    }
+}
+
+function applyIncomingDm(raw) {
+    if (!raw?.conversation_id) return;
+    if (raw.conversation_id === activeConversationId && !dmMessages.some((item) => item.id === raw.id)) {
+        dmMessages.push(normalizeMessage(raw));
+        if (mode === 'dm') renderMessages();
+    }
+    touchConversation(raw);
+}
+
+async function loadOlderDmMessages() {
+    if (!dmHistoryCursor || isLoadingOlder || !activeConversationId) return;
+    const conversationId = activeConversationId;
+    isLoadingOlder = true;
+    try {
+        const page = await conversationsApi.getMessages(conversationId, { before: dmHistoryCursor, limit: 50 });
+        if (conversationId !== activeConversationId) return;
+        dmHistoryCursor = page?.next_cursor || null;
+        const older = (page?.messages || []).map(normalizeMessage);
+        if (older.length) {
+            dmMessages = [...older, ...dmMessages];
+            if (mode === 'dm') renderMessages();
+        }
+    } catch (error) {
+        showToast(error.message || 'Не удалось загрузить историю', 'error');
+    } finally {
+        isLoadingOlder = false;
+    }
 }
 
-function activateGlobal(updateUrl = true) {
+async function loadOlderGlobalMessages() {
+    if (!globalHistoryCursor || isLoadingOlder) return;
+    isLoadingOlder = true;
+    try {
+        const page = await chatApi.getMessages({ room: activeRoomId, before: globalHistoryCursor, limit: 50 });
+        globalHistoryCursor = page?.next_cursor || null;
+        const older = (page?.messages || []).map(normalizeMessage);
+        if (older.length) {
+            globalMessages = [...older, ...globalMessages];
+            if (mode === 'global') renderMessages();
+        }
+    } catch (error) {
+        showToast(error.message || 'Не удалось загрузить историю', 'error');
+    } finally {
+        isLoadingOlder = false;
+    }
+}
+
+function activateGlobal(updateUrl = true, roomId = activeRoomId) {
     mode = 'global';
     activeConversationId = null;
     activeDmUserId = null;
-    stopDmPolling();
+    if (roomId !== activeRoomId) {
+        activeRoomId = roomId;
+        globalMessages = [];
+        globalHistoryCursor = null;
+        onlineCount = 0;
+        reconnectAttempts = 0;
+        connectWebSocket();
+    }
     if (updateUrl) setDmInUrl(null);
     updateHeader();
     renderConversationsList();
@@ -357,11 +468,13 @@ async function activateConversation(conversation, updateUrl = true) {
     activeConversationId = conversation.id;
     activeDmUserId = conversation.partner?.id || null;
     if (updateUrl) setDmInUrl(activeDmUserId);
-    setDmConnectionState('connecting');
     updateHeader();
     renderConversationsList();
     await loadDmMessages(true);
-    startDmPolling();
+    if (conversation.unread_count) {
+        await markConversationRead(conversation.id);
+        renderConversationsList();
+    }
 }
 
 async function startConversationWithUser(userId) {
@@ -389,11 +502,13 @@ async function sendMessage(text) {
     if (!payload) return false;
 
     if (mode === 'global') {
+        const frame = { message: payload, client_id: createClientId() };
+        pendingGlobalSends.set(frame.client_id, { room: activeRoomId, frame });
         if (!ws || ws.readyState !== WebSocket.OPEN) {
-            showToast('Нет подключения к общему чату', 'error');
-            return false;
+            showToast('Нет подключения, сообщение будет отправлено после переподключения', 'warning');
+            return true;
         }
-        ws.send(JSON.stringify({ message: payload }));
+        sendChatFrame(ws, frame);
         return true;
     }
 
@@ -404,28 +519,134 @@ async function sendMessage(text) {
 
     try {
         const message = await conversationsApi.sendMessage(activeConversationId, payload);
-        dmMessages.push(normalizeMessage(message));
+        applyIncomingDm(message);
         renderMessages(true);
-        await loadConversations(true);
-        setDmConnectionState('connected');
         return true;
     } catch (error) {
-        setDmConnectionState('disconnected');
         showToast(error.message || 'Не удалось отправить сообщение', 'error');
         return false;
     }
 }
 
+function createClientId() {
+    if (window.crypto?.randomUUID) return window.crypto.randomUUID();
+    return `c-${Date.now()}-${Math.random().toString(36).slice(2, 10)}`;
+}
+
+function resendPendingGlobalMessages(socket) {
+    // The server drops retransmits it has already stored and just acks them again.
+    pendingGlobalSends.forEach(({ room, frame }, clientId) => {
+        if (room !== activeRoomId) {
+            pendingGlobalSends.delete(clientId);
+            return;
+        }
+        sendChatFrame(socket, frame);
+    });
+}
+
+function handleDmSync(data) {
+    dmCursor = data?.cursor || dmCursor;
+    (data?.messages || []).forEach(applyIncomingDm);
+    if (data?.has_more) {
+        loadConversations(true);
+        loadDmMessages(false, true);
+    }
+}
+
+async function runDmLongPoll() {
+    // Fallback for networks where the DM WebSocket cannot stay open.
+    if (dmLongPollActive) return;
+    dmLongPollActive = true;
+    while (mounted && dmLongPollActive) {
+        try {
+            handleDmSync(await conversationsApi.getUpdates(dmCursor));
+            setDmConnectionState('connected');
+        } catch (error) {
+            setDmConnectionState('disconnected');
+            await new Promise((resolve) => setTimeout(resolve, 5000));
+        }
+    }
+}
+
+// A server restart is not a failure: wait for the hinted (or a random) delay instead of
+// backing off, so clients do not all reconnect at the same moment.
+function plannedRestartDelay(event, hintMs) {
+    if (hintMs !== null) return hintMs;
+    if (event && RESTART_CLOSE_CODES.has(event.code)) return Math.floor(Math.random() * RESTART_RECONNECT_SPREAD_MS);
+    return null;
+}
+
+function connectDmWebSocket() {
+    const token = getToken();
+    if (!token) return;
+
+    setDmConnectionState('connecting');
+    dmWs = createDmWebSocket(
+        token,
+        dmCursor,
+        (data) => {
+            if (data.type === 'dm_sync') {
+                handleDmSync(data);
+                return;
+            }
+            if (data.type === 'reconnect') {
+                dmReconnectHintMs = data.retry_after_ms ?? null;
+                return;
+            }
+            if (data.type === 'dm') {
+                dmCursor = data.cursor || dmCursor;
+                applyIncomingDm(data.data);
+            }
+        },
+        () => {
+            dmReconnectAttempts = 0;
+            setDmConnectionState('connected');
+        },
+        (event) => {
+            setDmConnectionState('disconnected');
+            if (!mounted) return;
+            const restartDelay = plannedRestartDelay(event, dmReconnectHintMs);
+            dmReconnectHintMs = null;
+            if (restartDelay !== null) {
+                setTimeout(() => {
+                    if (mounted && document.getElementById('chat-messages')) connectDmWebSocket();
+                }, restartDelay);
+                return;
+            }
+            if (dmReconnectAttempts >= MAX_RECONNECT_ATTEMPTS) {
+                runDmLongPoll();
+                return;
+            }
+            dmReconnectAttempts += 1;
+            setTimeout(() => {
+                if (mounted && document.getElementById('chat-messages')) connectDmWebSocket();
+            }, 2000 * dmReconnectAttempts);
+        },
+        () => setDmConnectionState('disconnected'),
+    );
+}
+
 function connectWebSocket() {
     const token = getToken();
     if (!token) return;
 
+    if (ws) {
+        const previous = ws;
+        ws = null;
+        previous.close();
+    }
+
     setGlobalConnectionState('connecting');
-    ws = createChatWebSocket(
+    const socket = createChatWebSocket(
         token,
+        activeRoomId,
         (data) => {
+            if (ws !== socket) return;
             if (data.type === 'history') {
                 globalMessages = (data.messages || []).map(normalizeMessage);
+                globalHistoryCursor = data.next_cursor || null;
+                onlineCount = (data.online || []).length;
+                if (mode === 'global') updateHeader();
                 if (mode === 'global') renderMessages(true);
                 return;
             }
@@ -434,30 +655,78 @@ function connectWebSocket() {
                 if (mode === 'global') renderMessages();
                 return;
             }
-            if (data.type === 'user_joined') {
-                globalMessages.push(normalizeMessage({ type: 'system', message: `${data.username} присоединился к чату`, systemType: 'join', systemIcon: 'user-plus' }));
-                if (mode === 'global') renderMessages();
+            if (data.type === 'reconnect') {
+                reconnectHintMs = data.retry_after_ms ?? null;
                 return;
             }
-            if (data.type === 'user_left') {
-                globalMessages.push(normalizeMessage({ type: 'system', message: `${data.username} покинул чат`, systemType: 'leave', systemIcon: 'user-minus' }));
-                if (mode === 'global') renderMessages();
+            if (data.type === 'ack') {
+                pendingGlobalSends.delete(data.client_id);
+                return;
+            }
+            if (data.type === 'error') {
+                const pending = data.client_id ? pendingGlobalSends.get(data.client_id) : null;
+                if (data.retry && pending) {
+                    // Another socket is still storing this message; send it again once that settles.
+                    setTimeout(() => {
+                        if (ws === socket && socket.readyState === WebSocket.OPEN && pendingGlobalSends.has(data.client_id)) {
+                            sendChatFrame(socket, pending.frame);
+                        }
+                    }, data.retry_after_ms ?? 1000);
+                    return;
+                }
+                if (data.client_id) pendingGlobalSends.delete(data.client_id);
+                showToast(data.code === 'rate_limited'
+                    ? 'Слишком много сообщений, подождите немного'
+                    : 'Сообщение не отправлено', 'error');
+                return;
+            }
+            if (data.type === 'presence') {
+                const joined = data.joined || [];
+                const left = data.left || [];
+                if (joined.length) {
+                    const verb = joined.length === 1 ? 'присоединился' : 'присоединились';
+                    globalMessages.push(normalizeMessage({ type: 'system', message: `${joined.join(', ')} ${verb} к чату`, systemType: 'join', systemIcon: 'user-plus' }));
+                }
+                if (left.length) {
+                    const verb = left.length === 1 ? 'покинул' : 'покинули';
+                    globalMessages.push(normalizeMessage({ type: 'system', message: `${left.join(', ')} ${verb} чат`, systemType: 'leave', systemIcon: 'user-minus' }));
+                }
+                onlineCount = data.online_count ?? onlineCount;
+                if (mode === 'global') {
+                    updateHeader();
+                    renderMessages();
+                }
             }
         },
         () => {
+            if (ws !== socket) return;
             reconnectAttempts = 0;
             setGlobalConnectionState('connected');
+            resendPendingGlobalMessages(socket);
         },
-        () => {
+        (event) => {
+            if (ws !== socket) return;
             setGlobalConnectionState('disconnected');
-            if (!mounted || reconnectAttempts >= MAX_RECONNECT_ATTEMPTS) return;
+            if (!mounted) return;
+            const restartDelay = plannedRestartDelay(event, reconnectHintMs);
+            reconnectHintMs = null;
+            if (restartDelay !== null) {
+                setTimeout(() => {
+                    if (mounted && ws === socket && document.getElementById('chat-messages')) connectWebSocket();
+                }, restartDelay);
+                return;
+            }
+            if (reconnectAttempts >= MAX_RECONNECT_ATTEMPTS) return;
             reconnectAttempts += 1;
             setTimeout(() => {
-                if (mounted && document.getElementById('chat-messages')) connectWebSocket();
+                if (mounted && ws === socket && document.getElementById('chat-messages')) connectWebSocket();
             }, 2000 * reconnectAttempts);
         },
-        () => setGlobalConnectionState('disconnected'),
+        () => {
+            if (ws === socket) setGlobalConnectionState('disconnected');
+        },
     );
+    ws = socket;
 }
 
 async function applyModeFromUrl() {
@@ -483,7 +752,12 @@ const handleSearchInput = debounce(async () => {
         return;
     }
     try {
-        searchResults = await usersApi.search(query, 20);
+        // Prefix matches come from the server's in-memory index; only substrings
+        // and typos need the database-backed search.
+        searchResults = await usersApi.typeahead(query, 20);
+        if (!searchResults.length) {
+            searchResults = await usersApi.search(query, 20);
+        }
     } catch (error) {
         searchResults = [];
         showToast(error.message || 'Ошибка поиска пользователей', 'error');
@@ -542,8 +816,12 @@ export function render() {
 export async function mount() {
     mounted = true;
     reconnectAttempts = 0;
+    dmReconnectAttempts = 0;
+    dmCursor = null;
     shouldStickToBottom = true;
     mode = 'global';
+    chatRooms = [DEFAULT_ROOM];
+    activeRoomId = DEFAULT_ROOM.id;
     activeConversationId = null;
     activeDmUserId = null;
 
@@ -594,6 +872,10 @@ export async function mount() {
     messagesEl?.addEventListener('scroll', () => {
         shouldStickToBottom = isNearBottom(messagesEl);
         updateScrollButton();
+        if (messagesEl.scrollTop <= SCROLL_TOP_THRESHOLD) {
+            if (mode === 'global') loadOlderGlobalMessages();
+            else loadOlderDmMessages();
+        }
     }, { passive: true });
 
     scrollBottomBtnEl?.addEventListener('click', () => {
@@ -603,9 +885,9 @@ export async function mount() {
     });
 
     conversationsListEl?.addEventListener('click', (event) => {
-        const globalBtn = event.target.closest('[data-action="global-room"]');
-        if (globalBtn) {
-            activateGlobal();
+        const roomBtn = event.target.closest('[data-room-id]');
+        if (roomBtn) {
+            activateGlobal(true, roomBtn.dataset.roomId || DEFAULT_ROOM.id);
             return;
         }
         const item = event.target.closest('[data-conversation-id]');
@@ -632,19 +914,27 @@ export async function mount() {
     updateScrollButton();
 
     connectWebSocket();
+    connectDmWebSocket();
+    await loadRooms();
     await loadConversations();
     await applyModeFromUrl();
 }
 
 export function unmount() {
     mounted = false;
-    stopDmPolling();
     if (ws) {
         ws.close();
         ws = null;
     }
+    if (dmWs) {
+        dmWs.close();
+        dmWs = null;
+    }
+    dmLongPollActive = false;
     globalMessages = [];
+    globalHistoryCursor = null;
     dmMessages = [];
+    dmHistoryCursor = null;
     conversations = [];
     searchResults = [];
 }
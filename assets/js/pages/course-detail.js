@@ -7,6 +7,9 @@ import { showModal, closeModal, confirmModal } from '../components/modal.js';
 let course = null;
 let purchases = [];
 let currentCourseId = null;
+// One key per purchase target until it succeeds, so a retry after a dropped
+// response gets the original purchase back instead of an error.
+const purchaseKeys = new Map();
 
 const SBP_PHONE_FALLBACK = '+7 987 745 65 36';
 const SBP_BANK_FALLBACK = 'Тинькофф / Сбер';
@@ -419,6 +422,16 @@ function showSbpModal(sbp, onClosed) {
     }, 0);
 }
 
+function getPurchaseKey(target) {
+    if (!purchaseKeys.has(target)) {
+        const key = window.crypto?.randomUUID
+            ? window.crypto.randomUUID()
+            : `p-${Date.now()}-${Math.random().toString(36).slice(2, 10)}`;
+        purchaseKeys.set(target, key);
+    }
+    return purchaseKeys.get(target);
+}
+
 async function handlePurchaseCourse(button) {
     if (!isAuthenticated()) {
         await router.navigate('/login');
@@ -432,7 +445,9 @@ async function handlePurchaseCourse(button) {
     }
 
     try {
-        const response = await coursesApi.purchaseCourse(currentCourseId);
+        const keyTarget = `course:${currentCourseId}`;
+        const response = await coursesApi.purchaseCourse(currentCourseId, getPurchaseKey(keyTarget));
+        purchaseKeys.delete(keyTarget);
 
         if (response?.sbp) {
             showSbpModal(response.sbp, async () => {
@@ -465,7 +480,9 @@ async function handlePurchasePart(partId, button) {
     }
 
     try {
-        const response = await coursesApi.purchasePart(currentCourseId, partId);
+        const keyTarget = `part:${partId}`;
+        const response = await coursesApi.purchasePart(currentCourseId, partId, getPurchaseKey(keyTarget));
+        purchaseKeys.delete(keyTarget);
 
         if (response?.sbp) {
             showSbpModal(response.sbp, async () => {
@@ -8,6 +8,8 @@ let course = null;
 let part = null;
 let currentCourseId = null;
 let currentPartId = null;
+let sectionsLoadId = 0;
+let pendingAnchor = null;
 
 function formatPrice(amount) {
     return `${Number(amount || 0).toLocaleString('ru-RU')} ₽`;
@@ -52,6 +54,92 @@ function renderNavButtons(prev, next, containerClass = '') {
     `;
 }
 
+function renderSection(section) {
+    if (!section) return '';
+    return `
+        <section class="reader-section" id="section-${escapeHtml(section.anchor)}" data-position="${Number(section.position)}">
+            ${renderMarkdown(section.content || '')}
+        </section>
+    `;
+}
+
+function renderToc() {
+    const headings = (part?.sections || []).filter((section) => section.level > 0 && !section.is_continuation);
+    if (headings.length < 2) return '';
+
+    return `
+        <nav class="reader-toc bg-discord-light rounded-xl border border-discord-lighter/40 p-4 mb-6">
+            <p class="text-white font-semibold mb-2">Содержание</p>
+            <ul class="space-y-1">
+                ${headings.map((section) => `
+                    <li style="padding-left: ${(section.level - 1) * 1}rem">
+                        <button type="button" class="reader-toc-link text-discord-text hover:text-white transition text-left" data-anchor="${escapeHtml(section.anchor)}">
+                            ${escapeHtml(section.title)}
+                        </button>
+                    </li>
+                `).join('')}
+            </ul>
+        </nav>
+    `;
+}
+
+function enhanceMarkdown(element) {
+    if (!element) return;
+
+    if (window.Prism) {
+        Prism.highlightAllUnder(element);
+    }
+
+    if (window.renderMathInElement) {
+        renderMathInElement(element, {
+            delimiters: [
+                { left: '$$', right: '$$', display: true },
+                { left: '$', right: '$', display: false },
+                { left: '\\[', right: '\\]', display: true },
+                { left: '\\(', right: '\\)', display: false },
+            ],
+            throwOnError: false,
+        });
+    }
+}
+
+function scrollToSection(anchor) {
+    const target = document.getElementById(`section-${anchor}`);
+    if (!target) {
+        // Not loaded yet; loadRemainingSections scrolls once it arrives.
+        pendingAnchor = anchor;
+        return;
+    }
+    pendingAnchor = null;
+    target.scrollIntoView({ behavior: 'smooth', block: 'start' });
+}
+
+async function loadRemainingSections(courseId, partId) {
+    const loadId = ++sectionsLoadId;
+    const remaining = (part?.sections || []).slice(1);
+
+    for (const summary of remaining) {
+        let section;
+        try {
+            section = await coursesApi.getPartSection(courseId, partId, summary.position);
+        } catch (error) {
+            if (loadId === sectionsLoadId) {
+                showToast(error.message || 'Ошибка загрузки раздела', 'error');
+            }
+            return;
+        }
+
+        const container = document.getElementById('reader-markdown-content');
+        if (loadId !== sectionsLoadId || !container) return;
+
+        container.insertAdjacentHTML('beforeend', renderSection(section));
+        enhanceMarkdown(container.lastElementChild);
+        if (pendingAnchor === section.anchor) {
+            scrollToSection(section.anchor);
+        }
+    }
+}
+
 function renderReader() {
     const container = document.getElementById('reader-content');
     if (!container || !course || !part) return;
@@ -78,8 +166,10 @@ function renderReader() {
                 <p class="text-discord-text text-sm">${escapeHtml(part.description || '')}</p>
             </div>
 
+            ${renderToc()}
+
             <div class="markdown-content bg-discord-light rounded-xl border border-discord-lighter/40 p-6" id="reader-markdown-content">
-                ${renderMarkdown(part.content || '')}
+                ${renderSection(part.first_section)}
             </div>
 
             ${renderNavButtons(prev, next, 'mt-8')}
@@ -95,24 +185,11 @@ function renderReader() {
         });
     });
 
-    if (window.Prism) {
-        Prism.highlightAll();
-    }
+    container.querySelectorAll('.reader-toc-link').forEach((button) => {
+        button.addEventListener('click', () => scrollToSection(button.dataset.anchor));
+    });
 
-    if (window.renderMathInElement) {
-        const markdownContainer = document.getElementById('reader-markdown-content');
-        if (markdownContainer) {
-            renderMathInElement(markdownContainer, {
-                delimiters: [
-                    { left: '$$', right: '$$', display: true },
-                    { left: '$', right: '$', display: false },
-                    { left: '\\[', right: '\\]', display: true },
-                    { left: '\\(', right: '\\)', display: false },
-                ],
-                throwOnError: false,
-            });
-        }
-    }
+    enhanceMarkdown(document.getElementById('reader-markdown-content'));
 }
 
 function renderNotFound(message = 'Раздел не найден') {
@@ -260,8 +337,12 @@ async function loadCourse(courseId) {
 
 async function loadPartContent(courseId, partId) {
     try {
-        part = await coursesApi.getPartContent(courseId, partId);
+        // The table of contents carries the first section, so the first screen
+        // renders before the rest of a long part has been fetched.
+        part = await coursesApi.getPartToc(courseId, partId);
+        pendingAnchor = null;
         renderReader();
+        loadRemainingSections(courseId, partId);
     } catch (error) {
         const message = error.message || '';
 
@@ -380,4 +461,6 @@ export function unmount() {
     part = null;
     currentCourseId = null;
     currentPartId = null;
+    sectionsLoadId += 1;
+    pendingAnchor = null;
 }
@@ -7,9 +7,11 @@ from typing import AsyncIterator
 import ssl
 
 from dotenv import load_dotenv
-from sqlalchemy import Boolean, CheckConstraint, DateTime, ForeignKey, Index, String, Text, UniqueConstraint
+from sqlalchemy import Boolean, CheckConstraint, DateTime, ForeignKey, Index, String, Text, UniqueConstraint, inspect, text
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from sqlalchemy.exc import DBAPIError, IntegrityError, OperationalError
+from sqlalchemy.schema import CreateColumn
 
 load_dotenv()
 
@@ -105,16 +107,39 @@ class AdminResetRequest(Base):
     completed_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
 
 
-class ChatMessage(Base):
-    __tablename__ = "chat_messages"
+DEFAULT_CHAT_ROOM = "general"
+
+
+class ChatMessage(Base):
+    __tablename__ = "chat_messages"
+    __table_args__ = (
+        Index("ix_chat_messages_timestamp_id", "timestamp", "id"),
+        Index("ix_chat_messages_room_timestamp_id", "room", "timestamp", "id"),
+    )
 
     id: Mapped[str] = mapped_column(String(36), primary_key=True)
+    room: Mapped[str] = mapped_column(String(64), default=DEFAULT_CHAT_ROOM, server_default=DEFAULT_CHAT_ROOM)
     user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     username: Mapped[str] = mapped_column(String(50), nullable=False)
     message: Mapped[str] = mapped_column(Text, nullable=False)
     timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
 
 
+class ChatMessageArchive(Base):
+    __tablename__ = "chat_messages_archive"
+    __table_args__ = (
+        Index("ix_chat_messages_archive_room_timestamp_id", "room", "timestamp", "id"),
+    )
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True)
+    room: Mapped[str] = mapped_column(String(64), default=DEFAULT_CHAT_ROOM, server_default=DEFAULT_CHAT_ROOM)
+    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    username: Mapped[str] = mapped_column(String(50), nullable=False)
+    message: Mapped[str] = mapped_column(Text, nullable=False)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
+    archived_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
+
+
 class UserProfile(Base):
     __tablename__ = "user_profiles"
 
@@ -132,16 +157,33 @@ class Conversation(Base):
     __tablename__ = "conversations"
     __table_args__ = (
         UniqueConstraint("user_a", "user_b", name="uq_conversations_pair"),
+        Index("ix_conversations_user_a_activity", "user_a", "last_activity_at", "id"),
+        Index("ix_conversations_user_b_activity", "user_b", "last_activity_at", "id"),
     )
 
     id: Mapped[str] = mapped_column(String(36), primary_key=True)
     user_a: Mapped[str] = mapped_column(String(36), ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     user_b: Mapped[str] = mapped_column(String(36), ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
+    # Denormalized from direct_messages by send_conversation_message so the inbox
+    # never has to scan messages; repair_conversation_stats() rebuilds them.
+    last_message_id: Mapped[str | None] = mapped_column(String(36), nullable=True)
+    last_message_preview: Mapped[str | None] = mapped_column(String(200), nullable=True)
+    last_message_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    last_activity_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    message_count: Mapped[int] = mapped_column(default=0, server_default="0")
+    # Per-participant read markers and the number of partner messages after them.
+    user_a_last_read_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    user_b_last_read_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    user_a_unread: Mapped[int] = mapped_column(default=0, server_default="0")
+    user_b_unread: Mapped[int] = mapped_column(default=0, server_default="0")
 
 
 class DirectMessage(Base):
     __tablename__ = "direct_messages"
+    __table_args__ = (
+        Index("ix_direct_messages_conversation_created_id", "conversation_id", "created_at", "id"),
+    )
 
     id: Mapped[str] = mapped_column(String(36), primary_key=True)
     conversation_id: Mapped[str] = mapped_column(
@@ -203,6 +245,30 @@ class CoursePart(Base):
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, onupdate=datetime.now)
 
 
+class CoursePartSection(Base):
+    """A slice of CoursePart.content cut at Markdown headings when the part is saved."""
+
+    __tablename__ = "course_part_sections"
+
+    part_id: Mapped[str] = mapped_column(
+        String(36), ForeignKey("course_parts.id", ondelete="CASCADE"), primary_key=True
+    )
+    position: Mapped[int] = mapped_column(primary_key=True)
+    title: Mapped[str] = mapped_column(String(255), default="")
+    level: Mapped[int] = mapped_column(default=0)
+    anchor: Mapped[str] = mapped_column(String(255), default="")
+    is_continuation: Mapped[bool] = mapped_column(Boolean, default=False)
+    char_count: Mapped[int] = mapped_column(default=0)
+    content: Mapped[str] = mapped_column(Text, default="")
+
+
+# A user holds at most one pending or completed purchase per course and per part.
+# The purchase endpoints insert with ON CONFLICT against these same predicates,
+# so the texts have to match the index definitions exactly.
+ACTIVE_COURSE_PURCHASE_WHERE = text("course_id IS NOT NULL AND status IN ('pending', 'completed')")
+ACTIVE_PART_PURCHASE_WHERE = text("part_id IS NOT NULL AND status IN ('pending', 'completed')")
+
+
 class Purchase(Base):
     __tablename__ = "purchases"
     __table_args__ = (
@@ -216,8 +282,30 @@ class Purchase(Base):
             "status IN ('pending', 'completed', 'cancelled')",
             name="ck_purchase_status",
         ),
-        Index("ix_purchases_user_id", "user_id"),
-        Index("ix_purchases_status", "status"),
+        # Every admin listing filter is an equality prefix followed by the
+        # (created_at, id) keyset, so each one walks a single index in order.
+        Index("ix_purchases_created_id", "created_at", "id"),
+        Index("ix_purchases_user_created_id", "user_id", "created_at", "id"),
+        Index("ix_purchases_status_created_id", "status", "created_at", "id"),
+        Index("ix_purchases_course_created_id", "course_id", "created_at", "id"),
+        Index("ix_purchases_part_created_id", "part_id", "created_at", "id"),
+        Index("ix_purchases_sbp_comment", "sbp_comment"),
+        Index(
+            "ux_purchases_active_course",
+            "user_id",
+            "course_id",
+            unique=True,
+            sqlite_where=ACTIVE_COURSE_PURCHASE_WHERE,
+            postgresql_where=ACTIVE_COURSE_PURCHASE_WHERE,
+        ),
+        Index(
+            "ux_purchases_active_part",
+            "user_id",
+            "part_id",
+            unique=True,
+            sqlite_where=ACTIVE_PART_PURCHASE_WHERE,
+            postgresql_where=ACTIVE_PART_PURCHASE_WHERE,
+        ),
     )
 
     id: Mapped[str] = mapped_column(String(36), primary_key=True)
@@ -236,9 +324,196 @@ class Purchase(Base):
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
 
 
-async def init_models() -> None:
+def _add_missing_columns(sync_conn) -> None:
+    # Same story for columns: new ones need a server_default (or nullable) so
+    # ALTER TABLE can backfill existing rows.
+    inspector = inspect(sync_conn)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            if not column.nullable and column.server_default is None:
+                continue
+            column_ddl = CreateColumn(column).compile(dialect=sync_conn.dialect)
+            sync_conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}")
+
+
+# Unique indexes init_models() could not build because existing rows violate them.
+unbuilt_unique_indexes: set[str] = set()
+
+
+def _create_missing_indexes(sync_conn) -> None:
+    # create_all() only emits CREATE INDEX for tables it creates itself, so
+    # indexes added to existing tables have to be created separately.
+    unbuilt_unique_indexes.clear()
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            if any(column.name not in existing_columns for column in index.columns):
+                continue
+            if not index.unique:
+                index.create(sync_conn, checkfirst=True)
+                continue
+            # Rows written before a unique index existed may violate it; keep
+            # serving and leave the cleanup to an admin instead of failing startup.
+            try:
+                with sync_conn.begin_nested():
+                    index.create(sync_conn, checkfirst=True)
+            except IntegrityError:
+                unbuilt_unique_indexes.add(index.name)
+                print(
+                    f"WARNING: unique index {index.name} on {table.name} was not created: existing "
+                    "rows violate it. Writes that rely on it fall back to locked select-then-insert. "
+                    "Remove the duplicates (for purchases, keep one pending or completed purchase "
+                    "per user and target) and restart to build it."
+                )
+
+
+def is_unique_index_built(name: str) -> bool:
+    return name not in unbuilt_unique_indexes
+
+
+# Search index over username and display_name, kept in sync by triggers so every
+# write path (register, profile edits, admin tools, raw SQL) is covered.
+# user_search_docs has an INTEGER PRIMARY KEY so FTS rowids survive VACUUM.
+SQLITE_USER_SEARCH_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS user_search_docs (
+        id INTEGER PRIMARY KEY,
+        user_id VARCHAR(36) NOT NULL UNIQUE,
+        username TEXT NOT NULL COLLATE NOCASE,
+        display_name TEXT NOT NULL DEFAULT '' COLLATE NOCASE
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_user_search_docs_username ON user_search_docs (username)",
+    "CREATE INDEX IF NOT EXISTS ix_user_search_docs_display_name ON user_search_docs (display_name)",
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS user_search_fts USING fts5(
+        username, display_name, content='user_search_docs', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS user_search_docs_ai AFTER INSERT ON user_search_docs BEGIN
+        INSERT INTO user_search_fts(rowid, username, display_name) VALUES (new.id, new.username, new.display_name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS user_search_docs_ad AFTER DELETE ON user_search_docs BEGIN
+        INSERT INTO user_search_fts(user_search_fts, rowid, username, display_name)
+        VALUES ('delete', old.id, old.username, old.display_name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS user_search_docs_au AFTER UPDATE ON user_search_docs BEGIN
+        INSERT INTO user_search_fts(user_search_fts, rowid, username, display_name)
+        VALUES ('delete', old.id, old.username, old.display_name);
+        INSERT INTO user_search_fts(rowid, username, display_name) VALUES (new.id, new.username, new.display_name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_search_ai AFTER INSERT ON users BEGIN
+        INSERT INTO user_search_docs(user_id, username, display_name) VALUES (new.id, new.username, '');
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_search_au AFTER UPDATE OF username ON users BEGIN
+        UPDATE user_search_docs SET username = new.username WHERE user_id = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_search_ad AFTER DELETE ON users BEGIN
+        DELETE FROM user_search_docs WHERE user_id = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS user_profiles_search_ai AFTER INSERT ON user_profiles BEGIN
+        UPDATE user_search_docs SET display_name = coalesce(new.display_name, '') WHERE user_id = new.user_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS user_profiles_search_au AFTER UPDATE OF display_name ON user_profiles BEGIN
+        UPDATE user_search_docs SET display_name = coalesce(new.display_name, '') WHERE user_id = new.user_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS user_profiles_search_ad AFTER DELETE ON user_profiles BEGIN
+        UPDATE user_search_docs SET display_name = '' WHERE user_id = old.user_id;
+    END
+    """,
+    # Backfill users created before the index existed.
+    """
+    INSERT INTO user_search_docs(user_id, username, display_name)
+    SELECT users.id, users.username, coalesce(user_profiles.display_name, '')
+    FROM users LEFT JOIN user_profiles ON user_profiles.user_id = users.id
+    WHERE NOT EXISTS (SELECT 1 FROM user_search_docs WHERE user_search_docs.user_id = users.id)
+    """,
+)
+
+POSTGRES_USER_SEARCH_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users USING gin (lower(username) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_user_profiles_display_name_trgm "
+    "ON user_profiles USING gin (lower(display_name) gin_trgm_ops)",
+)
+
+# Which search index init_models() managed to set up: "fts5", "pg_trgm" or None (plain LIKE).
+user_search_backend: str | None = None
+
+
+def _sqlite_supports_fts5_trigram(sync_conn) -> bool:
+    options = {row[0] for row in sync_conn.exec_driver_sql("PRAGMA compile_options")}
+    version = sync_conn.exec_driver_sql("SELECT sqlite_version()").scalar()
+    # The trigram tokenizer arrived in SQLite 3.34.
+    return "ENABLE_FTS5" in options and tuple(int(part) for part in version.split(".")[:2]) >= (3, 34)
+
+
+def _create_user_search_index(sync_conn) -> None:
+    global user_search_backend
+
+    dialect = sync_conn.dialect.name
+    if dialect == "sqlite":
+        # pysqlite does not handle savepoints around DDL reliably, so support is
+        # probed up front instead of rolling back a failed build.
+        if not _sqlite_supports_fts5_trigram(sync_conn):
+            print("WARNING: SQLite lacks FTS5 trigram support, user search falls back to LIKE")
+            user_search_backend = None
+            return
+        for statement in SQLITE_USER_SEARCH_DDL:
+            sync_conn.exec_driver_sql(statement)
+        user_search_backend = "fts5"
+        return
+
+    if dialect != "postgresql":
+        return
+
+    # A savepoint keeps a missing pg_trgm permission from aborting init_models().
+    try:
+        with sync_conn.begin_nested():
+            for statement in POSTGRES_USER_SEARCH_DDL:
+                sync_conn.exec_driver_sql(statement)
+    except (OperationalError, DBAPIError) as exc:
+        print(f"WARNING: user search index unavailable, falling back to LIKE: {exc}")
+        user_search_backend = None
+        return
+
+    user_search_backend = "pg_trgm"
+
+
+def get_user_search_backend() -> str | None:
+    return user_search_backend
+
+
+async def init_models() -> None:
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_create_missing_indexes)
+        await conn.run_sync(_create_user_search_index)
 
 
 async def get_session() -> AsyncIterator[AsyncSession]:
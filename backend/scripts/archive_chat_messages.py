@@ -0,0 +1,21 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from backend.database import init_models  # noqa: E402
+from backend.server import CHAT_RETENTION_DAYS, archive_old_chat_messages, compact_chat_storage  # noqa: E402
+
+
+async def archive_chat_messages(vacuum: bool):
+    await init_models()
+
+    archived = await archive_old_chat_messages()
+    # --vacuum also reclaims the freed pages on SQLite; run it in a quiet window.
+    await compact_chat_storage(archived, vacuum=vacuum)
+    print(f"Archived {archived} chat messages older than {CHAT_RETENTION_DAYS} days")
+
+
+if __name__ == "__main__":
+    asyncio.run(archive_chat_messages(vacuum="--vacuum" in sys.argv[1:]))
@@ -0,0 +1,70 @@
+import asyncio
+import json
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from backend.server import ConnectionManager, encode_frame, orjson  # noqa: E402
+
+RECIPIENTS = 1000
+MESSAGES = 200
+
+
+class FakeWebSocket:
+    """Mimics Starlette's send_json, which serializes once per call."""
+
+    async def send_text(self, data: str) -> None:
+        return None
+
+    async def send_json(self, data: dict) -> None:
+        await self.send_text(json.dumps(data, separators=(",", ":"), ensure_ascii=False))
+
+
+class PerRecipientManager(ConnectionManager):
+    async def broadcast(self, message: dict) -> None:
+        for connection in self.active_connections:
+            await connection["websocket"].send_json(message)
+
+
+def build_message(index: int) -> dict:
+    return {
+        "type": "message",
+        "data": {
+            "id": str(uuid.uuid4()),
+            "user_id": str(uuid.uuid4()),
+            "username": "benchmark_user",
+            "message": f"Сообщение номер {index}: " + "lorem ipsum dolor sit amet " * 4,
+            "timestamp": datetime.now().isoformat(),
+        },
+    }
+
+
+async def measure(manager: ConnectionManager) -> float:
+    for _ in range(RECIPIENTS):
+        await manager.connect(FakeWebSocket(), str(uuid.uuid4()), "listener")
+
+    messages = [build_message(index) for index in range(MESSAGES)]
+    started = time.process_time()
+    for message in messages:
+        await manager.broadcast(message)
+    return (time.process_time() - started) / MESSAGES
+
+
+async def main() -> None:
+    per_recipient = await measure(PerRecipientManager())
+    encode_once = await measure(ConnectionManager())
+    frame_size = len(encode_frame(build_message(0)))
+
+    print(f"Recipients: {RECIPIENTS}, messages: {MESSAGES}, frame: {frame_size} chars")
+    print(f"Encoder: {'orjson' if orjson is not None else 'json (stdlib)'}")
+    print(f"send_json per recipient: {per_recipient * 1000:.3f} ms CPU per message")
+    print(f"encode once:             {encode_once * 1000:.3f} ms CPU per message")
+    print(f"Speedup: {per_recipient / encode_once:.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,105 @@
+import asyncio
+import os
+import random
+import statistics
+import string
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+DB_FD, DB_PATH = tempfile.mkstemp(prefix="mydefaultsite-search-bench-", suffix=".db")
+os.close(DB_FD)
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_PATH}"
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from sqlalchemy import select, text  # noqa: E402
+
+from backend.database import User, async_session_factory, engine, get_user_search_backend, init_models  # noqa: E402
+from backend.server import search_user_ids, user_typeahead  # noqa: E402
+
+USERS = 100_000
+QUERIES = 200
+SYLLABLES = ["al", "ex", "an", "der", "ma", "ri", "ko", "va", "ne", "sha", "dim", "ol", "ga", "ser", "gey", "ta"]
+
+
+def random_name(rng: random.Random) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) + str(rng.randint(0, 999))
+
+
+def with_typo(rng: random.Random, value: str) -> str:
+    index = rng.randrange(1, len(value) - 1)
+    return value[:index] + rng.choice(string.ascii_lowercase) + value[index + 1:]
+
+
+async def seed(rng: random.Random) -> list[str]:
+    names = list({random_name(rng) for _ in range(USERS * 2)})[:USERS]
+    now = datetime.now()
+    async with engine.begin() as conn:
+        await conn.execute(
+            text("INSERT INTO users (id, username, email, password_hash, role, created_at) VALUES (:id, :username, NULL, '-', 'user', :now)"),
+            [{"id": str(uuid.uuid4()), "username": name, "now": now} for name in names],
+        )
+    return names
+
+
+async def measure(label: str, run) -> None:
+    timings = []
+    for query in QUERY_SET:
+        started = time.perf_counter()
+        async with async_session_factory() as session:
+            await run(session, query)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"{label:<22} p50 {statistics.median(timings):7.2f} ms   p95 {timings[int(len(timings) * 0.95)]:7.2f} ms")
+
+
+async def ilike_scan(session, query: str) -> None:
+    await session.execute(select(User.id).where(User.username.ilike(f"%{query}%")).order_by(User.username).limit(20))
+
+
+async def indexed_search(session, query: str) -> None:
+    await search_user_ids(session, query, "", 20)
+
+
+QUERY_SET: list[str] = []
+
+
+async def main() -> None:
+    rng = random.Random(42)
+    await init_models()
+    started = time.perf_counter()
+    names = await seed(rng)
+    print(f"Seeded {len(names)} users in {time.perf_counter() - started:.1f}s (search backend: {get_user_search_backend()})")
+
+    samples = rng.sample(names, QUERIES)
+    QUERY_SET.extend(name[: rng.randint(2, 6)] for name in samples[: QUERIES // 2])
+    QUERY_SET.extend(with_typo(rng, name) for name in samples[QUERIES // 2:])
+
+    await measure("ILIKE '%q%' (before)", ilike_scan)
+    await measure("indexed search", indexed_search)
+
+    await user_typeahead.rebuild()
+    prefixes = QUERY_SET[: QUERIES // 2]
+    timings = []
+    for query in prefixes:
+        started = time.perf_counter()
+        user_typeahead.search(query, 20)
+        timings.append((time.perf_counter() - started) * 1_000_000)
+    timings.sort()
+    print(f"{'typeahead trie':<22} p50 {statistics.median(timings):7.1f} us   p95 {timings[int(len(timings) * 0.95)]:7.1f} us")
+    report = user_typeahead.memory_report()
+    print(
+        f"Trie: {report['nodes']} nodes, {report['terms']} terms, "
+        f"{report['total_bytes'] / 1048576:.1f} MB, built in {report['build_seconds']}s"
+    )
+
+    await engine.dispose()
+    os.remove(DB_PATH)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,19 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from backend.database import init_models  # noqa: E402
+from backend.server import repair_conversation_stats  # noqa: E402
+
+
+async def repair_conversations():
+    await init_models()
+
+    repaired = await repair_conversation_stats()
+    print(f"Recomputed last-message stats for {repaired} conversations")
+
+
+if __name__ == "__main__":
+    asyncio.run(repair_conversations())
@@ -1,33 +1,66 @@
 import asyncio
 import base64
+import codecs
+import csv
+import hashlib
+import heapq
+import io
+import json
 import os
 import random
+import re
 import secrets
+import signal
 import string
+import sys
+import threading
+import time
 import uuid
 import httpx
+from collections import OrderedDict
 from contextlib import asynccontextmanager, suppress
 from datetime import datetime, timedelta
-from typing import Any
+from decimal import Decimal, InvalidOperation
+from typing import Any, Awaitable, BinaryIO, Callable
 
 import bcrypt
 import resend
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, File, Form, HTTPException, Request, UploadFile, WebSocket, WebSocketDisconnect, status
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, Request, UploadFile, WebSocket, WebSocketDisconnect, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from pydantic import BaseModel, ConfigDict, EmailStr, Field, field_validator, model_validator
-from sqlalchemy import and_, delete, or_, select, text, update
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import and_, case, delete, func, insert, literal, or_, select, text, union_all, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import defer
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional binary protocol
+    msgpack = None
 
 from backend.database import (
+    ACTIVE_COURSE_PURCHASE_WHERE,
+    ACTIVE_PART_PURCHASE_WHERE,
+    DEFAULT_CHAT_ROOM,
     AdminResetRequest,
     ChatMessage,
+    ChatMessageArchive,
     Conversation,
     Course,
     CoursePart,
+    CoursePartSection,
     DirectMessage,
     File as FileModel,
     PasswordReset as PasswordResetModel,
@@ -36,18 +69,52 @@ from backend.database import (
     Service,
     User,
     UserProfile,
-    async_session_factory,
-    get_session,
-    init_models,
-)
+    async_session_factory,
+    engine,
+    get_session,
+    get_user_search_backend,
+    init_models,
+    is_unique_index_built,
+)
 
 load_dotenv()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global _websockets_draining
     await init_models()
-    yield
+    # Conversations created before the activity columns existed are backfilled once.
+    await repair_conversation_stats(only_missing=True)
+    # Parts saved before sectioning existed are indexed once.
+    await index_course_part_sections(only_missing=True)
+    try:
+        await user_typeahead.rebuild()
+        report = user_typeahead.memory_report()
+        print(
+            f"User typeahead: {report['users']} users, {report['nodes']} nodes, "
+            f"~{report['total_bytes'] / 1048576:.1f} MB, built in {report['build_seconds']}s"
+        )
+    except SQLAlchemyError as exc:
+        print(f"User typeahead build failed, falling back to search: {exc}")
+    _websockets_draining = False
+    restore_signal_handlers = install_websocket_drain_on_signals()
+    background_tasks = [
+        asyncio.create_task(run_chat_retention_loop()),
+        asyncio.create_task(run_presence_flush_loop()),
+        asyncio.create_task(run_websocket_heartbeat_loop()),
+    ]
+    try:
+        yield
+    finally:
+        restore_signal_handlers()
+        # Only does anything when no exit signal came first (embedded servers, tests).
+        await drain_websockets()
+        for task in background_tasks:
+            task.cancel()
+        for task in background_tasks:
+            with suppress(asyncio.CancelledError):
+                await task
 
 
 app = FastAPI(lifespan=lifespan)
@@ -84,33 +151,356 @@ else:
 VALID_DM_PRIVACY_VALUES = {"all", "none"}
 DEFAULT_DM_PRIVACY = "all"
 MAX_DM_MESSAGE_LENGTH = 1000
+MAX_CHAT_MESSAGE_LENGTH = 1000
+CHAT_HISTORY_PAGE_SIZE = 50
+MAX_CHAT_HISTORY_PAGE_SIZE = 100
+DM_SYNC_LIMIT = 200
+DM_HISTORY_PAGE_SIZE = 50
+MAX_DM_HISTORY_PAGE_SIZE = 100
+MAX_CONVERSATIONS_PAGE_SIZE = 200
+CONVERSATION_PREVIEW_LENGTH = 200
+USER_SEARCH_CANDIDATES = 200
+USER_SEARCH_MIN_SIMILARITY = 0.3
+MAX_USER_SEARCH_QUERY_LENGTH = 50
+USER_CARD_CACHE_SIZE = int(os.getenv("USER_CARD_CACHE_SIZE", "5000"))
+USER_CARD_CACHE_TTL_SECONDS = float(os.getenv("USER_CARD_CACHE_TTL_SECONDS", "300"))
+ADMIN_PURCHASES_PAGE_SIZE = 50
+MAX_ADMIN_PURCHASES_PAGE_SIZE = 200
+ADMIN_PURCHASES_EXPORT_BATCH = 500
+ADMIN_PURCHASES_EXPORT_COLUMNS = (
+    "id",
+    "created_at",
+    "status",
+    "amount",
+    "user_id",
+    "username",
+    "course_id",
+    "course_title",
+    "part_id",
+    "part_title",
+    "sbp_comment",
+)
+SBP_STATEMENT_MAX_BYTES = int(os.getenv("SBP_STATEMENT_MAX_BYTES", str(20 * 1024 * 1024)))
+SBP_RECONCILE_BATCH = 500
+SBP_REFERENCE_PATTERN = re.compile(r"\b(?:CRS|PRT)-[0-9A-F]{8}\b")
+SBP_AMOUNT_HEADERS = ("сумма", "amount", "приход", "кредит", "credit")
+COURSE_SECTION_HEADING_LEVEL = 2
+COURSE_SECTION_TARGET_CHARS = 12000
+COURSE_CATALOG_TTL_SECONDS = float(os.getenv("COURSE_CATALOG_TTL_SECONDS", "60"))
+COURSE_DETAIL_CACHE_SIZE = int(os.getenv("COURSE_DETAIL_CACHE_SIZE", "500"))
+ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", "5000"))
+ENTITLEMENT_CACHE_TTL_SECONDS = float(os.getenv("ENTITLEMENT_CACHE_TTL_SECONDS", "300"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+USER_TYPEAHEAD_MAX_RESULTS = int(os.getenv("USER_TYPEAHEAD_MAX_RESULTS", "20"))
+USER_TYPEAHEAD_BUILD_BATCH = 1000
+CHAT_PUBLIC_ROOMS = {
+    DEFAULT_CHAT_ROOM: "Общая комната",
+    "offtopic": "Флудилка",
+}
+COURSE_ROOM_PREFIX = "course:"
+CHAT_RETENTION_DAYS = int(os.getenv("CHAT_RETENTION_DAYS", "30"))
+CHAT_ARCHIVE_BATCH_SIZE = int(os.getenv("CHAT_ARCHIVE_BATCH_SIZE", "500"))
+CHAT_RETENTION_INTERVAL_SECONDS = int(os.getenv("CHAT_RETENTION_INTERVAL_SECONDS", "3600"))
+PRESENCE_FLUSH_INTERVAL_SECONDS = float(os.getenv("PRESENCE_FLUSH_INTERVAL_SECONDS", "2"))
+WS_PING_INTERVAL_SECONDS = float(os.getenv("WS_PING_INTERVAL_SECONDS", "25"))
+WS_PING_TIMEOUT_SECONDS = float(os.getenv("WS_PING_TIMEOUT_SECONDS", "20"))
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "0"))
+WS_CLOSE_TIMEOUT_SECONDS = 5
+WS_DRAIN_RECONNECT_SPREAD_MS = int(os.getenv("WS_DRAIN_RECONNECT_SPREAD_MS", "10000"))
+WS_DRAIN_GRACE_SECONDS = float(os.getenv("WS_DRAIN_GRACE_SECONDS", "10"))
+WS_MAX_SIZE_BYTES = int(os.getenv("WS_MAX_SIZE_BYTES", "65536"))
+CHAT_MAX_FRAME_BYTES = int(os.getenv("CHAT_MAX_FRAME_BYTES", "8192"))
+CHAT_USER_RATE_PER_SECOND = float(os.getenv("CHAT_USER_RATE_PER_SECOND", "1"))
+CHAT_USER_BURST = int(os.getenv("CHAT_USER_BURST", "5"))
+CHAT_IP_RATE_PER_SECOND = float(os.getenv("CHAT_IP_RATE_PER_SECOND", "3"))
+CHAT_IP_BURST = int(os.getenv("CHAT_IP_BURST", "15"))
+CHAT_FLOOD_MAX_DELAY_SECONDS = float(os.getenv("CHAT_FLOOD_MAX_DELAY_SECONDS", "1"))
+CHAT_FLOOD_MAX_STRIKES = int(os.getenv("CHAT_FLOOD_MAX_STRIKES", "10"))
+CHAT_CONTROL_RATE_PER_SECOND = float(os.getenv("CHAT_CONTROL_RATE_PER_SECOND", "1"))
+CHAT_CONTROL_BURST = int(os.getenv("CHAT_CONTROL_BURST", "5"))
+CHAT_RATE_LIMIT_MAX_KEYS = 10000
+CHAT_DEDUPE_WINDOW_SECONDS = int(os.getenv("CHAT_DEDUPE_WINDOW_SECONDS", "300"))
+CHAT_DEDUPE_MAX_ENTRIES = 10000
+MAX_CHAT_CLIENT_ID_LENGTH = 64
+DM_LONG_POLL_TIMEOUT_SECONDS = 25
+MAX_DM_LONG_POLL_TIMEOUT_SECONDS = 55
+
+
+CHAT_SUBPROTOCOL_JSON = "chat.v1.json"
+CHAT_SUBPROTOCOL_MSGPACK = "chat.v1.msgpack"
+
+
+def negotiate_chat_subprotocol(websocket: WebSocket) -> str | None:
+    offered = websocket.scope.get("subprotocols") or []
+    if CHAT_SUBPROTOCOL_MSGPACK in offered and msgpack is not None:
+        return CHAT_SUBPROTOCOL_MSGPACK
+    if CHAT_SUBPROTOCOL_JSON in offered:
+        return CHAT_SUBPROTOCOL_JSON
+    return None
+
+
+def encode_frame(message: dict, protocol: str | None = CHAT_SUBPROTOCOL_JSON) -> str | bytes:
+    if protocol == CHAT_SUBPROTOCOL_MSGPACK:
+        return msgpack.packb(message, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(message).decode("utf-8")
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+
+async def send_frame(websocket: WebSocket, frame: str | bytes) -> None:
+    if isinstance(frame, bytes):
+        await websocket.send_bytes(frame)
+    else:
+        await websocket.send_text(frame)
+
+
+class ChatFrameTooLarge(Exception):
+    pass
+
+
+async def receive_frame(websocket: WebSocket, protocol: str | None, max_bytes: int | None = None) -> Any:
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+
+    raw = message.get("bytes") if message.get("bytes") is not None else (message.get("text") or "").encode("utf-8")
+    # Size is checked on the raw frame so oversized payloads are never parsed.
+    if max_bytes is not None and len(raw) > max_bytes:
+        raise ChatFrameTooLarge(len(raw))
+
+    if protocol == CHAT_SUBPROTOCOL_MSGPACK:
+        return msgpack.unpackb(raw, raw=False)
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def reserve(self, max_wait: float) -> float | None:
+        """Takes one token, returning how long the caller must wait for it, or None if that exceeds max_wait."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        if wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+    def refund(self) -> None:
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class ChatRateLimiter:
+    """Token buckets per user and per client IP; a frame must fit into both.
+
+    Control frames (heartbeat pongs) have a separate small per-user bucket so they
+    never eat into the message budget but cannot be flooded either.
+    """
+
+    def __init__(
+        self,
+        user_rate: float = CHAT_USER_RATE_PER_SECOND,
+        user_burst: int = CHAT_USER_BURST,
+        ip_rate: float = CHAT_IP_RATE_PER_SECOND,
+        ip_burst: int = CHAT_IP_BURST,
+        control_rate: float = CHAT_CONTROL_RATE_PER_SECOND,
+        control_burst: int = CHAT_CONTROL_BURST,
+        max_keys: int = CHAT_RATE_LIMIT_MAX_KEYS,
+    ):
+        self.limits = {
+            "user": (user_rate, user_burst),
+            "ip": (ip_rate, ip_burst),
+            "control": (control_rate, control_burst),
+        }
+        self.max_keys = max_keys
+        self.buckets: OrderedDict[tuple[str, str], TokenBucket] = OrderedDict()
+        self.counters = {
+            "accepted": 0,
+            "delayed": 0,
+            "dropped": 0,
+            "oversized": 0,
+            "invalid": 0,
+            "disconnected": 0,
+            "control": 0,
+            "control_dropped": 0,
+        }
+
+    def _bucket(self, kind: str, key: str) -> TokenBucket:
+        bucket = self.buckets.get((kind, key))
+        if bucket is None:
+            bucket = self.buckets[(kind, key)] = TokenBucket(*self.limits[kind])
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end((kind, key))
+        return bucket
+
+    def reserve(self, user_id: str, client_ip: str | None, max_wait: float = CHAT_FLOOD_MAX_DELAY_SECONDS) -> float | None:
+        user_bucket = self._bucket("user", user_id)
+        user_wait = user_bucket.reserve(max_wait)
+        if user_wait is None:
+            self.counters["dropped"] += 1
+            return None
+
+        ip_wait = 0.0
+        if client_ip:
+            ip_wait = self._bucket("ip", client_ip).reserve(max_wait)
+            if ip_wait is None:
+                user_bucket.refund()
+                self.counters["dropped"] += 1
+                return None
+
+        wait = max(user_wait, ip_wait)
+        self.counters["delayed" if wait > 0 else "accepted"] += 1
+        return wait
+
+    def allow_control(self, user_id: str) -> bool:
+        # Control frames are never delayed: either a token is free right now or the frame is dropped.
+        if self._bucket("control", user_id).reserve(0.0) is None:
+            self.counters["control_dropped"] += 1
+            return False
+        self.counters["control"] += 1
+        return True
+
+    def count(self, counter: str) -> None:
+        self.counters[counter] += 1
+
+
+chat_rate_limiter = ChatRateLimiter()
+
+
+class ChatDedupeCache:
+    """Remembers recently stored client message ids so retransmits are acked instead of stored again.
+
+    A send claims its client id first (message id None) and only turns the claim into
+    a stored id after the commit, so a retransmit never gets acked for a message that
+    may still fail.
+    """
+
+    def __init__(self, window_seconds: float = CHAT_DEDUPE_WINDOW_SECONDS, max_entries: int = CHAT_DEDUPE_MAX_ENTRIES):
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple[str, str], tuple[str | None, float]] = OrderedDict()
+        self.duplicates = 0
 
+    def _prune(self) -> None:
+        # Entries are kept in insertion order, so expired ones are always at the front.
+        expired_before = time.monotonic() - self.window_seconds
+        while self.entries:
+            _, stored_at = next(iter(self.entries.values()))
+            if stored_at >= expired_before and len(self.entries) <= self.max_entries:
+                break
+            self.entries.popitem(last=False)
 
-class ConnectionManager:
+    def get(self, user_id: str, client_id: str) -> str | None:
+        """Returns the stored message id for a committed send, None if unknown or still pending."""
+        self._prune()
+        entry = self.entries.get((user_id, client_id))
+        if entry is None or entry[0] is None:
+            return None
+        self.duplicates += 1
+        return entry[0]
+
+    def claim(self, user_id: str, client_id: str) -> bool:
+        """Marks a send as in flight; False if another send with this id is already in flight."""
+        self._prune()
+        key = (user_id, client_id)
+        if key in self.entries:
+            return False
+        self.entries[key] = (None, time.monotonic())
+        return True
+
+    def put(self, user_id: str, client_id: str, message_id: str) -> None:
+        self.entries[(user_id, client_id)] = (message_id, time.monotonic())
+        self._prune()
+
+    def discard(self, user_id: str, client_id: str) -> None:
+        self.entries.pop((user_id, client_id), None)
+
+
+chat_dedupe_cache = ChatDedupeCache()
+
+
+class ConnectionManager:
     def __init__(self):
         self.active_connections: list[dict[str, Any]] = []
+        self.rooms: dict[str, list[dict[str, Any]]] = {}
+        self.by_socket: dict[WebSocket, dict[str, Any]] = {}
 
-    async def connect(self, websocket: WebSocket, user_id: str, username: str) -> None:
-        self.active_connections.append({
+    async def connect(
+        self,
+        websocket: WebSocket,
+        user_id: str,
+        username: str,
+        protocol: str | None = CHAT_SUBPROTOCOL_JSON,
+        room: str = DEFAULT_CHAT_ROOM,
+    ) -> None:
+        connection = {
             "websocket": websocket,
             "user_id": user_id,
-            "username": username
-        })
+            "username": username,
+            "protocol": protocol,
+            "room": room,
+            "last_seen": time.monotonic(),
+            "last_active": time.monotonic(),
+        }
+        self.active_connections.append(connection)
+        self.rooms.setdefault(room, []).append(connection)
+        self.by_socket[websocket] = connection
 
-    def disconnect(self, websocket: WebSocket) -> str | None:
-        username = None
-        for conn in self.active_connections:
-            if conn["websocket"] == websocket:
-                username = conn["username"]
-                break
-        self.active_connections = [conn for conn in self.active_connections if conn["websocket"] != websocket]
-        return username
+    def disconnect(self, websocket: WebSocket) -> dict[str, Any] | None:
+        removed = self.by_socket.pop(websocket, None)
+        if removed is None:
+            return None
 
-    async def broadcast(self, message: dict) -> None:
+        self.active_connections = [conn for conn in self.active_connections if conn["websocket"] != websocket]
+        members = [conn for conn in self.rooms.get(removed["room"], []) if conn["websocket"] != websocket]
+        if members:
+            self.rooms[removed["room"]] = members
+        else:
+            self.rooms.pop(removed["room"], None)
+        return removed
+
+    def touch(self, websocket: WebSocket, active: bool = True) -> None:
+        connection = self.by_socket.get(websocket)
+        if connection is None:
+            return
+        connection["last_seen"] = time.monotonic()
+        if active:
+            connection["last_active"] = connection["last_seen"]
+
+    def reap_stale(self, dead_before: float, idle_before: float | None = None) -> list[WebSocket]:
+        stale = [
+            conn["websocket"]
+            for conn in self.active_connections
+            if conn["last_seen"] < dead_before
+            or (idle_before is not None and conn["last_active"] < idle_before)
+        ]
+        for websocket in stale:
+            self.disconnect(websocket)
+        return stale
+
+    async def broadcast(self, message: dict, room: str | None = None) -> None:
+        targets = self.rooms.get(room, []) if room is not None else self.active_connections
+        frames: dict[str | None, str | bytes] = {}
         disconnected = []
-        for connection in self.active_connections:
+        for connection in list(targets):
+            protocol = connection["protocol"]
+            frame = frames.get(protocol)
+            if frame is None:
+                frame = frames[protocol] = encode_frame(message, protocol)
             try:
-                await connection["websocket"].send_json(message)
+                await send_frame(connection["websocket"], frame)
             except Exception:
                 disconnected.append(connection["websocket"])
 
@@ -121,6 +511,163 @@ class ConnectionManager:
 manager = ConnectionManager()
 
 
+class PresenceTracker:
+    """Reference-counts chat sockets per user and room and batches join/leave diffs."""
+
+    def __init__(self):
+        self.socket_counts: dict[str, dict[str, int]] = {}
+        self.user_sockets: dict[str, int] = {}
+        self.usernames: dict[str, str] = {}
+        self.departed: set[str] = set()
+        self.pending: dict[str, dict[str, str]] = {}
+
+    def add(self, room: str, user_id: str, username: str) -> None:
+        self.usernames[user_id] = username
+        self.user_sockets[user_id] = self.user_sockets.get(user_id, 0) + 1
+        counts = self.socket_counts.setdefault(room, {})
+        counts[user_id] = counts.get(user_id, 0) + 1
+        if counts[user_id] == 1:
+            self._mark(room, user_id, "joined")
+
+    def remove(self, room: str, user_id: str) -> None:
+        counts = self.socket_counts.get(room)
+        if not counts or user_id not in counts:
+            return
+        counts[user_id] -= 1
+        self.user_sockets[user_id] -= 1
+        if not self.user_sockets[user_id]:
+            del self.user_sockets[user_id]
+            self.departed.add(user_id)
+        if counts[user_id] > 0:
+            return
+        del counts[user_id]
+        if not counts:
+            del self.socket_counts[room]
+        self._mark(room, user_id, "left")
+
+    def _mark(self, room: str, user_id: str, transition: str) -> None:
+        # A leave followed by a join (or the reverse) inside one flush window cancels out,
+        # so reconnects and short-lived tabs never reach other clients.
+        room_pending = self.pending.setdefault(room, {})
+        if room_pending.get(user_id) not in (None, transition):
+            del room_pending[user_id]
+        else:
+            room_pending[user_id] = transition
+        if not room_pending:
+            del self.pending[room]
+
+    def online(self, room: str) -> list[dict[str, str]]:
+        return [
+            {"user_id": user_id, "username": self.usernames.get(user_id, "")}
+            for user_id in self.socket_counts.get(room, {})
+        ]
+
+    def drain(self) -> dict[str, dict[str, list[str]]]:
+        pending, self.pending = self.pending, {}
+        diffs: dict[str, dict[str, list[str]]] = {}
+        for room, transitions in pending.items():
+            diffs[room] = {
+                "joined": [self.usernames.get(uid, "") for uid, kind in transitions.items() if kind == "joined"],
+                "left": [self.usernames.get(uid, "") for uid, kind in transitions.items() if kind == "left"],
+            }
+        # Names of users without sockets were only kept for the "left" diff above.
+        departed, self.departed = self.departed, set()
+        for user_id in departed:
+            if user_id not in self.user_sockets:
+                self.usernames.pop(user_id, None)
+        return diffs
+
+
+presence = PresenceTracker()
+
+
+class UserChannelManager:
+    def __init__(self):
+        self.user_connections: dict[str, set[WebSocket]] = {}
+        self.user_waiters: dict[str, set[asyncio.Event]] = {}
+        self.last_seen: dict[WebSocket, tuple[str, float]] = {}
+        # Last queued send per socket; each send waits for the previous one to keep frames in order.
+        self.send_tails: dict[WebSocket, asyncio.Task] = {}
+
+    def connect(self, websocket: WebSocket, user_id: str) -> None:
+        self.user_connections.setdefault(user_id, set()).add(websocket)
+        self.last_seen[websocket] = (user_id, time.monotonic())
+
+    def disconnect(self, websocket: WebSocket, user_id: str) -> None:
+        self.last_seen.pop(websocket, None)
+        sockets = self.user_connections.get(user_id)
+        if not sockets:
+            return
+        sockets.discard(websocket)
+        if not sockets:
+            del self.user_connections[user_id]
+
+    def touch(self, websocket: WebSocket) -> None:
+        entry = self.last_seen.get(websocket)
+        if entry is not None:
+            self.last_seen[websocket] = (entry[0], time.monotonic())
+
+    def reap_stale(self, dead_before: float) -> list[WebSocket]:
+        stale = [(ws, user_id) for ws, (user_id, seen) in self.last_seen.items() if seen < dead_before]
+        for websocket, user_id in stale:
+            self.disconnect(websocket, user_id)
+        return [websocket for websocket, _ in stale]
+
+    async def broadcast(self, message: dict) -> None:
+        frame = encode_frame(message)
+        for websocket, (user_id, _) in list(self.last_seen.items()):
+            try:
+                await send_frame(websocket, frame)
+            except Exception:
+                self.disconnect(websocket, user_id)
+
+    def subscribe(self, user_id: str) -> asyncio.Event:
+        event = asyncio.Event()
+        self.user_waiters.setdefault(user_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, event: asyncio.Event, user_id: str) -> None:
+        waiters = self.user_waiters.get(user_id)
+        if not waiters:
+            return
+        waiters.discard(event)
+        if not waiters:
+            del self.user_waiters[user_id]
+
+    def send_to_user(self, user_id: str, message: dict) -> None:
+        """Wakes the user's long polls and queues the frame on each of their sockets.
+
+        Sends run as background tasks so a slow socket never holds up the caller.
+        """
+        for event in self.user_waiters.get(user_id, ()):
+            event.set()
+
+        sockets = self.user_connections.get(user_id)
+        if not sockets:
+            return
+
+        frame = encode_frame(message)
+        for websocket in sockets:
+            task = asyncio.create_task(self._send(websocket, user_id, frame, self.send_tails.get(websocket)))
+            self.send_tails[websocket] = task
+            task.add_done_callback(lambda done, websocket=websocket: self._forget_send(websocket, done))
+
+    async def _send(self, websocket: WebSocket, user_id: str, frame: str | bytes, previous: asyncio.Task | None) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await send_frame(websocket, frame)
+        except Exception:
+            self.disconnect(websocket, user_id)
+
+    def _forget_send(self, websocket: WebSocket, task: asyncio.Task) -> None:
+        if self.send_tails.get(websocket) is task:
+            del self.send_tails[websocket]
+
+
+dm_manager = UserChannelManager()
+
+
 class UserCreate(BaseModel):
     username: str
     email: EmailStr | None = None
@@ -374,6 +921,25 @@ class CoursePartContentResponse(CoursePartResponse):
     content: str
 
 
+class CoursePartSectionSummary(_StrictSchema):
+    position: int
+    title: str
+    level: int
+    anchor: str
+    is_continuation: bool
+    char_count: int
+
+
+class CoursePartSectionResponse(CoursePartSectionSummary):
+    content: str
+
+
+class CoursePartTocResponse(CoursePartResponse):
+    total_chars: int
+    sections: list[CoursePartSectionSummary]
+    first_section: CoursePartSectionResponse | None
+
+
 class PurchaseResponse(_StrictSchema):
     id: str
     user_id: str
@@ -419,6 +985,11 @@ class AdminPurchaseResponse(PurchaseResponse):
     part_title: str | None
 
 
+class AdminPurchasePageResponse(_StrictSchema):
+    purchases: list[AdminPurchaseResponse]
+    next_cursor: str | None
+
+
 CourseResponse.model_rebuild()
 
 
@@ -495,9 +1066,10 @@ def file_to_dict(file: FileModel) -> dict[str, Any]:
     }
 
 
-def chat_message_to_dict(message: ChatMessage) -> dict[str, Any]:
+def chat_message_to_dict(message: ChatMessage | ChatMessageArchive) -> dict[str, Any]:
     return {
         "id": message.id,
+        "room": message.room,
         "user_id": message.user_id,
         "username": message.username,
         "message": message.message,
@@ -505,6 +1077,324 @@ def chat_message_to_dict(message: ChatMessage) -> dict[str, Any]:
     }
 
 
+def _encode_cursor(timestamp: datetime, row_id: str) -> str:
+    raw = f"{timestamp.isoformat()}|{row_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8")
+        timestamp_raw, row_id = raw.split("|", 1)
+        timestamp = datetime.fromisoformat(timestamp_raw)
+    except (ValueError, UnicodeError) as exc:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from exc
+    if not row_id:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return timestamp, row_id
+
+
+async def _fetch_chat_page(
+    session: AsyncSession,
+    model: type[ChatMessage] | type[ChatMessageArchive],
+    room: str,
+    before_key: tuple[datetime, str] | None,
+    limit: int,
+) -> list[ChatMessage | ChatMessageArchive]:
+    query = (
+        select(model)
+        .where(model.room == room)
+        .order_by(model.timestamp.desc(), model.id.desc())
+    )
+    if before_key:
+        before_ts, before_id = before_key
+        query = query.where(
+            or_(
+                model.timestamp < before_ts,
+                and_(model.timestamp == before_ts, model.id < before_id),
+            )
+        )
+
+    result = await session.execute(query.limit(limit))
+    return list(result.scalars().all())
+
+
+async def fetch_chat_history(
+    session: AsyncSession,
+    room: str = DEFAULT_CHAT_ROOM,
+    before: str | None = None,
+    limit: int = CHAT_HISTORY_PAGE_SIZE,
+) -> tuple[list[dict[str, Any]], str | None]:
+    before_key = _decode_cursor(before) if before else None
+    rows = await _fetch_chat_page(session, ChatMessage, room, before_key, limit + 1)
+
+    # Archived rows are always older than the hot table, so a short page continues there.
+    if len(rows) <= limit:
+        archive_key = (rows[-1].timestamp, rows[-1].id) if rows else before_key
+        rows += await _fetch_chat_page(session, ChatMessageArchive, room, archive_key, limit + 1 - len(rows))
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = _encode_cursor(rows[-1].timestamp, rows[-1].id) if has_more else None
+    return [chat_message_to_dict(msg) for msg in reversed(rows)], next_cursor
+
+
+async def archive_old_chat_messages(
+    retention_days: int = CHAT_RETENTION_DAYS,
+    batch_size: int = CHAT_ARCHIVE_BATCH_SIZE,
+) -> int:
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    archived_total = 0
+
+    while True:
+        async with async_session_factory() as session:
+            ids_result = await session.execute(
+                select(ChatMessage.id)
+                .where(ChatMessage.timestamp < cutoff)
+                .order_by(ChatMessage.timestamp.asc(), ChatMessage.id.asc())
+                .limit(batch_size)
+            )
+            batch_ids = list(ids_result.scalars().all())
+            if not batch_ids:
+                break
+
+            archived_at = datetime.now()
+            await session.execute(
+                insert(ChatMessageArchive).from_select(
+                    ["id", "room", "user_id", "username", "message", "timestamp", "archived_at"],
+                    select(
+                        ChatMessage.id,
+                        ChatMessage.room,
+                        ChatMessage.user_id,
+                        ChatMessage.username,
+                        ChatMessage.message,
+                        ChatMessage.timestamp,
+                        literal(archived_at),
+                    ).where(ChatMessage.id.in_(batch_ids)),
+                )
+            )
+            await session.execute(delete(ChatMessage).where(ChatMessage.id.in_(batch_ids)))
+            await session.commit()
+
+        archived_total += len(batch_ids)
+        if len(batch_ids) < batch_size:
+            break
+        # Let other requests run between batches.
+        await asyncio.sleep(0)
+
+    return archived_total
+
+
+async def compact_chat_storage(archived_count: int, vacuum: bool = False) -> None:
+    """Refreshes planner statistics after archiving.
+
+    A SQLite VACUUM rewrites the whole file and blocks writers while it runs, so it
+    is only done on request (scripts/archive_chat_messages.py --vacuum), never from
+    the retention loop.
+    """
+    if archived_count <= 0 and not vacuum:
+        return
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("ANALYZE chat_messages"))
+        await conn.execute(text("ANALYZE chat_messages_archive"))
+        if vacuum and engine.dialect.name == "sqlite":
+            await conn.execute(text("VACUUM"))
+
+
+async def run_chat_retention_loop() -> None:
+    if CHAT_RETENTION_DAYS <= 0:
+        return
+
+    while True:
+        await asyncio.sleep(CHAT_RETENTION_INTERVAL_SECONDS)
+        try:
+            archived = await archive_old_chat_messages()
+            await compact_chat_storage(archived)
+            if archived:
+                print(f"Archived {archived} chat messages older than {CHAT_RETENTION_DAYS} days")
+        except SQLAlchemyError as exc:
+            print(f"Chat retention job failed: {exc}")
+
+
+def _course_id_from_room(room: str) -> str | None:
+    if room.startswith(COURSE_ROOM_PREFIX):
+        return room[len(COURSE_ROOM_PREFIX):] or None
+    return None
+
+
+def _accessible_course_ids_query(user_id: str):
+    purchased_parts_courses = (
+        select(CoursePart.course_id)
+        .join(Purchase, Purchase.part_id == CoursePart.id)
+        .where(Purchase.user_id == user_id, Purchase.status == "completed")
+    )
+    purchased_courses = select(Purchase.course_id).where(
+        Purchase.user_id == user_id,
+        Purchase.course_id.is_not(None),
+        Purchase.status == "completed",
+    )
+    return purchased_courses.union(purchased_parts_courses)
+
+
+async def can_join_chat_room(session: AsyncSession, user: User, room: str) -> bool:
+    if room in CHAT_PUBLIC_ROOMS:
+        return True
+
+    course_id = _course_id_from_room(room)
+    if not course_id:
+        return False
+
+    course = await session.get(Course, course_id)
+    if not course:
+        return False
+    if user.role == "admin":
+        return True
+    if not course.is_published:
+        return False
+
+    accessible = _accessible_course_ids_query(user.id).subquery()
+    result = await session.execute(
+        select(accessible.c.course_id).where(accessible.c.course_id == course_id).limit(1)
+    )
+    return result.first() is not None
+
+
+async def flush_presence() -> None:
+    for room, diff in presence.drain().items():
+        await manager.broadcast({
+            "type": "presence",
+            "room": room,
+            "joined": diff["joined"],
+            "left": diff["left"],
+            "online_count": len(presence.socket_counts.get(room, {})),
+        }, room)
+
+
+async def run_presence_flush_loop() -> None:
+    while True:
+        await asyncio.sleep(PRESENCE_FLUSH_INTERVAL_SECONDS)
+        try:
+            await flush_presence()
+        except Exception as exc:
+            print(f"Presence flush failed: {exc}")
+
+
+_websockets_draining = False
+
+
+async def close_websocket_quietly(websocket: WebSocket, code: int, reason: str = "") -> None:
+    with suppress(Exception):
+        await asyncio.wait_for(websocket.close(code=code, reason=reason), timeout=WS_CLOSE_TIMEOUT_SECONDS)
+
+
+async def reap_stale_websockets() -> int:
+    now = time.monotonic()
+    dead_before = now - WS_PING_INTERVAL_SECONDS - WS_PING_TIMEOUT_SECONDS
+    idle_before = now - WS_IDLE_TIMEOUT_SECONDS if WS_IDLE_TIMEOUT_SECONDS > 0 else None
+
+    stale = manager.reap_stale(dead_before, idle_before) + dm_manager.reap_stale(dead_before)
+    await asyncio.gather(*(close_websocket_quietly(ws, 1001, "Heartbeat timeout") for ws in stale))
+    return len(stale)
+
+
+async def run_websocket_heartbeat_loop() -> None:
+    if WS_PING_INTERVAL_SECONDS <= 0:
+        return
+
+    while True:
+        await asyncio.sleep(WS_PING_INTERVAL_SECONDS)
+        try:
+            await reap_stale_websockets()
+            await manager.broadcast({"type": "ping"})
+            await dm_manager.broadcast({"type": "ping"})
+        except Exception as exc:
+            print(f"WebSocket heartbeat failed: {exc}")
+
+
+async def drain_websockets() -> None:
+    global _websockets_draining
+    _websockets_draining = True
+
+    with suppress(Exception):
+        await flush_presence()
+
+    targets: list[tuple[WebSocket, str | None]] = [
+        (conn["websocket"], conn["protocol"]) for conn in manager.active_connections
+    ]
+    targets += [(websocket, CHAT_SUBPROTOCOL_JSON) for websocket in dm_manager.last_seen]
+
+    async def drain_one(websocket: WebSocket, protocol: str | None) -> None:
+        # Spread reconnects so a rolling deploy does not bring every client back at once.
+        hint = {"type": "reconnect", "retry_after_ms": random.randint(0, WS_DRAIN_RECONNECT_SPREAD_MS)}
+        with suppress(Exception):
+            await asyncio.wait_for(send_frame(websocket, encode_frame(hint, protocol)), WS_CLOSE_TIMEOUT_SECONDS)
+        await close_websocket_quietly(websocket, 1012, "Server restarting")
+
+    await asyncio.gather(*(drain_one(websocket, protocol) for websocket, protocol in targets))
+
+
+def install_websocket_drain_on_signals() -> Callable[[], None]:
+    """Drains websockets on SIGTERM/SIGINT before the server's own handler runs.
+
+    Uvicorn closes every connection with 1012 before it starts the lifespan
+    shutdown, so a drain started from there has nobody left to send the
+    reconnect hint to. The previously installed handler (uvicorn's) is invoked
+    once the drain finishes or WS_DRAIN_GRACE_SECONDS elapses. Returns a
+    callable that puts the previous handlers back.
+    """
+    # Signal handlers can only be installed from the main thread; embedded
+    # servers and the test client fall back to the drain in lifespan shutdown.
+    if threading.current_thread() is not threading.main_thread():
+        return lambda: None
+
+    loop = asyncio.get_running_loop()
+    previous = {sig: signal.getsignal(sig) for sig in (signal.SIGINT, signal.SIGTERM)}
+    drain_tasks: list[asyncio.Task] = []
+    signalled = False
+
+    def forward(sig: int, frame: Any) -> None:
+        handler = previous[sig]
+        if callable(handler):
+            handler(sig, frame)
+        else:
+            signal.signal(sig, handler)
+            signal.raise_signal(sig)
+
+    async def drain_then_forward(sig: int, frame: Any) -> None:
+        try:
+            await asyncio.wait_for(drain_websockets(), WS_DRAIN_GRACE_SECONDS)
+        except asyncio.TimeoutError:
+            print(f"WebSocket drain exceeded {WS_DRAIN_GRACE_SECONDS}s, shutting down anyway")
+        finally:
+            forward(sig, frame)
+
+    def start_drain(sig: int, frame: Any) -> None:
+        drain_tasks.append(loop.create_task(drain_then_forward(sig, frame)))
+
+    def handle(sig: int, frame: Any) -> None:
+        nonlocal signalled
+        # A second signal skips the grace period, e.g. a repeated Ctrl+C.
+        if signalled:
+            forward(sig, frame)
+            return
+        signalled = True
+        loop.call_soon_threadsafe(start_drain, sig, frame)
+
+    for sig in previous:
+        signal.signal(sig, handle)
+
+    def restore() -> None:
+        for sig, handler in previous.items():
+            if signal.getsignal(sig) is handle:
+                signal.signal(sig, handler)
+
+    return restore
+
+
 async def ensure_db_connection(session: AsyncSession) -> None:
     try:
         await session.execute(text("SELECT 1"))
@@ -542,18 +1432,302 @@ def profile_to_dict(user: User, profile: UserProfile | None) -> dict[str, Any]:
     }
 
 
-def direct_message_to_dict(
-    message: DirectMessage,
-    sender_user: User,
-    sender_profile: UserProfile | None = None,
-) -> dict[str, Any]:
+def user_card_from_rows(user: User, profile: UserProfile | None) -> dict[str, Any]:
+    return {
+        "id": user.id,
+        "username": user.username,
+        "display_name": _normalize_display_name(profile.display_name if profile else None, user.username),
+        "avatar_url": profile.avatar_url if profile else None,
+        "privacy_dm": _normalize_privacy_dm(profile.privacy_dm if profile else DEFAULT_DM_PRIVACY),
+        "role": user.role,
+    }
+
+
+class UserCardCache:
+    """Bounded LRU of public user cards shared by the messaging endpoints.
+
+    Entries also expire after a TTL so other worker processes, which cannot see
+    this process's invalidations, converge on profile changes.
+    """
+
+    def __init__(self, max_entries: int = USER_CARD_CACHE_SIZE, ttl_seconds: float = USER_CARD_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[str, tuple[dict[str, Any], float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get_many(self, session: AsyncSession, user_ids) -> dict[str, dict[str, Any]]:
+        cards: dict[str, dict[str, Any]] = {}
+        missing: list[str] = []
+        expired_before = time.monotonic() - self.ttl_seconds
+        for user_id in set(user_ids):
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[1] >= expired_before:
+                self.entries.move_to_end(user_id)
+                cards[user_id] = entry[0]
+            else:
+                missing.append(user_id)
+
+        self.hits += len(cards)
+        self.misses += len(missing)
+        if missing:
+            result = await session.execute(
+                select(User, UserProfile)
+                .outerjoin(UserProfile, UserProfile.user_id == User.id)
+                .where(User.id.in_(missing))
+            )
+            now = time.monotonic()
+            for user, profile in result.all():
+                card = cards[user.id] = user_card_from_rows(user, profile)
+                self.entries[user.id] = (card, now)
+                self.entries.move_to_end(user.id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        return cards
+
+    async def get(self, session: AsyncSession, user_id: str) -> dict[str, Any] | None:
+        return (await self.get_many(session, [user_id])).get(user_id)
+
+    def invalidate(self, user_id: str) -> None:
+        self.entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+user_cards = UserCardCache()
+
+
+class _TypeaheadNode:
+    """Radix trie node; chains of single-child nodes are collapsed into ``label``."""
+
+    __slots__ = ("label", "children", "user_ids")
+
+    def __init__(self, label: str = "") -> None:
+        self.label = label
+        self.children: dict[str, "_TypeaheadNode"] | None = None
+        # Most terms belong to one user, so a lone id is stored without a set.
+        self.user_ids: str | set[str] | None = None
+
+    def add(self, user_id: str) -> None:
+        if self.user_ids is None:
+            self.user_ids = user_id
+        elif isinstance(self.user_ids, set):
+            self.user_ids.add(user_id)
+        elif self.user_ids != user_id:
+            self.user_ids = {self.user_ids, user_id}
+
+    def discard(self, user_id: str) -> None:
+        if self.user_ids == user_id:
+            self.user_ids = None
+        elif isinstance(self.user_ids, set):
+            self.user_ids.discard(user_id)
+            if len(self.user_ids) == 1:
+                self.user_ids = next(iter(self.user_ids))
+
+    def ids(self) -> list[str]:
+        if self.user_ids is None:
+            return []
+        if isinstance(self.user_ids, str):
+            return [self.user_ids]
+        return sorted(self.user_ids)
+
+
+def _typeahead_terms(username: str, display_name: str) -> set[str]:
+    display_lower = display_name.lower()
+    return {term for term in (username.lower(), display_lower, *display_lower.split()) if term}
+
+
+class UserTypeaheadIndex:
+    """In-process radix trie over usernames and display names for the DM picker.
+
+    Built once at startup and kept current by register and update_my_profile.
+    Other worker processes only see those edits after their next restart, so the
+    picker falls back to /api/users/search when the trie has nothing.
+    """
+
+    def __init__(self) -> None:
+        self.root = _TypeaheadNode()
+        # user_id -> (username, display_name, avatar_url, privacy_dm)
+        self.users: dict[str, tuple[str, str, str | None, str]] = {}
+        self.ready = False
+        self.build_seconds = 0.0
+
+    def _insert_term(self, term: str, user_id: str) -> None:
+        node = self.root
+        index = 0
+        while index < len(term):
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(term[index])
+            if child is None:
+                child = node.children[term[index]] = _TypeaheadNode(term[index:])
+                child.add(user_id)
+                return
+
+            label = child.label
+            common = 0
+            limit = min(len(label), len(term) - index)
+            while common < limit and label[common] == term[index + common]:
+                common += 1
+            if common < len(label):
+                middle = _TypeaheadNode(label[:common])
+                child.label = label[common:]
+                middle.children = {child.label[0]: child}
+                node.children[term[index]] = middle
+                child = middle
+            node = child
+            index += common
+        node.add(user_id)
+
+    def _remove_term(self, term: str, user_id: str) -> None:
+        path: list[tuple[_TypeaheadNode, _TypeaheadNode]] = []
+        node = self.root
+        index = 0
+        while index < len(term):
+            child = node.children.get(term[index]) if node.children else None
+            if child is None or not term.startswith(child.label, index):
+                return
+            path.append((node, child))
+            node = child
+            index += len(child.label)
+        node.discard(user_id)
+
+        # Drop emptied leaves and re-collapse nodes left with a single child.
+        for parent, current in reversed(path):
+            if current.user_ids is not None:
+                break
+            if not current.children:
+                del parent.children[current.label[0]]
+                if not parent.children:
+                    parent.children = None
+                continue
+            if len(current.children) == 1:
+                (only_child,) = current.children.values()
+                only_child.label = current.label + only_child.label
+                parent.children[only_child.label[0]] = only_child
+            break
+
+    def upsert(self, user_id: str, username: str, display_name: str | None, avatar_url: str | None, privacy_dm: str) -> None:
+        self.remove(user_id)
+        display_name = _normalize_display_name(display_name, username)
+        self.users[user_id] = (username, display_name, avatar_url, privacy_dm)
+        for term in _typeahead_terms(username, display_name):
+            self._insert_term(term, user_id)
+
+    def remove(self, user_id: str) -> None:
+        entry = self.users.pop(user_id, None)
+        if entry is not None:
+            for term in _typeahead_terms(entry[0], entry[1]):
+                self._remove_term(term, user_id)
+
+    async def rebuild(self) -> None:
+        started = time.perf_counter()
+        fresh = UserTypeaheadIndex()
+        async with async_session_factory() as session:
+            result = await session.stream(
+                select(User.id, User.username, UserProfile.display_name, UserProfile.avatar_url, UserProfile.privacy_dm)
+                .outerjoin(UserProfile, UserProfile.user_id == User.id)
+                .execution_options(yield_per=USER_TYPEAHEAD_BUILD_BATCH)
+            )
+            async for user_id, username, display_name, avatar_url, privacy_dm in result:
+                fresh.upsert(user_id, username, display_name, avatar_url, _normalize_privacy_dm(privacy_dm))
+        self.root, self.users = fresh.root, fresh.users
+        self.build_seconds = time.perf_counter() - started
+        self.ready = True
+
+    def search(
+        self,
+        query: str,
+        limit: int,
+        exclude_user_id: str | None = None,
+        dm_only: bool = False,
+    ) -> list[dict[str, Any]]:
+        query = query.lower()
+        node = self.root
+        term = ""
+        index = 0
+        while index < len(query):
+            child = node.children.get(query[index]) if node.children else None
+            if child is None:
+                return []
+            if query.startswith(child.label, index):
+                index += len(child.label)
+            elif child.label.startswith(query[index:]):
+                index = len(query)
+            else:
+                return []
+            node = child
+            term += child.label
+
+        # Best-first walk ranked by term length, then alphabetically, so an exact match
+        # comes first. A child's term is always longer than its parent's, so the heap
+        # yields terms in that order.
+        found: list[dict[str, Any]] = []
+        seen: set[str] = set()
+        heap = [(len(term), term, node)]
+        while heap and len(found) < limit:
+            _, term, current = heapq.heappop(heap)
+            for user_id in current.ids():
+                if user_id in seen or user_id == exclude_user_id:
+                    continue
+                seen.add(user_id)
+                username, display_name, avatar_url, privacy_dm = self.users[user_id]
+                if dm_only and privacy_dm == "none":
+                    continue
+                found.append(_user_search_item(user_id, username, display_name, avatar_url, privacy_dm))
+                if len(found) >= limit:
+                    break
+            for child in (current.children or {}).values():
+                child_term = term + child.label
+                heapq.heappush(heap, (len(child_term), child_term, child))
+        return found
+
+    def memory_report(self) -> dict[str, Any]:
+        nodes = terms = trie_bytes = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            nodes += 1
+            trie_bytes += sys.getsizeof(node) + sys.getsizeof(node.label)
+            if node.user_ids is not None:
+                terms += 1
+                if isinstance(node.user_ids, set):
+                    trie_bytes += sys.getsizeof(node.user_ids)
+            if node.children:
+                trie_bytes += sys.getsizeof(node.children)
+                stack.extend(node.children.values())
+
+        entry_bytes = sys.getsizeof(self.users)
+        for user_id, entry in self.users.items():
+            entry_bytes += sys.getsizeof(user_id) + sys.getsizeof(entry)
+            entry_bytes += sum(sys.getsizeof(field) for field in entry if field is not None)
+
+        return {
+            "ready": self.ready,
+            "users": len(self.users),
+            "terms": terms,
+            "nodes": nodes,
+            "trie_bytes": trie_bytes,
+            "entry_bytes": entry_bytes,
+            "total_bytes": trie_bytes + entry_bytes,
+            "build_seconds": round(self.build_seconds, 3),
+        }
+
+
+user_typeahead = UserTypeaheadIndex()
+
+
+def direct_message_to_dict(message: DirectMessage, sender_card: dict[str, Any]) -> dict[str, Any]:
     return {
         "id": message.id,
         "conversation_id": message.conversation_id,
         "sender_id": message.sender_id,
         "user_id": message.sender_id,
-        "username": sender_user.username,
-        "display_name": _normalize_display_name(sender_profile.display_name if sender_profile else None, sender_user.username),
+        "username": sender_card["username"],
+        "display_name": sender_card["display_name"],
         "text": message.text,
         "message": message.text,
         "created_at": _to_iso(message.created_at),
@@ -561,6 +1735,71 @@ def direct_message_to_dict(
     }
 
 
+async def serialize_direct_messages(
+    session: AsyncSession,
+    direct_messages: list[DirectMessage],
+) -> list[dict[str, Any]]:
+    sender_ids = {msg.sender_id for msg in direct_messages}
+    if not sender_ids:
+        return []
+
+    cards = await user_cards.get_many(session, sender_ids)
+
+    payload: list[dict[str, Any]] = []
+    for message in direct_messages:
+        sender_card = cards.get(message.sender_id)
+        if not sender_card:
+            continue
+        payload.append(direct_message_to_dict(message, sender_card))
+    return payload
+
+
+async def fetch_direct_messages_since(
+    session: AsyncSession,
+    user_id: str,
+    since: str | None,
+    limit: int = DM_SYNC_LIMIT,
+) -> dict[str, Any]:
+    participant_filter = or_(Conversation.user_a == user_id, Conversation.user_b == user_id)
+    base_query = (
+        select(DirectMessage)
+        .join(Conversation, Conversation.id == DirectMessage.conversation_id)
+        .where(participant_filter)
+    )
+
+    if not since:
+        latest_result = await session.execute(
+            base_query.order_by(DirectMessage.created_at.desc(), DirectMessage.id.desc()).limit(1)
+        )
+        latest = latest_result.scalar_one_or_none()
+        return {
+            "messages": [],
+            "cursor": _encode_cursor(latest.created_at, latest.id) if latest else None,
+            "has_more": False,
+        }
+
+    since_ts, since_id = _decode_cursor(since)
+    result = await session.execute(
+        base_query.where(
+            or_(
+                DirectMessage.created_at > since_ts,
+                and_(DirectMessage.created_at == since_ts, DirectMessage.id > since_id),
+            )
+        )
+        .order_by(DirectMessage.created_at.asc(), DirectMessage.id.asc())
+        .limit(limit + 1)
+    )
+    rows = list(result.scalars().all())
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    return {
+        "messages": await serialize_direct_messages(session, rows),
+        "cursor": _encode_cursor(rows[-1].created_at, rows[-1].id) if rows else since,
+        "has_more": has_more,
+    }
+
+
 def get_partner_id(conversation: Conversation, current_user_id: str) -> str:
     return conversation.user_b if conversation.user_a == current_user_id else conversation.user_a
 
@@ -617,16 +1856,9 @@ async def get_conversation_for_user_or_404(
     return conversation
 
 
-async def ensure_user_accepts_dm(
-    session: AsyncSession,
-    target_user: User,
-) -> UserProfile | None:
-    target_profile_result = await session.execute(select(UserProfile).where(UserProfile.user_id == target_user.id))
-    target_profile = target_profile_result.scalar_one_or_none()
-    privacy_dm = _normalize_privacy_dm(target_profile.privacy_dm if target_profile else DEFAULT_DM_PRIVACY)
-    if privacy_dm == "none":
+def ensure_user_accepts_dm(target_card: dict[str, Any]) -> None:
+    if target_card["privacy_dm"] == "none":
         raise HTTPException(status_code=403, detail="User does not accept direct messages")
-    return target_profile
 
 
 async def build_conversation_summary(
@@ -634,40 +1866,138 @@ async def build_conversation_summary(
     conversation: Conversation,
     current_user_id: str,
 ) -> dict[str, Any]:
-    partner_id = get_partner_id(conversation, current_user_id)
-    partner_user = await session.get(User, partner_id)
-    if not partner_user:
+    partner_card = await user_cards.get(session, get_partner_id(conversation, current_user_id))
+    if not partner_card:
         raise HTTPException(status_code=404, detail="Conversation participant not found")
 
-    partner_profile_result = await session.execute(select(UserProfile).where(UserProfile.user_id == partner_id))
-    partner_profile = partner_profile_result.scalar_one_or_none()
+    return _conversation_summary_to_dict(conversation, partner_card)
 
-    last_message_result = await session.execute(
-        select(DirectMessage)
-        .where(DirectMessage.conversation_id == conversation.id)
-        .order_by(DirectMessage.created_at.desc())
-        .limit(1)
+
+def _participant_side(conversation: Conversation, user_id: str) -> str:
+    return "user_a" if conversation.user_a == user_id else "user_b"
+
+
+def _unread_total_query(user_id: str):
+    unread = case(
+        (Conversation.user_a == user_id, Conversation.user_a_unread),
+        else_=Conversation.user_b_unread,
     )
-    last_message = last_message_result.scalar_one_or_none()
+    return select(func.coalesce(func.sum(unread), 0)).where(
+        or_(Conversation.user_a == user_id, Conversation.user_b == user_id)
+    )
+
 
-    partner_display_name = _normalize_display_name(partner_profile.display_name if partner_profile else None, partner_user.username)
+def _conversation_summary_to_dict(conversation: Conversation, partner_card: dict[str, Any]) -> dict[str, Any]:
+    activity_at = conversation.last_activity_at or conversation.created_at
+    own_side = "user_b" if conversation.user_a == partner_card["id"] else "user_a"
     return {
         "id": conversation.id,
         "user_a": conversation.user_a,
         "user_b": conversation.user_b,
         "created_at": _to_iso(conversation.created_at),
         "partner": {
-            "id": partner_user.id,
-            "username": partner_user.username,
-            "display_name": partner_display_name,
-            "avatar_url": partner_profile.avatar_url if partner_profile else None,
+            "id": partner_card["id"],
+            "username": partner_card["username"],
+            "display_name": partner_card["display_name"],
+            "avatar_url": partner_card["avatar_url"],
         },
-        "last_message": last_message.text if last_message else "",
-        "last_message_at": _to_iso(last_message.created_at if last_message else conversation.created_at),
-        "updated_at": _to_iso(last_message.created_at if last_message else conversation.created_at),
+        "last_message": conversation.last_message_preview or "",
+        "last_message_id": conversation.last_message_id,
+        "last_message_at": _to_iso(activity_at),
+        "message_count": conversation.message_count or 0,
+        "unread_count": getattr(conversation, f"{own_side}_unread") or 0,
+        "last_read_at": _to_iso(getattr(conversation, f"{own_side}_last_read_at")),
+        "updated_at": _to_iso(activity_at),
+        "cursor": _encode_cursor(activity_at, conversation.id),
     }
 
 
+async def fetch_conversation_summaries(
+    session: AsyncSession,
+    user_id: str,
+    before: str | None = None,
+    limit: int | None = None,
+) -> list[dict[str, Any]]:
+    """Lists a user's conversations, newest activity first, from the conversations table alone.
+
+    Partner cards come from the shared user card cache, so a warm inbox is one query.
+    """
+    activity_at = Conversation.last_activity_at
+
+    query = (
+        select(Conversation)
+        .where(or_(Conversation.user_a == user_id, Conversation.user_b == user_id))
+        .order_by(activity_at.desc(), Conversation.id.desc())
+    )
+    if before:
+        before_at, before_id = _decode_cursor(before)
+        query = query.where(
+            or_(
+                activity_at < before_at,
+                and_(activity_at == before_at, Conversation.id < before_id),
+            )
+        )
+    if limit is not None:
+        query = query.limit(limit)
+
+    result = await session.execute(query)
+    conversations = list(result.scalars().all())
+    cards = await user_cards.get_many(session, [get_partner_id(item, user_id) for item in conversations])
+    return [
+        _conversation_summary_to_dict(conversation, cards[get_partner_id(conversation, user_id)])
+        for conversation in conversations
+        if get_partner_id(conversation, user_id) in cards
+    ]
+
+
+def _unread_since_marker(reader_column, last_read_column):
+    return (
+        select(func.count())
+        .select_from(DirectMessage)
+        .where(
+            DirectMessage.conversation_id == Conversation.id,
+            DirectMessage.sender_id != reader_column,
+            or_(last_read_column.is_(None), DirectMessage.created_at > last_read_column),
+        )
+        .scalar_subquery()
+    )
+
+
+async def repair_conversation_stats(only_missing: bool = False) -> int:
+    """Recomputes the denormalized last-message columns of conversations from direct_messages."""
+    latest_message = (
+        select(DirectMessage)
+        .where(DirectMessage.conversation_id == Conversation.id)
+        .order_by(DirectMessage.created_at.desc(), DirectMessage.id.desc())
+        .limit(1)
+    )
+    last_message_at = latest_message.with_only_columns(DirectMessage.created_at).scalar_subquery()
+
+    statement = update(Conversation).values(
+        last_message_id=latest_message.with_only_columns(DirectMessage.id).scalar_subquery(),
+        last_message_preview=latest_message.with_only_columns(
+            func.substr(DirectMessage.text, 1, CONVERSATION_PREVIEW_LENGTH)
+        ).scalar_subquery(),
+        last_message_at=last_message_at,
+        last_activity_at=func.coalesce(last_message_at, Conversation.created_at),
+        message_count=(
+            select(func.count())
+            .select_from(DirectMessage)
+            .where(DirectMessage.conversation_id == Conversation.id)
+            .scalar_subquery()
+        ),
+        user_a_unread=_unread_since_marker(Conversation.user_a, Conversation.user_a_last_read_at),
+        user_b_unread=_unread_since_marker(Conversation.user_b, Conversation.user_b_last_read_at),
+    )
+    if only_missing:
+        statement = statement.where(Conversation.last_activity_at.is_(None))
+
+    async with async_session_factory() as session:
+        result = await session.execute(statement.execution_options(synchronize_session=False))
+        await session.commit()
+        return result.rowcount or 0
+
+
 async def get_current_user_model(
     token: str = Depends(oauth2_scheme),
     session: AsyncSession = Depends(get_session),
@@ -748,6 +2078,116 @@ def _course_part_to_response(
     return payload
 
 
+def _json_bytes(payload: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _etag_for(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def _cached_json_response(request: Request, body: bytes, etag: str | None = None) -> Response:
+    if etag is None:
+        return Response(content=body, media_type="application/json")
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+class CourseSnapshot:
+    """A course and its parts serialized once; only has_access varies per reader."""
+
+    __slots__ = ("course", "parts", "is_published", "anonymous_body", "anonymous_etag", "stored_at")
+
+    def __init__(self, course: Course, parts: list[CoursePart]) -> None:
+        self.course = _course_to_response(course)
+        self.parts = [_course_part_to_response(part, has_access=False) for part in parts]
+        self.is_published = bool(course.is_published)
+        self.anonymous_body = self.render(lambda part: part["is_preview"])
+        self.anonymous_etag = _etag_for(self.anonymous_body)
+        self.stored_at = time.monotonic()
+
+    def render(self, has_access) -> bytes:
+        parts = [{**part, "has_access": bool(has_access(part))} for part in self.parts]
+        return _json_bytes({**self.course, "parts": parts})
+
+
+class CourseCatalogCache:
+    """Public catalog as pre-encoded JSON plus per-course detail snapshots.
+
+    Course and part writes in this process drop the affected entries; the TTL
+    covers writes made by other worker processes.
+    """
+
+    def __init__(self, max_details: int = COURSE_DETAIL_CACHE_SIZE, ttl_seconds: float = COURSE_CATALOG_TTL_SECONDS):
+        self.max_details = max_details
+        self.ttl_seconds = ttl_seconds
+        self.catalog: tuple[bytes, str, float] | None = None
+        self.details: OrderedDict[str, CourseSnapshot] = OrderedDict()
+        # Bumped on every invalidation so a rebuild that raced with a write is not stored.
+        self.generation = 0
+
+    async def get_catalog(self, session: AsyncSession) -> tuple[bytes, str]:
+        if self.catalog is not None and self.catalog[2] >= time.monotonic() - self.ttl_seconds:
+            return self.catalog[0], self.catalog[1]
+
+        generation = self.generation
+        result = await session.execute(
+            select(Course)
+            .where(Course.is_published.is_(True))
+            .order_by(Course.created_at.desc())
+        )
+        body = _json_bytes([_course_to_response(course) for course in result.scalars().all()])
+        etag = _etag_for(body)
+        if generation == self.generation:
+            self.catalog = (body, etag, time.monotonic())
+        return body, etag
+
+    async def get_course(self, session: AsyncSession, course_id: str) -> CourseSnapshot | None:
+        snapshot = self.details.get(course_id)
+        if snapshot is not None and snapshot.stored_at >= time.monotonic() - self.ttl_seconds:
+            self.details.move_to_end(course_id)
+            return snapshot
+
+        generation = self.generation
+        course = await session.get(Course, course_id)
+        if not course:
+            return None
+        parts_result = await session.execute(
+            select(CoursePart)
+            .options(defer(CoursePart.content))
+            .where(CoursePart.course_id == course.id)
+            .order_by(CoursePart.order.asc(), CoursePart.created_at.asc())
+        )
+        snapshot = CourseSnapshot(course, list(parts_result.scalars().all()))
+        if generation == self.generation:
+            self.details[course_id] = snapshot
+            self.details.move_to_end(course_id)
+            while len(self.details) > self.max_details:
+                self.details.popitem(last=False)
+        return snapshot
+
+    def invalidate_course(self, course_id: str) -> None:
+        self.generation += 1
+        self.catalog = None
+        self.details.pop(course_id, None)
+
+    def invalidate_parts(self, course_id: str) -> None:
+        self.generation += 1
+        self.details.pop(course_id, None)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self.catalog = None
+        self.details.clear()
+
+
+course_catalog = CourseCatalogCache()
+
+
 def _purchase_to_response(purchase: Purchase) -> dict[str, Any]:
     return {
         "id": purchase.id,
@@ -800,34 +2240,345 @@ async def _get_optional_user_from_request(request: Request, session: AsyncSessio
         return None
 
 
-async def _has_access_to_part(
-    session: AsyncSession,
-    user_id: str,
-    part: CoursePart,
-    is_admin_user: bool = False,
-) -> bool:
-    if is_admin_user or part.is_preview:
-        return True
+class UserEntitlements:
+    """Completed purchases that unlock course parts: whole courses and single parts."""
+
+    __slots__ = ("course_ids", "part_ids")
 
+    def __init__(self, course_ids: frozenset[str] = frozenset(), part_ids: frozenset[str] = frozenset()) -> None:
+        self.course_ids = course_ids
+        self.part_ids = part_ids
+
+    def allows(self, part: CoursePart) -> bool:
+        return self.allows_ids(part.course_id, part.id, part.is_preview)
+
+    def allows_ids(self, course_id: str, part_id: str, is_preview: bool) -> bool:
+        return bool(is_preview) or course_id in self.course_ids or part_id in self.part_ids
+
+
+async def load_user_entitlements(session: AsyncSession, user_id: str) -> UserEntitlements:
     result = await session.execute(
-        select(Purchase).where(
+        select(Purchase.course_id, Purchase.part_id).where(
             Purchase.user_id == user_id,
-            Purchase.course_id == part.course_id,
-            Purchase.part_id.is_(None),
             Purchase.status == "completed",
         )
     )
-    if result.scalar_one_or_none():
+    course_ids: set[str] = set()
+    part_ids: set[str] = set()
+    for purchased_course_id, purchased_part_id in result.all():
+        if purchased_part_id is not None:
+            part_ids.add(purchased_part_id)
+        elif purchased_course_id is not None:
+            course_ids.add(purchased_course_id)
+    return UserEntitlements(frozenset(course_ids), frozenset(part_ids))
+
+
+class EntitlementCache:
+    """Bounded LRU of per-user entitlements so course readers flip parts without a query.
+
+    Purchase writes in this process invalidate their user's entry; the TTL covers
+    writes made by other worker processes.
+    """
+
+    def __init__(self, max_entries: int = ENTITLEMENT_CACHE_SIZE, ttl_seconds: float = ENTITLEMENT_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[str, tuple[UserEntitlements, float]] = OrderedDict()
+        # Bumped on every invalidation so a load that raced with a purchase write
+        # is returned to its caller but not cached.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, session: AsyncSession, user_id: str) -> UserEntitlements:
+        entry = self.entries.get(user_id)
+        if entry is not None and entry[1] >= time.monotonic() - self.ttl_seconds:
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        generation = self.generation
+        entitlements = await load_user_entitlements(session, user_id)
+        if generation == self.generation:
+            self.entries[user_id] = (entitlements, time.monotonic())
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entitlements
+
+    def invalidate(self, user_id: str) -> None:
+        self.generation += 1
+        self.entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self.entries.clear()
+
+
+entitlement_cache = EntitlementCache()
+
+
+class IdempotencyCache:
+    """Bounded LRU of purchase responses keyed by (user, Idempotency-Key).
+
+    A retry with the same key gets the first response back instead of a
+    "purchase already exists" error, and concurrent requests sharing a key are
+    serialized so only the first one runs. Entries live in this process; the
+    partial unique indexes on purchases still hold across workers.
+    """
+
+    def __init__(self, max_entries: int = IDEMPOTENCY_CACHE_SIZE, ttl_seconds: float = IDEMPOTENCY_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[tuple[str, str], tuple[str, dict[str, Any], float]] = OrderedDict()
+        self.locks: dict[tuple[str, str], tuple[asyncio.Lock, int]] = {}
+        self.replays = 0
+
+    async def run(
+        self,
+        user_id: str,
+        key: str | None,
+        fingerprint: str,
+        operation: Callable[[], Awaitable[dict[str, Any]]],
+    ) -> dict[str, Any]:
+        if key is None:
+            return await operation()
+        if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise HTTPException(status_code=400, detail="Некорректный Idempotency-Key")
+
+        cache_key = (user_id, key)
+        lock, waiters = self.locks.get(cache_key, (None, 0))
+        lock = lock or asyncio.Lock()
+        self.locks[cache_key] = (lock, waiters + 1)
+        try:
+            async with lock:
+                entry = self.entries.get(cache_key)
+                if entry is not None and entry[2] >= time.monotonic() - self.ttl_seconds:
+                    if entry[0] != fingerprint:
+                        raise HTTPException(
+                            status_code=422,
+                            detail="Idempotency-Key уже использован для другого запроса",
+                        )
+                    self.entries.move_to_end(cache_key)
+                    self.replays += 1
+                    return entry[1]
+
+                # Errors are not stored, so a retry after a failure runs again.
+                response = await operation()
+                self.entries[cache_key] = (fingerprint, response, time.monotonic())
+                self.entries.move_to_end(cache_key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                return response
+        finally:
+            lock, waiters = self.locks[cache_key]
+            if waiters == 1:
+                del self.locks[cache_key]
+            else:
+                self.locks[cache_key] = (lock, waiters - 1)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+purchase_idempotency = IdempotencyCache()
+
+
+async def _lock_buyer_for_purchase(session: AsyncSession, user_id: str) -> None:
+    if engine.dialect.name != "sqlite":
+        await session.execute(select(User.id).where(User.id == user_id).with_for_update())
+        return
+    # SQLite has a single writer: BEGIN IMMEDIATE takes the write lock before the
+    # duplicate check. A transaction that already wrote holds it.
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    if not raw_connection.driver_connection.in_transaction:
+        await connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+async def _insert_active_purchase(session: AsyncSession, purchase: Purchase) -> bool:
+    """Inserts a purchase unless the user already holds an active one for its target.
+
+    A single INSERT ... ON CONFLICT DO NOTHING against the partial unique index
+    replaces select-then-insert, so two concurrent submits cannot both pass.
+    """
+    if purchase.part_id is None:
+        index_name, target_column, active_where = (
+            "ux_purchases_active_course", Purchase.course_id, ACTIVE_COURSE_PURCHASE_WHERE
+        )
+    else:
+        index_name, target_column, active_where = (
+            "ux_purchases_active_part", Purchase.part_id, ACTIVE_PART_PURCHASE_WHERE
+        )
+    values = {column.key: getattr(purchase, column.key) for column in Purchase.__table__.columns}
+
+    if not is_unique_index_built(index_name):
+        # Duplicates kept the index from being built, so there is no conflict target;
+        # the buyer's purchases are serialized until commit instead.
+        await _lock_buyer_for_purchase(session, purchase.user_id)
+        existing = await session.execute(
+            select(Purchase.id)
+            .where(
+                Purchase.user_id == purchase.user_id,
+                target_column == getattr(purchase, target_column.key),
+                active_where,
+            )
+            .limit(1)
+        )
+        if existing.first() is not None:
+            await session.rollback()
+            return False
+        await session.execute(insert(Purchase).values(**values))
+        return True
+
+    dialect_insert = {"sqlite": sqlite_insert, "postgresql": postgresql_insert}.get(engine.dialect.name)
+    if dialect_insert is None:
+        try:
+            async with session.begin_nested():
+                await session.execute(insert(Purchase).values(**values))
+        except IntegrityError:
+            return False
         return True
 
     result = await session.execute(
-        select(Purchase).where(
-            Purchase.user_id == user_id,
-            Purchase.part_id == part.id,
-            Purchase.status == "completed",
+        dialect_insert(Purchase)
+        .values(**values)
+        .on_conflict_do_nothing(
+            index_elements=[Purchase.user_id, target_column],
+            index_where=active_where,
         )
     )
-    return result.scalar_one_or_none() is not None
+    return result.rowcount == 1
+
+
+_MARKDOWN_HEADING = re.compile(r"^(#{1,6})[ \t]+(.+?)[ \t]*#*[ \t]*$")
+_MARKDOWN_FENCE = re.compile(r"^[ \t]{0,3}(`{3,}|~{3,})")
+
+
+def _section_anchor(title: str, used: set[str]) -> str:
+    base = re.sub(r"[\s_]+", "-", re.sub(r"[^\w\s-]", "", title.lower())).strip("-") or "section"
+    anchor = base
+    suffix = 2
+    while anchor in used:
+        anchor = f"{base}-{suffix}"
+        suffix += 1
+    used.add(anchor)
+    return anchor
+
+
+def split_markdown_sections(content: str) -> list[dict[str, Any]]:
+    """Cuts Markdown into sections at headings up to COURSE_SECTION_HEADING_LEVEL.
+
+    Sections longer than COURSE_SECTION_TARGET_CHARS continue in a new section at
+    the next blank line. Fenced code blocks are never split, and joining the
+    sections' content gives back the original text.
+    """
+    sections: list[dict[str, Any]] = []
+    used_anchors: set[str] = set()
+
+    def start(title: str, level: int, is_continuation: bool = False) -> dict[str, Any]:
+        if is_continuation:
+            heading_anchor = next(section["anchor"] for section in reversed(sections) if not section["is_continuation"])
+            anchor = _section_anchor(f"{heading_anchor}-cont", used_anchors)
+        else:
+            anchor = _section_anchor(title or "intro", used_anchors)
+        section = {"title": title, "level": level, "anchor": anchor, "is_continuation": is_continuation, "lines": [], "chars": 0}
+        sections.append(section)
+        return section
+
+    current = start("", 0)
+    fence: str | None = None
+    for line in content.splitlines(keepends=True):
+        stripped = line.rstrip("\r\n")
+        fence_match = _MARKDOWN_FENCE.match(stripped)
+        if fence_match:
+            marker = fence_match.group(1)
+            if fence is None:
+                fence = marker
+            elif marker[0] == fence[0] and len(marker) >= len(fence) and not stripped.strip()[len(marker):].strip():
+                fence = None
+        elif fence is None:
+            heading = _MARKDOWN_HEADING.match(stripped)
+            if heading and len(heading.group(1)) <= COURSE_SECTION_HEADING_LEVEL:
+                if current["level"] or "".join(current["lines"]).strip():
+                    current = start(heading.group(2)[:255], len(heading.group(1)))
+                else:
+                    # A blank preamble is folded into the first heading's section.
+                    current.update(title=heading.group(2)[:255], level=len(heading.group(1)))
+                    used_anchors.discard(current["anchor"])
+                    current["anchor"] = _section_anchor(current["title"], used_anchors)
+            elif not stripped.strip() and current["chars"] >= COURSE_SECTION_TARGET_CHARS:
+                current["lines"].append(line)
+                current["chars"] += len(line)
+                current = start(current["title"], current["level"], is_continuation=True)
+                continue
+        current["lines"].append(line)
+        current["chars"] += len(line)
+
+    if len(sections) > 1 and not sections[-1]["lines"]:
+        sections.pop()
+    return [
+        {
+            "position": position,
+            "title": section["title"],
+            "level": section["level"],
+            "anchor": section["anchor"],
+            "is_continuation": section["is_continuation"],
+            "char_count": section["chars"],
+            "content": "".join(section["lines"]),
+        }
+        for position, section in enumerate(sections)
+    ]
+
+
+def build_part_sections(part_id: str, content: str | None) -> list[CoursePartSection]:
+    return [CoursePartSection(part_id=part_id, **section) for section in split_markdown_sections(content or "")]
+
+
+async def index_course_part_sections(only_missing: bool = False) -> int:
+    """Rebuilds course_part_sections from course_parts.content, one part at a time."""
+    async with async_session_factory() as session:
+        statement = select(CoursePart.id)
+        if only_missing:
+            statement = statement.where(
+                ~select(CoursePartSection.part_id).where(CoursePartSection.part_id == CoursePart.id).exists()
+            )
+        part_ids = (await session.execute(statement)).scalars().all()
+
+        for part_id in part_ids:
+            content = await session.scalar(select(CoursePart.content).where(CoursePart.id == part_id))
+            await session.execute(delete(CoursePartSection).where(CoursePartSection.part_id == part_id))
+            session.add_all(build_part_sections(part_id, content))
+            await session.commit()
+        return len(part_ids)
+
+
+def _section_to_response(section: CoursePartSection, include_content: bool = False) -> dict[str, Any]:
+    payload: dict[str, Any] = {
+        "position": int(section.position),
+        "title": section.title or "",
+        "level": int(section.level),
+        "anchor": section.anchor or "",
+        "is_continuation": bool(section.is_continuation),
+        "char_count": int(section.char_count),
+    }
+    if include_content:
+        payload["content"] = section.content or ""
+    return payload
+
+
+async def _has_access_to_part(
+    session: AsyncSession,
+    user_id: str,
+    part: CoursePart,
+    is_admin_user: bool = False,
+) -> bool:
+    if is_admin_user or part.is_preview:
+        return True
+
+    entitlements = await entitlement_cache.get(session, user_id)
+    return entitlements.allows(part)
 
 
 def generate_reset_token() -> str:
@@ -983,10 +2734,12 @@ async def register(user: UserCreate, session: AsyncSession = Depends(get_session
             accent_color=None,
             privacy_dm=DEFAULT_DM_PRIVACY,
             created_at=datetime.now(),
-            updated_at=datetime.now(),
-        )
-    )
-    await session.commit()
+            updated_at=datetime.now(),
+        )
+    )
+    await session.commit()
+    user_cards.invalidate(user_id)
+    user_typeahead.upsert(user_id, user_obj.username, user_obj.username, None, DEFAULT_DM_PRIVACY)
 
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(data={"sub": user_id}, expires_delta=access_token_expires)
@@ -1067,10 +2820,190 @@ async def update_my_profile(
     profile.updated_at = datetime.now()
     await session.commit()
     await session.refresh(profile)
+    user_cards.invalidate(current_user.id)
+    user_typeahead.upsert(
+        current_user.id,
+        current_user.username,
+        profile.display_name,
+        profile.avatar_url,
+        _normalize_privacy_dm(profile.privacy_dm),
+    )
 
     return profile_to_dict(current_user, profile)
 
 
+def _trigrams(value: str, padded: bool = False) -> set[str]:
+    value = value.lower()
+    if padded:
+        # Same padding as pg_trgm, so word edges count and the two backends score alike.
+        value = f"  {value} "
+    if len(value) < 3:
+        return {value} if value else set()
+    return {value[index:index + 3] for index in range(len(value) - 2)}
+
+
+def _trigram_similarity(left: str, right: str) -> float:
+    left_grams, right_grams = _trigrams(left, padded=True), _trigrams(right, padded=True)
+    if not left_grams or not right_grams:
+        return 0.0
+    return len(left_grams & right_grams) / len(left_grams | right_grams)
+
+
+def _rank_user_match(query: str, username: str, display_name: str | None) -> tuple | None:
+    """Sort key for a search hit: exact, then prefix, then substring, then fuzzy matches.
+
+    Inside a tier a username hit beats a display name hit, then closer names win.
+    """
+    needle = query.lower()
+    login = username.lower()
+    names = [name for name in (login, (display_name or "").lower()) if name]
+    similarity = max((_trigram_similarity(needle, name) for name in names), default=0.0)
+
+    tests = (
+        lambda name: name == needle,
+        lambda name: name.startswith(needle),
+        lambda name: needle in name,
+    )
+    for tier, matches in enumerate(tests):
+        if any(matches(name) for name in names):
+            return tier, not matches(login), -similarity, len(login), login
+    if similarity >= USER_SEARCH_MIN_SIMILARITY:
+        return len(tests), False, -similarity, len(login), login
+    return None
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _fts_phrase(value: str) -> str:
+    return '"' + value.replace('"', '""') + '"'
+
+
+def _fuzzy_fts_match(query: str) -> str:
+    # One typo breaks at most one half of a query of six or more characters, so a
+    # name containing either half verbatim is a candidate. Shorter queries fall
+    # back to sharing any trigram, which is less selective but still indexed.
+    if len(query) >= 6:
+        middle = len(query) // 2
+        return f"{_fts_phrase(query[:middle])} OR {_fts_phrase(query[middle:])}"
+    return " OR ".join(_fts_phrase(gram) for gram in sorted(_trigrams(query)))
+
+
+async def _sqlite_user_search_candidates(
+    session: AsyncSession,
+    query: str,
+    exclude_user_id: str,
+    wanted: int,
+) -> list[tuple[str, str, str | None]]:
+    """Prefix hits from the B-tree indexes first, then substring and fuzzy hits from FTS5 if still short."""
+    prefix = f"{_escape_like(query.lower())}%"
+    result = await session.execute(
+        text(
+            "SELECT user_id, username, display_name FROM user_search_docs "
+            "WHERE (username LIKE :prefix ESCAPE '\\' OR display_name LIKE :prefix ESCAPE '\\') "
+            "AND user_id != :exclude LIMIT :limit"
+        ).bindparams(prefix=prefix, exclude=exclude_user_id, limit=USER_SEARCH_CANDIDATES)
+    )
+    rows = [tuple(row) for row in result.all()]
+    if len(query) < 3:
+        return rows
+
+    for match in (_fts_phrase(query), _fuzzy_fts_match(query)):
+        if len(rows) >= wanted:
+            break
+        seen = {row[0] for row in rows}
+        result = await session.execute(
+            text(
+                "SELECT d.user_id, d.username, d.display_name FROM user_search_fts "
+                "JOIN user_search_docs AS d ON d.id = user_search_fts.rowid "
+                "WHERE user_search_fts MATCH :match AND d.user_id != :exclude "
+                "ORDER BY user_search_fts.rank LIMIT :limit"
+            ).bindparams(match=match, exclude=exclude_user_id, limit=USER_SEARCH_CANDIDATES)
+        )
+        rows += [tuple(row) for row in result.all() if row[0] not in seen]
+    return rows
+
+
+async def _user_search_candidates(
+    session: AsyncSession,
+    query: str,
+    exclude_user_id: str,
+    wanted: int,
+    limit: int = USER_SEARCH_CANDIDATES,
+) -> list[tuple[str, str, str | None]]:
+    backend = get_user_search_backend()
+    prefix = f"{_escape_like(query.lower())}%"
+
+    if backend == "fts5":
+        return await _sqlite_user_search_candidates(session, query, exclude_user_id, wanted)
+
+    username_lower = func.lower(User.username)
+    display_lower = func.lower(UserProfile.display_name)
+    base_query = (
+        select(User.id, User.username, UserProfile.display_name)
+        .outerjoin(UserProfile, UserProfile.user_id == User.id)
+        .where(User.id != exclude_user_id)
+        .limit(limit)
+    )
+
+    if backend == "pg_trgm":
+        needle = query.lower()
+        similarity = func.greatest(
+            func.similarity(username_lower, needle),
+            func.coalesce(func.similarity(display_lower, needle), 0),
+        )
+        statement = base_query.where(
+            or_(
+                username_lower.like(prefix, escape="\\"),
+                display_lower.like(prefix, escape="\\"),
+                username_lower.op("%")(needle),
+                display_lower.op("%")(needle),
+            )
+        ).order_by(similarity.desc())
+    else:
+        contains = f"%{_escape_like(query)}%"
+        statement = base_query.where(
+            or_(User.username.ilike(contains, escape="\\"), UserProfile.display_name.ilike(contains, escape="\\"))
+        ).order_by(User.username.asc())
+
+    result = await session.execute(statement)
+    return [tuple(row) for row in result.all()]
+
+
+async def search_user_ids(
+    session: AsyncSession,
+    query: str,
+    exclude_user_id: str,
+    limit: int,
+) -> list[str]:
+    candidates = await _user_search_candidates(session, query, exclude_user_id, wanted=limit)
+    ranked = []
+    for user_id, username, display_name in candidates:
+        rank = _rank_user_match(query, username, display_name)
+        if rank is not None:
+            ranked.append((rank, user_id))
+    ranked.sort()
+    return [user_id for _, user_id in ranked[:limit]]
+
+
+def _user_search_item(
+    user_id: str,
+    username: str,
+    display_name: str,
+    avatar_url: str | None,
+    privacy_dm: str,
+) -> dict[str, Any]:
+    return {
+        "id": user_id,
+        "username": username,
+        "display_name": display_name,
+        "avatar_url": avatar_url,
+        "privacy_dm": privacy_dm,
+        "can_receive_dm": privacy_dm != "none",
+    }
+
+
 @app.get("/api/users/search")
 async def search_users(
     q: str = "",
@@ -1084,39 +3017,44 @@ async def search_users(
         return []
 
     safe_limit = min(max(limit, 1), 50)
-    users_result = await session.execute(
-        select(User)
-        .where(
-            User.id != current_user.id,
-            User.username.ilike(f"%{search_query}%"),
-        )
-        .order_by(User.username.asc())
-        .limit(safe_limit)
-    )
-    users = users_result.scalars().all()
-    if not users:
+    user_ids = await search_user_ids(session, search_query[:MAX_USER_SEARCH_QUERY_LENGTH], current_user.id, safe_limit)
+    if not user_ids:
         return []
 
-    user_ids = [user.id for user in users]
-    profiles_result = await session.execute(select(UserProfile).where(UserProfile.user_id.in_(user_ids)))
-    profiles_map = {profile.user_id: profile for profile in profiles_result.scalars().all()}
+    cards = await user_cards.get_many(session, user_ids)
 
     payload: list[dict[str, Any]] = []
-    for user in users:
-        profile = profiles_map.get(user.id)
-        privacy_dm = _normalize_privacy_dm(profile.privacy_dm if profile else DEFAULT_DM_PRIVACY)
-        payload.append({
-            "id": user.id,
-            "username": user.username,
-            "display_name": _normalize_display_name(profile.display_name if profile else None, user.username),
-            "avatar_url": profile.avatar_url if profile else None,
-            "privacy_dm": privacy_dm,
-            "can_receive_dm": privacy_dm != "none",
-        })
+    for user_id in user_ids:
+        card = cards.get(user_id)
+        if not card:
+            continue
+        payload.append(_user_search_item(
+            card["id"], card["username"], card["display_name"], card["avatar_url"], card["privacy_dm"]
+        ))
 
     return payload
 
 
+@app.get("/api/users/typeahead")
+async def typeahead_users(
+    q: str = "",
+    limit: int = USER_TYPEAHEAD_MAX_RESULTS,
+    dm_only: bool = False,
+    current_user: User = Depends(get_current_user_model),
+    session: AsyncSession = Depends(get_session),
+) -> list[dict[str, Any]]:
+    query = q.strip()[:MAX_USER_SEARCH_QUERY_LENGTH]
+    if not query:
+        return []
+
+    safe_limit = min(max(limit, 1), USER_TYPEAHEAD_MAX_RESULTS)
+    if user_typeahead.ready:
+        return user_typeahead.search(query, safe_limit, exclude_user_id=current_user.id, dm_only=dm_only)
+
+    results = await search_users(q=query, limit=safe_limit, current_user=current_user, session=session)
+    return [item for item in results if item["can_receive_dm"] or not dm_only]
+
+
 @app.post("/api/conversations")
 async def create_or_get_conversation(
     payload: ConversationCreatePayload,
@@ -1131,11 +3069,11 @@ async def create_or_get_conversation(
     if target_user_id == current_user.id:
         raise HTTPException(status_code=400, detail="Cannot create conversation with yourself")
 
-    target_user = await session.get(User, target_user_id)
-    if not target_user:
+    target_card = await user_cards.get(session, target_user_id)
+    if not target_card:
         raise HTTPException(status_code=404, detail="User not found")
 
-    await ensure_user_accepts_dm(session, target_user)
+    ensure_user_accepts_dm(target_card)
 
     user_a, user_b = _conversation_pair(current_user.id, target_user_id)
     conversation_result = await session.execute(
@@ -1149,11 +3087,14 @@ async def create_or_get_conversation(
     conversation = conversation_result.scalar_one_or_none()
 
     if not conversation:
+        now = datetime.now()
         conversation = Conversation(
             id=str(uuid.uuid4()),
             user_a=user_a,
             user_b=user_b,
-            created_at=datetime.now(),
+            created_at=now,
+            last_activity_at=now,
+            message_count=0,
         )
         session.add(conversation)
         await session.commit()
@@ -1164,90 +3105,151 @@ async def create_or_get_conversation(
 
 @app.get("/api/me/conversations")
 async def get_my_conversations(
+    before: str | None = None,
+    limit: int | None = None,
     current_user: User = Depends(get_current_user_model),
     session: AsyncSession = Depends(get_session),
 ) -> list[dict[str, Any]]:
     await ensure_db_connection(session)
-    conversations_result = await session.execute(
-        select(Conversation).where(
+    safe_limit = min(max(limit, 1), MAX_CONVERSATIONS_PAGE_SIZE) if limit is not None else None
+    # Pass the last item's cursor as `before` to get the next page.
+    return await fetch_conversation_summaries(session, current_user.id, before=before, limit=safe_limit)
+
+
+async def fetch_conversation_page(
+    session: AsyncSession,
+    conversation_id: str,
+    before: str | None = None,
+    after: str | None = None,
+    limit: int = DM_HISTORY_PAGE_SIZE,
+) -> dict[str, Any]:
+    """Keyset page over (conversation_id, created_at, id); messages are always returned oldest first.
+
+    Without `after` the page walks backwards from `before` (or the newest message) and
+    `next_cursor` points further into the past, or is None at the oldest message. With
+    `after` it walks forward and `next_cursor` is always the position to poll from next:
+    the last message returned, or `after` itself when the client is caught up.
+    `has_more` tells whether another page is already available.
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either 'before' or 'after', not both")
+
+    query = select(DirectMessage).where(DirectMessage.conversation_id == conversation_id)
+    if after:
+        after_ts, after_id = _decode_cursor(after)
+        query = query.where(
             or_(
-                Conversation.user_a == current_user.id,
-                Conversation.user_b == current_user.id,
+                DirectMessage.created_at > after_ts,
+                and_(DirectMessage.created_at == after_ts, DirectMessage.id > after_id),
             )
-        )
-    )
-    conversations = conversations_result.scalars().all()
+        ).order_by(DirectMessage.created_at.asc(), DirectMessage.id.asc())
+    else:
+        if before:
+            before_ts, before_id = _decode_cursor(before)
+            query = query.where(
+                or_(
+                    DirectMessage.created_at < before_ts,
+                    and_(DirectMessage.created_at == before_ts, DirectMessage.id < before_id),
+                )
+            )
+        query = query.order_by(DirectMessage.created_at.desc(), DirectMessage.id.desc())
 
-    summaries: list[dict[str, Any]] = []
-    for conversation in conversations:
-        try:
-            summaries.append(await build_conversation_summary(session, conversation, current_user.id))
-        except HTTPException as exc:
-            if exc.status_code == 404:
-                continue
-            raise
+    result = await session.execute(query.limit(limit + 1))
+    rows = list(result.scalars().all())
+    has_more = len(rows) > limit
+    rows = rows[:limit]
 
-    summaries.sort(key=lambda item: item.get("updated_at") or "", reverse=True)
-    return summaries
+    if after:
+        next_cursor = _encode_cursor(rows[-1].created_at, rows[-1].id) if rows else after
+    else:
+        next_cursor = _encode_cursor(rows[-1].created_at, rows[-1].id) if has_more else None
+        rows.reverse()
+
+    return {
+        "messages": await serialize_direct_messages(session, rows),
+        "next_cursor": next_cursor,
+        "has_more": has_more,
+    }
 
 
 @app.get("/api/conversations/{conversation_id}/messages")
 async def get_conversation_messages(
     conversation_id: str,
-    limit: int = 50,
+    limit: int = DM_HISTORY_PAGE_SIZE,
     before: str | None = None,
+    after: str | None = None,
     current_user: User = Depends(get_current_user_model),
     session: AsyncSession = Depends(get_session),
-) -> list[dict[str, Any]]:
+) -> dict[str, Any]:
     await ensure_db_connection(session)
     await get_conversation_for_user_or_404(session, conversation_id, current_user.id)
 
-    safe_limit = min(max(limit, 1), 100)
-    query = (
-        select(DirectMessage)
-        .where(DirectMessage.conversation_id == conversation_id)
-        .order_by(DirectMessage.created_at.desc())
-        .limit(safe_limit)
-    )
+    safe_limit = min(max(limit, 1), MAX_DM_HISTORY_PAGE_SIZE)
+    return await fetch_conversation_page(session, conversation_id, before=before, after=after, limit=safe_limit)
 
-    if before:
-        try:
-            before_dt = datetime.fromisoformat(before.replace("Z", "+00:00"))
-            if before_dt.tzinfo is not None:
-                before_dt = before_dt.replace(tzinfo=None)
-        except ValueError as exc:
-            raise HTTPException(status_code=400, detail="Invalid 'before' datetime format") from exc
-        query = (
-            select(DirectMessage)
-            .where(
-                DirectMessage.conversation_id == conversation_id,
-                DirectMessage.created_at < before_dt,
-            )
-            .order_by(DirectMessage.created_at.desc())
-            .limit(safe_limit)
+
+@app.post("/api/conversations/{conversation_id}/read")
+async def mark_conversation_read(
+    conversation_id: str,
+    current_user: User = Depends(get_current_user_model),
+    session: AsyncSession = Depends(get_session),
+) -> dict[str, Any]:
+    await ensure_db_connection(session)
+    conversation = await get_conversation_for_user_or_404(session, conversation_id, current_user.id)
+
+    side = _participant_side(conversation, current_user.id)
+    if getattr(conversation, f"{side}_unread"):
+        await session.execute(
+            update(Conversation)
+            .where(Conversation.id == conversation.id)
+            .values({
+                f"{side}_unread": 0,
+                f"{side}_last_read_at": func.coalesce(Conversation.last_message_at, Conversation.created_at),
+            })
+            .execution_options(synchronize_session=False)
         )
+        await session.commit()
 
-    messages_result = await session.execute(query)
-    direct_messages = list(messages_result.scalars().all())[::-1]
+    total_unread = (await session.execute(_unread_total_query(current_user.id))).scalar_one()
+    return {"conversation_id": conversation.id, "unread_count": 0, "total_unread": int(total_unread)}
 
-    sender_ids = {msg.sender_id for msg in direct_messages}
-    if not sender_ids:
-        return []
 
-    users_result = await session.execute(select(User).where(User.id.in_(sender_ids)))
-    users_map = {user.id: user for user in users_result.scalars().all()}
+@app.get("/api/me/unread")
+async def get_my_unread_total(
+    current_user: User = Depends(get_current_user_model),
+    session: AsyncSession = Depends(get_session),
+) -> dict[str, int]:
+    total_unread = (await session.execute(_unread_total_query(current_user.id))).scalar_one()
+    return {"total_unread": int(total_unread)}
 
-    profiles_result = await session.execute(select(UserProfile).where(UserProfile.user_id.in_(sender_ids)))
-    profiles_map = {profile.user_id: profile for profile in profiles_result.scalars().all()}
 
-    payload: list[dict[str, Any]] = []
-    for message in direct_messages:
-        sender = users_map.get(message.sender_id)
-        if not sender:
-            continue
-        payload.append(direct_message_to_dict(message, sender, profiles_map.get(message.sender_id)))
+@app.get("/api/me/dm/updates")
+async def get_direct_message_updates(
+    since: str | None = None,
+    timeout: int = DM_LONG_POLL_TIMEOUT_SECONDS,
+    current_user: User = Depends(get_current_user_model),
+    session: AsyncSession = Depends(get_session),
+) -> dict[str, Any]:
+    user_id = current_user.id
+    safe_timeout = min(max(timeout, 0), MAX_DM_LONG_POLL_TIMEOUT_SECONDS)
 
-    return payload
+    # Subscribe before the first read so a message committed in between still wakes us up.
+    event = dm_manager.subscribe(user_id)
+    try:
+        updates = await fetch_direct_messages_since(session, user_id, since)
+        if updates["messages"] or not since or safe_timeout == 0:
+            return updates
+
+        # Give the connection back to the pool while the request is parked.
+        await session.close()
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(event.wait(), timeout=safe_timeout)
+        if not event.is_set():
+            return updates
+
+        return await fetch_direct_messages_since(session, user_id, since)
+    finally:
+        dm_manager.unsubscribe(event, user_id)
 
 
 @app.post("/api/conversations/{conversation_id}/messages")
@@ -1267,14 +3269,12 @@ async def send_conversation_message(
         raise HTTPException(status_code=400, detail=f"Message too long (max {MAX_DM_MESSAGE_LENGTH} chars)")
 
     partner_id = get_partner_id(conversation, current_user.id)
-    partner_user = await session.get(User, partner_id)
-    if not partner_user:
+    cards = await user_cards.get_many(session, [partner_id, current_user.id])
+    partner_card = cards.get(partner_id)
+    if not partner_card:
         raise HTTPException(status_code=404, detail="Conversation participant not found")
 
-    await ensure_user_accepts_dm(session, partner_user)
-
-    current_user_profile_result = await session.execute(select(UserProfile).where(UserProfile.user_id == current_user.id))
-    current_user_profile = current_user_profile_result.scalar_one_or_none()
+    ensure_user_accepts_dm(partner_card)
 
     message = DirectMessage(
         id=str(uuid.uuid4()),
@@ -1284,10 +3284,39 @@ async def send_conversation_message(
         created_at=datetime.now(),
     )
     session.add(message)
+    # Same transaction as the insert; counters are incremented in SQL so concurrent sends don't lose updates.
+    # Sending counts as reading the conversation up to this message.
+    sender_side = _participant_side(conversation, current_user.id)
+    recipient_side = _participant_side(conversation, partner_id)
+    await session.execute(
+        update(Conversation)
+        .where(Conversation.id == conversation.id)
+        .values(
+            {
+                "last_message_id": message.id,
+                "last_message_preview": text_value[:CONVERSATION_PREVIEW_LENGTH],
+                "last_message_at": message.created_at,
+                "last_activity_at": message.created_at,
+                "message_count": Conversation.message_count + 1,
+                f"{recipient_side}_unread": getattr(Conversation, f"{recipient_side}_unread") + 1,
+                f"{sender_side}_unread": 0,
+                f"{sender_side}_last_read_at": message.created_at,
+            }
+        )
+        .execution_options(synchronize_session=False)
+    )
     await session.commit()
-    await session.refresh(message)
 
-    return direct_message_to_dict(message, current_user, current_user_profile)
+    message_payload = direct_message_to_dict(message, cards[current_user.id])
+    frame = {
+        "type": "dm",
+        "data": message_payload,
+        "cursor": _encode_cursor(message.created_at, message.id),
+    }
+    for recipient_id in (partner_id, current_user.id):
+        dm_manager.send_to_user(recipient_id, frame)
+
+    return message_payload
 
 
 @app.post("/api/auth/password-reset-request")
@@ -1852,16 +3881,100 @@ async def update_user_role(
 
     user_obj.role = role
     await session.commit()
+    user_cards.invalidate(user_id)
 
     return {"message": "Role updated"}
 
 
+@app.get("/api/chat/rooms")
+async def get_chat_rooms(
+    current_user: User = Depends(get_current_user_model),
+    session: AsyncSession = Depends(get_session),
+) -> list[dict[str, Any]]:
+    await ensure_db_connection(session)
+    rooms: list[dict[str, Any]] = [
+        {"id": room_id, "title": title, "kind": "public"}
+        for room_id, title in CHAT_PUBLIC_ROOMS.items()
+    ]
+
+    query = select(Course).order_by(Course.title.asc())
+    if current_user.role != "admin":
+        accessible = _accessible_course_ids_query(current_user.id).subquery()
+        query = query.where(
+            Course.is_published.is_(True),
+            Course.id.in_(select(accessible.c.course_id)),
+        )
+    result = await session.execute(query)
+    for course in result.scalars().all():
+        rooms.append({
+            "id": f"{COURSE_ROOM_PREFIX}{course.id}",
+            "title": course.title,
+            "kind": "course",
+        })
+
+    return rooms
+
+
+@app.get("/api/chat/online")
+async def get_chat_online(
+    room: str = DEFAULT_CHAT_ROOM,
+    current_user: User = Depends(get_current_user_model),
+    session: AsyncSession = Depends(get_session),
+) -> dict[str, Any]:
+    if not await can_join_chat_room(session, current_user, room):
+        raise HTTPException(status_code=403, detail="Access to this room is denied")
+
+    users = presence.online(room)
+    return {"room": room, "users": users, "count": len(users)}
+
+
+@app.get("/api/admin/chat/throttle")
+async def get_chat_throttle_stats(
+    current_user: dict[str, Any] = Depends(get_current_admin),
+) -> dict[str, Any]:
+    return {
+        "counters": {**chat_rate_limiter.counters, "deduplicated": chat_dedupe_cache.duplicates},
+        "tracked_keys": len(chat_rate_limiter.buckets),
+    }
+
+
+@app.get("/api/admin/users/typeahead")
+async def get_user_typeahead_stats(
+    current_user: dict[str, Any] = Depends(get_current_admin),
+) -> dict[str, Any]:
+    return user_typeahead.memory_report()
+
+
+@app.get("/api/chat/messages")
+async def get_chat_messages(
+    room: str = DEFAULT_CHAT_ROOM,
+    before: str | None = None,
+    limit: int = CHAT_HISTORY_PAGE_SIZE,
+    current_user: User = Depends(get_current_user_model),
+    session: AsyncSession = Depends(get_session),
+) -> dict[str, Any]:
+    await ensure_db_connection(session)
+    if not await can_join_chat_room(session, current_user, room):
+        raise HTTPException(status_code=403, detail="Access to this room is denied")
+
+    safe_limit = min(max(limit, 1), MAX_CHAT_HISTORY_PAGE_SIZE)
+    messages, next_cursor = await fetch_chat_history(session, room=room, before=before, limit=safe_limit)
+    return {"room": room, "messages": messages, "next_cursor": next_cursor}
+
+
 @app.websocket("/api/ws/chat")
-async def websocket_chat(websocket: WebSocket, token: str) -> None:
+async def websocket_chat(websocket: WebSocket, token: str, room: str = DEFAULT_CHAT_ROOM) -> None:
     user = None
+    registered = False
+    strikes = 0
+    protocol = negotiate_chat_subprotocol(websocket)
+    client_ip = websocket.client.host if websocket.client else None
 
     try:
-        await websocket.accept()
+        await websocket.accept(subprotocol=protocol)
+        if _websockets_draining:
+            await websocket.close(code=1013, reason="Server restarting")
+            return
 
         try:
             payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -1884,47 +3997,140 @@ async def websocket_chat(websocket: WebSocket, token: str) -> None:
                 await websocket.close(code=1008, reason="User not found")
                 return
 
-            await manager.connect(websocket, user_id, user.username)
+            if not await can_join_chat_room(session, user, room):
+                await websocket.close(code=1008, reason="Room access denied")
+                return
 
-            history_result = await session.execute(
-                select(ChatMessage)
-                .order_by(ChatMessage.timestamp.desc())
-                .limit(50)
-            )
-            messages = [
-                chat_message_to_dict(msg)
-                for msg in history_result.scalars().all()
-            ][::-1]
+            await manager.connect(websocket, user_id, user.username, protocol, room)
+            presence.add(room, user_id, user.username)
+            registered = True
 
-            await websocket.send_json({
-                "type": "history",
-                "messages": messages
-            })
+            messages, next_cursor = await fetch_chat_history(session, room=room)
 
-            await manager.broadcast({
-                "type": "user_joined",
-                "username": user.username
-            })
+            await send_frame(websocket, encode_frame({
+                "type": "history",
+                "room": room,
+                "messages": messages,
+                "next_cursor": next_cursor,
+                "online": presence.online(room),
+            }, protocol))
 
         while True:
-            data = await websocket.receive_json()
-
-            async with async_session_factory() as session:
-                message_id = str(uuid.uuid4())
-                chat_message = ChatMessage(
-                    id=message_id,
-                    user_id=user_id,
-                    username=user.username,
-                    message=data.get("message", ""),
-                    timestamp=datetime.now(),
-                )
-                session.add(chat_message)
-                await session.commit()
-
-                await manager.broadcast({
-                    "type": "message",
-                    "data": chat_message_to_dict(chat_message)
-                })
+            try:
+                data = await receive_frame(websocket, protocol, CHAT_MAX_FRAME_BYTES)
+            except ChatFrameTooLarge:
+                chat_rate_limiter.count("oversized")
+                await websocket.close(code=1009, reason="Frame too large")
+                return
+            except ValueError:
+                data = None
+
+            if isinstance(data, dict) and data.get("type") == "pong":
+                if chat_rate_limiter.allow_control(user_id):
+                    manager.touch(websocket, active=False)
+                    continue
+                strikes += 1
+                if strikes >= CHAT_FLOOD_MAX_STRIKES:
+                    chat_rate_limiter.count("disconnected")
+                    await websocket.close(code=1008, reason="Too many messages")
+                    return
+                continue
+            manager.touch(websocket)
+
+            text_value = data.get("message") if isinstance(data, dict) else None
+            client_id = data.get("client_id") if isinstance(data, dict) else None
+            if client_id is not None and (not isinstance(client_id, str) or len(client_id) > MAX_CHAT_CLIENT_ID_LENGTH):
+                client_id = None
+                text_value = None
+
+            stored_id = chat_dedupe_cache.get(user_id, client_id) if client_id else None
+            if stored_id is not None:
+                # A retransmit after reconnect: confirm the original instead of storing it again.
+                await send_frame(websocket, encode_frame({
+                    "type": "ack",
+                    "client_id": client_id,
+                    "id": stored_id,
+                    "duplicate": True,
+                }, protocol))
+                continue
+            if client_id and not chat_dedupe_cache.claim(user_id, client_id):
+                # The original is still waiting for a rate-limit token or its commit and may
+                # yet fail, so the client keeps its copy and tries again shortly.
+                await send_frame(websocket, encode_frame({
+                    "type": "error",
+                    "code": "in_progress",
+                    "client_id": client_id,
+                    "retry": True,
+                    "retry_after_ms": int(CHAT_FLOOD_MAX_DELAY_SECONDS * 1000) + 500,
+                }, protocol))
+                continue
+
+            message_id = str(uuid.uuid4())
+            stored = False
+            try:
+                if not isinstance(text_value, str) or not text_value.strip() or len(text_value) > MAX_CHAT_MESSAGE_LENGTH:
+                    chat_rate_limiter.count("invalid")
+                    strikes += 1
+                    await send_frame(websocket, encode_frame({
+                        "type": "error",
+                        "code": "invalid_message",
+                        "client_id": client_id,
+                    }, protocol))
+                else:
+                    wait = chat_rate_limiter.reserve(user_id, client_ip)
+                    if wait is None:
+                        strikes += 1
+                        await send_frame(websocket, encode_frame({
+                            "type": "error",
+                            "code": "rate_limited",
+                            "client_id": client_id,
+                            "retry_after_ms": int(1000 / CHAT_USER_RATE_PER_SECOND),
+                        }, protocol))
+                    else:
+                        strikes = 0
+                        if wait > 0:
+                            await asyncio.sleep(wait)
+
+                if strikes >= CHAT_FLOOD_MAX_STRIKES:
+                    chat_rate_limiter.count("disconnected")
+                    await websocket.close(code=1008, reason="Too many messages")
+                    return
+                if strikes:
+                    continue
+
+                async with async_session_factory() as session:
+                    chat_message = ChatMessage(
+                        id=message_id,
+                        room=room,
+                        user_id=user_id,
+                        username=user.username,
+                        message=text_value,
+                        timestamp=datetime.now(),
+                    )
+                    session.add(chat_message)
+                    await session.commit()
+                stored = True
+                if client_id:
+                    chat_dedupe_cache.put(user_id, client_id, message_id)
+            finally:
+                # Rejected or failed sends release the claim so the client can retry them.
+                if client_id and not stored:
+                    chat_dedupe_cache.discard(user_id, client_id)
+
+            message_data = chat_message_to_dict(chat_message)
+            if client_id:
+                await send_frame(websocket, encode_frame({
+                    "type": "ack",
+                    "client_id": client_id,
+                    "id": message_id,
+                    "timestamp": message_data["timestamp"],
+                }, protocol))
+
+            await manager.broadcast({
+                "type": "message",
+                "data": message_data,
+                "client_id": client_id,
+            }, room)
 
     except WebSocketDisconnect:
         pass
@@ -1935,13 +4141,78 @@ async def websocket_chat(websocket: WebSocket, token: str) -> None:
         traceback.print_exc()
 
     finally:
-        username = manager.disconnect(websocket)
+        # broadcast() may already have dropped a dead socket, so presence is tracked separately.
+        manager.disconnect(websocket)
+        if registered:
+            presence.remove(room, user_id)
 
-        if username:
-            await manager.broadcast({
-                "type": "user_left",
-                "username": username
-            })
+        with suppress(Exception):
+            if websocket.client_state.name == "CONNECTED":
+                await websocket.close(code=1000)
+
+
+@app.websocket("/api/ws/dm")
+async def websocket_dm(websocket: WebSocket, token: str, since: str | None = None) -> None:
+    user_id = None
+
+    try:
+        await websocket.accept()
+        if _websockets_draining:
+            await websocket.close(code=1013, reason="Server restarting")
+            return
+
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            user_id = payload.get("sub")
+
+            if not user_id:
+                await websocket.close(code=1008, reason="Invalid token")
+                return
+        except JWTError:
+            await websocket.close(code=1008, reason="Invalid token")
+            return
+
+        async with async_session_factory() as session:
+            user = await session.get(User, user_id)
+            if not user:
+                user_id = None
+                await websocket.close(code=1008, reason="User not found")
+                return
+
+            # Register before reading the backlog so nothing sent in between is lost;
+            # the client drops duplicates by message id.
+            dm_manager.connect(websocket, user_id)
+
+            try:
+                sync_payload = await fetch_direct_messages_since(session, user_id, since)
+            except HTTPException:
+                await websocket.close(code=1008, reason="Invalid cursor")
+                return
+
+            await send_frame(websocket, encode_frame({"type": "dm_sync", **sync_payload}, CHAT_SUBPROTOCOL_JSON))
+
+        # Clients only send heartbeat pongs here, so every frame is charged as a control frame.
+        strikes = 0
+        while True:
+            await websocket.receive_text()
+            if chat_rate_limiter.allow_control(user_id):
+                dm_manager.touch(websocket)
+                continue
+            strikes += 1
+            if strikes >= CHAT_FLOOD_MAX_STRIKES:
+                chat_rate_limiter.count("disconnected")
+                await websocket.close(code=1008, reason="Too many messages")
+                return
+
+    except WebSocketDisconnect:
+        pass
+
+    except Exception as exc:
+        print(f"DM WebSocket error: {exc}")
+
+    finally:
+        if user_id:
+            dm_manager.disconnect(websocket, user_id)
 
         with suppress(Exception):
             if websocket.client_state.name == "CONNECTED":
@@ -2096,16 +4367,19 @@ Email: {contact.email}{phone_text}
 
 @app.get("/api/courses", response_model=list[CourseResponse])
 async def get_courses_catalog(
+    request: Request,
     session: AsyncSession = Depends(get_session),
-) -> list[dict[str, Any]]:
-    await ensure_db_connection(session)
-    result = await session.execute(
-        select(Course)
-        .where(Course.is_published.is_(True))
-        .order_by(Course.created_at.desc())
-    )
-    courses = result.scalars().all()
-    return [_course_to_response(course) for course in courses]
+) -> Response:
+    # Served from pre-encoded bytes, so neither the database nor response_model
+    # validation runs once the snapshot is warm.
+    try:
+        body, etag = await course_catalog.get_catalog(session)
+    except SQLAlchemyError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Database connection failed. Ensure DATABASE_URL is correct."
+        ) from exc
+    return _cached_json_response(request, body, etag)
 
 
 @app.get("/api/courses/all", response_model=list[CourseResponse])
@@ -2124,37 +4398,26 @@ async def get_course_detail(
     course_id: str,
     request: Request,
     session: AsyncSession = Depends(get_session),
-) -> dict[str, Any]:
+) -> Response:
     await ensure_db_connection(session)
 
-    course = await session.get(Course, course_id)
+    snapshot = await course_catalog.get_course(session, course_id)
     optional_user = await _get_optional_user_from_request(request, session)
     is_admin_user = bool(optional_user and optional_user.role == "admin")
 
-    if not course or (not course.is_published and not is_admin_user):
+    if not snapshot or (not snapshot.is_published and not is_admin_user):
         raise HTTPException(status_code=404, detail="Курс не найден")
 
-    parts_result = await session.execute(
-        select(CoursePart)
-        .where(CoursePart.course_id == course.id)
-        .order_by(CoursePart.order.asc(), CoursePart.created_at.asc())
-    )
-    parts = parts_result.scalars().all()
-
-    serialized_parts: list[dict[str, Any]] = []
-    for part in parts:
-        if optional_user:
-            has_access = await _has_access_to_part(
-                session,
-                optional_user.id,
-                part,
-                is_admin_user=is_admin_user,
-            )
-        else:
-            has_access = bool(part.is_preview)
-        serialized_parts.append(_course_part_to_response(part, has_access=has_access))
+    if optional_user is None:
+        return _cached_json_response(request, snapshot.anonymous_body, snapshot.anonymous_etag)
+    if is_admin_user:
+        return _cached_json_response(request, snapshot.render(lambda part: True))
 
-    return _course_to_response(course, parts=serialized_parts)
+    entitlements = await entitlement_cache.get(session, optional_user.id)
+    body = snapshot.render(
+        lambda part: entitlements.allows_ids(part["course_id"], part["id"], part["is_preview"])
+    )
+    return _cached_json_response(request, body)
 
 
 @app.post("/api/courses", response_model=CourseResponse, status_code=201)
@@ -2179,6 +4442,7 @@ async def create_course(
     )
     session.add(course)
     await session.commit()
+    course_catalog.invalidate_course(course.id)
     await session.refresh(course)
 
     return _course_to_response(course)
@@ -2203,6 +4467,7 @@ async def update_course(
     course.updated_at = datetime.now()
 
     await session.commit()
+    course_catalog.invalidate_course(course_id)
     await session.refresh(course)
     return _course_to_response(course)
 
@@ -2228,9 +4493,11 @@ async def delete_course(
             )
         )
     )
+    await session.execute(delete(CoursePartSection).where(CoursePartSection.part_id.in_(parts_subquery)))
     await session.execute(delete(CoursePart).where(CoursePart.course_id == course_id))
     await session.delete(course)
     await session.commit()
+    course_catalog.invalidate_course(course_id)
 
     return {"message": "Курс удалён"}
 
@@ -2263,7 +4530,9 @@ async def create_course_part(
     )
 
     session.add(part)
+    session.add_all(build_part_sections(part.id, part.content))
     await session.commit()
+    course_catalog.invalidate_parts(course_id)
     await session.refresh(part)
 
     return _course_part_to_response(part, has_access=True, include_content=True)
@@ -2287,8 +4556,12 @@ async def update_course_part(
     for key, value in update_data.items():
         setattr(part, key, value)
     part.updated_at = datetime.now()
+    if "content" in update_data:
+        await session.execute(delete(CoursePartSection).where(CoursePartSection.part_id == part.id))
+        session.add_all(build_part_sections(part.id, part.content))
 
     await session.commit()
+    course_catalog.invalidate_parts(course_id)
     await session.refresh(part)
 
     return _course_part_to_response(part, has_access=True, include_content=True)
@@ -2308,22 +4581,23 @@ async def delete_course_part(
         raise HTTPException(status_code=404, detail="Раздел не найден")
 
     await session.execute(delete(Purchase).where(Purchase.part_id == part_id))
+    await session.execute(delete(CoursePartSection).where(CoursePartSection.part_id == part_id))
     await session.delete(part)
     await session.commit()
+    course_catalog.invalidate_parts(course_id)
 
     return {"message": "Раздел удалён"}
 
 
-@app.get("/api/courses/{course_id}/parts/{part_id}/content", response_model=CoursePartContentResponse)
-async def get_course_part_content(
+async def _get_readable_part(
+    session: AsyncSession,
     course_id: str,
     part_id: str,
-    current_user: User = Depends(get_current_user_model),
-    session: AsyncSession = Depends(get_session),
-) -> dict[str, Any]:
-    await ensure_db_connection(session)
-
-    part = await session.get(CoursePart, part_id)
+    current_user: User,
+    with_content: bool = False,
+) -> CoursePart:
+    options = [] if with_content else [defer(CoursePart.content)]
+    part = await session.get(CoursePart, part_id, options=options)
     if not part or part.course_id != course_id:
         raise HTTPException(status_code=404, detail="Раздел не найден")
 
@@ -2335,18 +4609,109 @@ async def get_course_part_content(
     )
     if not has_access:
         raise HTTPException(status_code=403, detail="Требуется покупка")
+    return part
+
+
+async def _stream_part_sections(part_id: str):
+    async with async_session_factory() as session:
+        chunks = await session.stream_scalars(
+            select(CoursePartSection.content)
+            .where(CoursePartSection.part_id == part_id)
+            .order_by(CoursePartSection.position.asc())
+            .execution_options(yield_per=4)
+        )
+        async for chunk in chunks:
+            yield chunk
+
+
+@app.get("/api/courses/{course_id}/parts/{part_id}/content", response_model=CoursePartContentResponse)
+async def get_course_part_content(
+    course_id: str,
+    part_id: str,
+    stream: bool = False,
+    current_user: User = Depends(get_current_user_model),
+    session: AsyncSession = Depends(get_session),
+) -> Any:
+    await ensure_db_connection(session)
+    part = await _get_readable_part(session, course_id, part_id, current_user, with_content=not stream)
 
+    if stream:
+        # Raw Markdown, written section by section as it is read.
+        return StreamingResponse(_stream_part_sections(part.id), media_type="text/markdown; charset=utf-8")
     return _course_part_to_response(part, has_access=True, include_content=True)
 
 
+@app.get("/api/courses/{course_id}/parts/{part_id}/toc", response_model=CoursePartTocResponse)
+async def get_course_part_toc(
+    course_id: str,
+    part_id: str,
+    current_user: User = Depends(get_current_user_model),
+    session: AsyncSession = Depends(get_session),
+) -> dict[str, Any]:
+    await ensure_db_connection(session)
+    part = await _get_readable_part(session, course_id, part_id, current_user)
+
+    result = await session.execute(
+        select(CoursePartSection)
+        .options(defer(CoursePartSection.content))
+        .where(CoursePartSection.part_id == part.id)
+        .order_by(CoursePartSection.position.asc())
+    )
+    sections = result.scalars().all()
+    first_section = None
+    if sections:
+        first = await session.scalar(
+            select(CoursePartSection.content).where(
+                CoursePartSection.part_id == part.id,
+                CoursePartSection.position == sections[0].position,
+            )
+        )
+        first_section = {**_section_to_response(sections[0]), "content": first or ""}
+
+    payload = _course_part_to_response(part, has_access=True)
+    payload["total_chars"] = sum(int(section.char_count) for section in sections)
+    payload["sections"] = [_section_to_response(section) for section in sections]
+    payload["first_section"] = first_section
+    return payload
+
+
+@app.get(
+    "/api/courses/{course_id}/parts/{part_id}/sections/{position}",
+    response_model=CoursePartSectionResponse,
+)
+async def get_course_part_section(
+    course_id: str,
+    part_id: str,
+    position: int,
+    current_user: User = Depends(get_current_user_model),
+    session: AsyncSession = Depends(get_session),
+) -> dict[str, Any]:
+    await ensure_db_connection(session)
+    part = await _get_readable_part(session, course_id, part_id, current_user)
+
+    section = await session.get(CoursePartSection, (part.id, position))
+    if not section:
+        raise HTTPException(status_code=404, detail="Секция не найдена")
+    return _section_to_response(section, include_content=True)
+
+
 @app.post("/api/courses/{course_id}/purchase", response_model=PurchaseWithSbpResponse)
 async def purchase_course(
     course_id: str,
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key"),
     current_user: User = Depends(get_current_user_model),
     session: AsyncSession = Depends(get_session),
 ) -> dict[str, Any]:
     await ensure_db_connection(session)
+    return await purchase_idempotency.run(
+        current_user.id,
+        idempotency_key,
+        f"course:{course_id}",
+        lambda: _create_course_purchase(session, current_user, course_id),
+    )
+
 
+async def _create_course_purchase(session: AsyncSession, current_user: User, course_id: str) -> dict[str, Any]:
     result = await session.execute(
         select(Course).where(
             Course.id == course_id,
@@ -2357,15 +4722,8 @@ async def purchase_course(
     if not course:
         raise HTTPException(status_code=404, detail="Курс не найден")
 
-    existing = await session.execute(
-        select(Purchase).where(
-            Purchase.user_id == current_user.id,
-            Purchase.course_id == course.id,
-            Purchase.part_id.is_(None),
-            Purchase.status.in_(["pending", "completed"]),
-        )
-    )
-    if existing.scalar_one_or_none():
+    entitlements = await entitlement_cache.get(session, current_user.id)
+    if course.id in entitlements.course_ids:
         raise HTTPException(
             status_code=400,
             detail="Уже существует активная или завершённая покупка",
@@ -2385,9 +4743,13 @@ async def purchase_course(
         sbp_comment=sbp_comment,
         created_at=datetime.now(),
     )
-    session.add(purchase)
+    if not await _insert_active_purchase(session, purchase):
+        raise HTTPException(
+            status_code=400,
+            detail="Уже существует активная или завершённая покупка",
+        )
     await session.commit()
-    await session.refresh(purchase)
+    entitlement_cache.invalidate(current_user.id)
 
     sbp_payload = _build_sbp_details(amount, sbp_comment) if sbp_comment else None
     return {
@@ -2400,11 +4762,25 @@ async def purchase_course(
 async def purchase_course_part(
     course_id: str,
     part_id: str,
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key"),
     current_user: User = Depends(get_current_user_model),
     session: AsyncSession = Depends(get_session),
 ) -> dict[str, Any]:
     await ensure_db_connection(session)
+    return await purchase_idempotency.run(
+        current_user.id,
+        idempotency_key,
+        f"part:{course_id}:{part_id}",
+        lambda: _create_part_purchase(session, current_user, course_id, part_id),
+    )
+
 
+async def _create_part_purchase(
+    session: AsyncSession,
+    current_user: User,
+    course_id: str,
+    part_id: str,
+) -> dict[str, Any]:
     part_result = await session.execute(
         select(CoursePart).where(
             CoursePart.id == part_id,
@@ -2415,30 +4791,10 @@ async def purchase_course_part(
     if not part:
         raise HTTPException(status_code=404, detail="Раздел не найден")
 
-    course_purchase_result = await session.execute(
-        select(Purchase).where(
-            Purchase.user_id == current_user.id,
-            Purchase.course_id == course_id,
-            Purchase.part_id.is_(None),
-            Purchase.status == "completed",
-        )
-    )
-    if course_purchase_result.scalar_one_or_none():
+    entitlements = await entitlement_cache.get(session, current_user.id)
+    if course_id in entitlements.course_ids:
         raise HTTPException(status_code=400, detail="У вас уже есть доступ через покупку курса")
 
-    part_purchase_result = await session.execute(
-        select(Purchase).where(
-            Purchase.user_id == current_user.id,
-            Purchase.part_id == part_id,
-            Purchase.status.in_(["pending", "completed"]),
-        )
-    )
-    if part_purchase_result.scalar_one_or_none():
-        raise HTTPException(
-            status_code=400,
-            detail="Уже существует активная или завершённая покупка",
-        )
-
     amount = int(part.price)
     should_complete = amount == 0 or part.is_preview
     sbp_comment = None if should_complete else f"PRT-{uuid.uuid4().hex[:8].upper()}"
@@ -2453,10 +4809,13 @@ async def purchase_course_part(
         sbp_comment=sbp_comment,
         created_at=datetime.now(),
     )
-
-    session.add(purchase)
+    if not await _insert_active_purchase(session, purchase):
+        raise HTTPException(
+            status_code=400,
+            detail="Уже существует активная или завершённая покупка",
+        )
     await session.commit()
-    await session.refresh(purchase)
+    entitlement_cache.invalidate(current_user.id)
 
     sbp_payload = _build_sbp_details(amount, sbp_comment) if sbp_comment else None
     return {
@@ -2480,43 +4839,376 @@ async def get_my_purchases(
     return [_purchase_to_response(purchase) for purchase in purchases]
 
 
-@app.get("/api/admin/purchases", response_model=list[AdminPurchaseResponse])
-async def get_admin_purchases(
-    status: str | None = None,
-    current_user: dict[str, Any] = Depends(get_current_admin),
-    session: AsyncSession = Depends(get_session),
-) -> list[dict[str, Any]]:
-    await ensure_db_connection(session)
-
+def _admin_purchase_filters(
+    status: str | None,
+    created_from: datetime | None,
+    created_to: datetime | None,
+    user_id: str | None,
+) -> list[Any]:
     if status is not None and status not in VALID_PURCHASE_STATUSES:
         raise HTTPException(status_code=400, detail="Недопустимый статус")
 
+    # Purchases store naive local time, so aware bounds are converted to match.
+    created_from, created_to = (
+        value.astimezone().replace(tzinfo=None) if value is not None and value.tzinfo else value
+        for value in (created_from, created_to)
+    )
+
+    conditions: list[Any] = []
+    if status is not None:
+        conditions.append(Purchase.status == status)
+    if created_from is not None:
+        conditions.append(Purchase.created_at >= created_from)
+    if created_to is not None:
+        conditions.append(Purchase.created_at < created_to)
+    if user_id:
+        conditions.append(Purchase.user_id == user_id)
+    return conditions
+
+
+async def _admin_course_targets(session: AsyncSession, course_id: str | None) -> list[Any] | None:
+    """Purchase targets that belong to a course: the course itself and each of its parts.
+
+    Part purchases carry no course_id, so they are matched through the course's parts.
+    """
+    if not course_id:
+        return None
+    part_ids = (await session.execute(select(CoursePart.id).where(CoursePart.course_id == course_id))).scalars()
+    return [Purchase.course_id == course_id, *(Purchase.part_id == part_id for part_id in part_ids)]
+
+
+def _admin_purchases_query(conditions: list[Any], targets: list[Any] | None = None, limit: int | None = None):
+    order = (Purchase.created_at.desc(), Purchase.id.desc())
+    if targets is not None:
+        # An OR across course_id and part_id cannot walk either index in created_at
+        # order, so each target gets its own keyset query on its (target, created_at, id)
+        # index and only the merged heads are sorted.
+        branches = []
+        for target in targets:
+            branch = select(Purchase.id).where(target, *conditions).order_by(*order)
+            if limit is not None:
+                branch = branch.limit(limit)
+            head = branch.subquery()
+            branches.append(select(head.c.id))
+        conditions = [Purchase.id.in_(union_all(*branches))]
+
     query = (
-        select(Purchase, User, Course, CoursePart)
+        select(Purchase, User.username, Course.title, CoursePart.title)
         .select_from(Purchase)
         .outerjoin(User, Purchase.user_id == User.id)
         .outerjoin(Course, Purchase.course_id == Course.id)
         .outerjoin(CoursePart, Purchase.part_id == CoursePart.id)
-        .order_by(Purchase.created_at.desc())
+        .where(*conditions)
+        .order_by(*order)
     )
-    if status is not None:
-        query = query.where(Purchase.status == status)
+    return query if limit is None else query.limit(limit)
 
-    result = await session.execute(query)
-    rows = result.all()
 
-    payload: list[dict[str, Any]] = []
-    for purchase, user, course, part in rows:
-        payload.append(
-            _admin_purchase_to_response(
-                purchase=purchase,
-                username=user.username if user else "Удалённый пользователь",
-                course_title=course.title if course else None,
-                part_title=part.title if part else None,
+def _admin_purchase_row_to_response(row) -> dict[str, Any]:
+    purchase, username, course_title, part_title = row
+    return _admin_purchase_to_response(
+        purchase=purchase,
+        username=username or "Удалённый пользователь",
+        course_title=course_title,
+        part_title=part_title,
+    )
+
+
+@app.get("/api/admin/purchases", response_model=AdminPurchasePageResponse)
+async def get_admin_purchases(
+    status: str | None = None,
+    created_from: datetime | None = None,
+    created_to: datetime | None = None,
+    course_id: str | None = None,
+    user_id: str | None = None,
+    before: str | None = None,
+    limit: int = ADMIN_PURCHASES_PAGE_SIZE,
+    current_user: dict[str, Any] = Depends(get_current_admin),
+    session: AsyncSession = Depends(get_session),
+) -> dict[str, Any]:
+    await ensure_db_connection(session)
+
+    conditions = _admin_purchase_filters(status, created_from, created_to, user_id)
+    targets = await _admin_course_targets(session, course_id)
+    if before:
+        cursor_created_at, cursor_id = _decode_cursor(before)
+        conditions.append(
+            or_(
+                Purchase.created_at < cursor_created_at,
+                and_(Purchase.created_at == cursor_created_at, Purchase.id < cursor_id),
             )
         )
 
-    return payload
+    safe_limit = min(max(limit, 1), MAX_ADMIN_PURCHASES_PAGE_SIZE)
+    result = await session.execute(_admin_purchases_query(conditions, targets, safe_limit + 1))
+    rows = result.all()
+
+    next_cursor = None
+    if len(rows) > safe_limit:
+        rows = rows[:safe_limit]
+        last = rows[-1][0]
+        next_cursor = _encode_cursor(last.created_at, last.id)
+
+    return {
+        "purchases": [_admin_purchase_row_to_response(row) for row in rows],
+        "next_cursor": next_cursor,
+    }
+
+
+_CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _csv_cell(value: Any) -> Any:
+    # Usernames and titles are user-controlled; a leading quote keeps spreadsheets
+    # from evaluating something like =HYPERLINK(...) as a formula.
+    if value is None:
+        return ""
+    if isinstance(value, str) and value.startswith(_CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+async def _stream_admin_purchases(conditions: list[Any], course_id: str | None, export_format: str):
+    # A fresh session: the request-scoped one is closed before the body is sent.
+    async with async_session_factory() as session:
+        targets = await _admin_course_targets(session, course_id)
+        rows = await session.stream(
+            _admin_purchases_query(conditions, targets).execution_options(yield_per=ADMIN_PURCHASES_EXPORT_BATCH)
+        )
+        if export_format == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            # The BOM makes Excel read the Cyrillic titles as UTF-8.
+            writer.writerow(ADMIN_PURCHASES_EXPORT_COLUMNS)
+            yield "\ufeff" + buffer.getvalue()
+            async for row in rows:
+                buffer.seek(0)
+                buffer.truncate()
+                item = _admin_purchase_row_to_response(row)
+                writer.writerow([_csv_cell(item[column]) for column in ADMIN_PURCHASES_EXPORT_COLUMNS])
+                yield buffer.getvalue()
+        else:
+            async for row in rows:
+                item = _admin_purchase_row_to_response(row)
+                yield _json_bytes({column: item[column] for column in ADMIN_PURCHASES_EXPORT_COLUMNS}) + b"\n"
+
+
+@app.get("/api/admin/purchases/export")
+async def export_admin_purchases(
+    format: str = "csv",
+    status: str | None = None,
+    created_from: datetime | None = None,
+    created_to: datetime | None = None,
+    course_id: str | None = None,
+    user_id: str | None = None,
+    current_user: dict[str, Any] = Depends(get_current_admin),
+) -> StreamingResponse:
+    media_types = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+    if format not in media_types:
+        raise HTTPException(status_code=400, detail="Недопустимый формат экспорта")
+
+    conditions = _admin_purchase_filters(status, created_from, created_to, user_id)
+    filename = f"purchases-{datetime.now():%Y%m%d-%H%M%S}.{format}"
+    return StreamingResponse(
+        _stream_admin_purchases(conditions, course_id, format),
+        media_type=media_types[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def _parse_statement_amount(raw: str) -> Decimal | None:
+    cleaned = re.sub(r"[\s\u00a0₽]|руб\.?|rub", "", raw, flags=re.IGNORECASE).replace(",", ".")
+    try:
+        return Decimal(cleaned)
+    except InvalidOperation:
+        return None
+
+
+class _StatementSizeLimit(io.RawIOBase):
+    """Counts bytes read from the uploaded statement and stops at SBP_STATEMENT_MAX_BYTES."""
+
+    def __init__(self, stream: BinaryIO, max_bytes: int):
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.consumed = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.stream.read(len(buffer))
+        self.consumed += len(data)
+        if self.consumed > self.max_bytes:
+            raise HTTPException(status_code=413, detail="Файл выписки слишком большой")
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def read_sbp_statement(
+    stream: BinaryIO,
+    max_bytes: int = SBP_STATEMENT_MAX_BYTES,
+) -> tuple[list[tuple[int, str, Decimal | None]], int]:
+    """Reads (row number, SBP reference, amount) from a bank statement CSV row by row.
+
+    The reference is looked for anywhere in the row, since banks put the payment
+    comment in differently named columns; the amount comes from the first column
+    whose header looks like one. UTF-8 and Windows-1251 exports are both accepted.
+    Blocking: call it from a worker thread.
+    """
+    head = stream.read(65536)
+    stream.seek(0)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError:
+        encoding = "cp1251"
+
+    limited = io.BufferedReader(_StatementSizeLimit(stream, max_bytes))
+    text_stream = io.TextIOWrapper(limited, encoding=encoding, errors="replace", newline="")
+    try:
+        dialect = csv.Sniffer().sniff(head[:4096].decode(encoding, errors="replace"), delimiters=";,\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(text_stream, dialect)
+
+    header = [cell.strip().lower() for cell in next(reader, [])]
+    amount_index = next(
+        (index for index, cell in enumerate(header) if any(name in cell for name in SBP_AMOUNT_HEADERS)),
+        None,
+    )
+    if amount_index is None:
+        raise HTTPException(status_code=400, detail="В выписке не найдена колонка с суммой")
+
+    payments: list[tuple[int, str, Decimal | None]] = []
+    skipped = 0
+    for row_number, row in enumerate(reader, start=2):
+        references = SBP_REFERENCE_PATTERN.findall(" ".join(row).upper())
+        if not references:
+            skipped += 1
+            continue
+        amount = _parse_statement_amount(row[amount_index]) if amount_index < len(row) else None
+        payments.append((row_number, references[0], amount))
+    text_stream.detach()
+    return payments, skipped
+
+
+async def reconcile_sbp_payments(
+    session: AsyncSession,
+    payments: list[tuple[int, str, Decimal | None]],
+    apply: bool = True,
+) -> dict[str, Any]:
+    """Matches statement rows to purchases by sbp_comment and amount.
+
+    Every pending purchase paid in full is completed in one transaction; anything
+    else is reported for manual review and left untouched.
+    """
+    report: dict[str, list[dict[str, Any]]] = {
+        "completed": [],
+        "already_completed": [],
+        "cancelled": [],
+        "amount_mismatch": [],
+        "not_found": [],
+        "duplicates": [],
+    }
+    by_reference: dict[str, tuple[int, Decimal | None]] = {}
+    for row_number, reference, amount in payments:
+        if reference in by_reference:
+            report["duplicates"].append({"row": row_number, "sbp_comment": reference})
+            continue
+        by_reference[reference] = (row_number, amount)
+
+    purchases: dict[str, Purchase] = {}
+    references = list(by_reference)
+    for start in range(0, len(references), SBP_RECONCILE_BATCH):
+        result = await session.execute(
+            select(Purchase).where(Purchase.sbp_comment.in_(references[start:start + SBP_RECONCILE_BATCH]))
+        )
+        for purchase in result.scalars():
+            purchases[purchase.sbp_comment] = purchase
+
+    to_complete: list[Purchase] = []
+    for reference, (row_number, amount) in by_reference.items():
+        entry: dict[str, Any] = {
+            "row": row_number,
+            "sbp_comment": reference,
+            "paid": str(amount) if amount is not None else None,
+        }
+        purchase = purchases.get(reference)
+        if purchase is None:
+            report["not_found"].append(entry)
+            continue
+
+        entry.update(purchase_id=purchase.id, amount=int(purchase.amount))
+        if purchase.status == "completed":
+            report["already_completed"].append(entry)
+        elif purchase.status == "cancelled":
+            report["cancelled"].append(entry)
+        elif amount is None or amount != Decimal(int(purchase.amount)):
+            report["amount_mismatch"].append(entry)
+        else:
+            report["completed"].append(entry)
+            to_complete.append(purchase)
+
+    if apply and to_complete:
+        purchase_ids = [purchase.id for purchase in to_complete]
+        completed_ids: set[str] = set()
+        for start in range(0, len(purchase_ids), SBP_RECONCILE_BATCH):
+            result = await session.execute(
+                update(Purchase)
+                .where(
+                    Purchase.id.in_(purchase_ids[start:start + SBP_RECONCILE_BATCH]),
+                    Purchase.status == "pending",
+                )
+                .values(status="completed")
+                .returning(Purchase.id)
+                .execution_options(synchronize_session=False)
+            )
+            completed_ids.update(result.scalars())
+        await session.commit()
+
+        # Purchases an admin completed or cancelled between the SELECT and the UPDATE
+        # were not touched; report them under their current status instead.
+        raced_ids = [purchase_id for purchase_id in purchase_ids if purchase_id not in completed_ids]
+        if raced_ids:
+            current_status: dict[str, str] = {}
+            for start in range(0, len(raced_ids), SBP_RECONCILE_BATCH):
+                result = await session.execute(
+                    select(Purchase.id, Purchase.status).where(
+                        Purchase.id.in_(raced_ids[start:start + SBP_RECONCILE_BATCH])
+                    )
+                )
+                current_status.update((purchase_id, purchase_status) for purchase_id, purchase_status in result)
+            raced = [entry for entry in report["completed"] if entry["purchase_id"] not in completed_ids]
+            report["completed"] = [entry for entry in report["completed"] if entry["purchase_id"] in completed_ids]
+            for entry in raced:
+                bucket = {"completed": "already_completed", "cancelled": "cancelled"}.get(
+                    current_status.get(entry["purchase_id"]), "not_found"
+                )
+                report[bucket].append(entry)
+
+        for user_id in {purchase.user_id for purchase in to_complete if purchase.id in completed_ids}:
+            entitlement_cache.invalidate(user_id)
+
+    return {
+        "applied": apply,
+        "summary": {key: len(entries) for key, entries in report.items()},
+        **report,
+    }
+
+
+@app.post("/api/admin/purchases/reconcile")
+async def reconcile_sbp_statement(
+    file: UploadFile = File(...),
+    dry_run: bool = Form(False),
+    current_user: dict[str, Any] = Depends(get_current_admin),
+    session: AsyncSession = Depends(get_session),
+) -> dict[str, Any]:
+    await ensure_db_connection(session)
+    # Decoding and parsing a large statement would otherwise stall every socket on the loop.
+    payments, skipped = await run_in_threadpool(read_sbp_statement, file.file)
+    report = await reconcile_sbp_payments(session, payments, apply=not dry_run)
+    report["summary"]["skipped_rows"] = skipped
+    return report
 
 
 @app.put("/api/admin/purchases/{purchase_id}/status", response_model=PurchaseResponse)
@@ -2536,7 +5228,16 @@ async def update_purchase_status(
         raise HTTPException(status_code=404, detail="Покупка не найдена")
 
     purchase.status = status
-    await session.commit()
+    try:
+        await session.commit()
+    except IntegrityError:
+        # Reopening a cancelled purchase would collide with a newer active one.
+        await session.rollback()
+        raise HTTPException(
+            status_code=400,
+            detail="У пользователя уже есть активная покупка этого курса или раздела",
+        )
+    entitlement_cache.invalidate(purchase.user_id)
     await session.refresh(purchase)
 
     return _purchase_to_response(purchase)
@@ -2545,4 +5246,4 @@ async def update_purchase_status(
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    uvicorn.run(app, host="0.0.0.0", port=8001, ws_per_message_deflate=True, ws_max_size=WS_MAX_SIZE_BYTES)
@@ -0,0 +1,613 @@
+import asyncio
+import json
+import os
+import signal
+import tempfile
+import time
+import unittest
+import uuid
+from datetime import datetime, timedelta
+from unittest import mock
+
+import uvicorn
+import websockets
+from sqlalchemy import delete, event, func, select
+
+DB_FD, DB_PATH = tempfile.mkstemp(prefix="mydefaultsite-chat-test-", suffix=".db")
+os.close(DB_FD)
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_PATH}"
+
+from fastapi import WebSocketDisconnect  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from backend.database import (  # noqa: E402
+    ChatMessage,
+    ChatMessageArchive,
+    Course,
+    Purchase,
+    User,
+    async_session_factory,
+    engine,
+)
+import backend.server as server_module  # noqa: E402
+from backend.server import (  # noqa: E402
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    CHAT_MAX_FRAME_BYTES,
+    CHAT_SUBPROTOCOL_MSGPACK,
+    ChatDedupeCache,
+    ChatRateLimiter,
+    ConnectionManager,
+    PresenceTracker,
+    app,
+    archive_old_chat_messages,
+    compact_chat_storage,
+    create_access_token,
+    drain_websockets,
+    get_password_hash,
+    msgpack,
+)
+
+
+def receive_non_presence(websocket, decode=None) -> dict:
+    # Presence diffs are flushed on a timer and may interleave with any other frame.
+    while True:
+        frame = decode(websocket.receive_bytes()) if decode else websocket.receive_json()
+        if frame["type"] != "presence":
+            return frame
+
+
+class RecordingWebSocket:
+    def __init__(self):
+        self.frames: list[str] = []
+
+    async def send_text(self, data: str) -> None:
+        self.frames.append(data)
+
+
+class ChatApiTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._client_context = TestClient(app)
+        cls.client = cls._client_context.__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._client_context.__exit__(None, None, None)
+        asyncio.run(engine.dispose())
+        if os.path.exists(DB_PATH):
+            os.remove(DB_PATH)
+
+    def setUp(self):
+        asyncio.run(self._reset_database())
+
+    @staticmethod
+    async def _reset_database():
+        async with async_session_factory() as session:
+            await session.execute(delete(Purchase))
+            await session.execute(delete(Course))
+            await session.execute(delete(ChatMessage))
+            await session.execute(delete(ChatMessageArchive))
+            await session.execute(delete(User))
+            await session.commit()
+
+    @staticmethod
+    async def _create_user(username: str) -> User:
+        async with async_session_factory() as session:
+            user = User(
+                id=str(uuid.uuid4()),
+                username=username,
+                email=f"{username}@example.com",
+                password_hash=get_password_hash("password123"),
+                role="user",
+                created_at=datetime.now(),
+            )
+            session.add(user)
+            await session.commit()
+            return user
+
+    @staticmethod
+    async def _create_chat_messages(user: User, count: int, timestamp: datetime) -> None:
+        async with async_session_factory() as session:
+            for index in range(count):
+                session.add(
+                    ChatMessage(
+                        id=str(uuid.uuid4()),
+                        user_id=user.id,
+                        username=user.username,
+                        message=f"message {index}",
+                        # Every third message shares a timestamp to exercise the id tiebreak.
+                        timestamp=timestamp + timedelta(seconds=index // 3),
+                    )
+                )
+            await session.commit()
+
+    @staticmethod
+    async def _create_course(title: str) -> Course:
+        async with async_session_factory() as session:
+            course = Course(
+                id=str(uuid.uuid4()),
+                title=title,
+                price=1000,
+                is_published=True,
+                created_at=datetime.now(),
+                updated_at=datetime.now(),
+            )
+            session.add(course)
+            await session.commit()
+            return course
+
+    @staticmethod
+    async def _grant_course(user: User, course: Course) -> None:
+        async with async_session_factory() as session:
+            session.add(
+                Purchase(
+                    id=str(uuid.uuid4()),
+                    user_id=user.id,
+                    course_id=course.id,
+                    amount=course.price,
+                    status="completed",
+                    created_at=datetime.now(),
+                )
+            )
+            await session.commit()
+
+    @staticmethod
+    def _auth_headers(user_id: str) -> dict[str, str]:
+        token = create_access_token(
+            {"sub": user_id},
+            expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
+        )
+        return {"Authorization": f"Bearer {token}"}
+
+    def test_chat_history_keyset_pagination(self):
+        user = asyncio.run(self._create_user("alice"))
+        asyncio.run(self._create_chat_messages(user, 25, datetime(2024, 1, 1, 12, 0, 0)))
+        headers = self._auth_headers(user.id)
+
+        seen: list[str] = []
+        cursor = None
+        pages = 0
+        while True:
+            params = {"limit": 10}
+            if cursor:
+                params["before"] = cursor
+            response = self.client.get("/api/chat/messages", headers=headers, params=params)
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            pages += 1
+            timestamps = [item["timestamp"] for item in page["messages"]]
+            self.assertEqual(timestamps, sorted(timestamps))
+            seen = [item["id"] for item in page["messages"]] + seen
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(len(set(seen)), 25)
+
+    def test_retention_archives_old_messages_and_keeps_history_reachable(self):
+        user = asyncio.run(self._create_user("alice"))
+        asyncio.run(self._create_chat_messages(user, 10, datetime.now() - timedelta(days=60)))
+        asyncio.run(self._create_chat_messages(user, 5, datetime.now() - timedelta(minutes=5)))
+
+        archived = asyncio.run(archive_old_chat_messages(retention_days=30, batch_size=3))
+        self.assertEqual(archived, 10)
+
+        statements: list[str] = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine.sync_engine, "before_cursor_execute", record)
+        try:
+            asyncio.run(compact_chat_storage(archived))
+            self.assertNotIn("VACUUM", statements)
+            # Only the archive script asks for a VACUUM.
+            asyncio.run(compact_chat_storage(0, vacuum=True))
+            self.assertIn("VACUUM", statements)
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", record)
+
+        async def count_rows(model) -> int:
+            async with async_session_factory() as session:
+                return (await session.execute(select(func.count()).select_from(model))).scalar_one()
+
+        self.assertEqual(asyncio.run(count_rows(ChatMessage)), 5)
+        self.assertEqual(asyncio.run(count_rows(ChatMessageArchive)), 10)
+
+        headers = self._auth_headers(user.id)
+        seen: list[str] = []
+        cursor = None
+        while True:
+            params = {"limit": 4}
+            if cursor:
+                params["before"] = cursor
+            page = self.client.get("/api/chat/messages", headers=headers, params=params).json()
+            seen = [item["id"] for item in page["messages"]] + seen
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+
+        self.assertEqual(len(seen), 15)
+        self.assertEqual(len(set(seen)), 15)
+
+    def test_chat_history_rejects_invalid_cursor(self):
+        user = asyncio.run(self._create_user("alice"))
+        response = self.client.get(
+            "/api/chat/messages",
+            headers=self._auth_headers(user.id),
+            params={"before": "not-a-cursor"},
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_broadcast_encodes_frame_once(self):
+        async def run_broadcast() -> list[RecordingWebSocket]:
+            manager = ConnectionManager()
+            sockets = [RecordingWebSocket() for _ in range(3)]
+            for index, websocket in enumerate(sockets):
+                await manager.connect(websocket, f"user-{index}", f"user{index}")
+            await manager.broadcast({"type": "message", "data": {"message": "привет"}})
+            return sockets
+
+        sockets = asyncio.run(run_broadcast())
+        frames = [websocket.frames[0] for websocket in sockets]
+        self.assertTrue(all(frame is frames[0] for frame in frames))
+        self.assertEqual(json.loads(frames[0])["data"]["message"], "привет")
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_chat_websocket_negotiates_msgpack(self):
+        user = asyncio.run(self._create_user("alice"))
+        token = self._auth_headers(user.id)["Authorization"].split(" ", 1)[1]
+
+        with self.client.websocket_connect(
+            f"/api/ws/chat?token={token}",
+            subprotocols=[CHAT_SUBPROTOCOL_MSGPACK],
+        ) as websocket:
+            self.assertEqual(websocket.accepted_subprotocol, CHAT_SUBPROTOCOL_MSGPACK)
+            history = msgpack.unpackb(websocket.receive_bytes(), raw=False)
+            self.assertEqual(history["type"], "history")
+
+            websocket.send_bytes(msgpack.packb({"message": "hello"}, use_bin_type=True))
+            frame = receive_non_presence(websocket, lambda data: msgpack.unpackb(data, raw=False))
+            self.assertEqual(frame["type"], "message")
+            self.assertEqual(frame["data"]["message"], "hello")
+
+    def test_chat_websocket_defaults_to_json(self):
+        user = asyncio.run(self._create_user("alice"))
+        token = self._auth_headers(user.id)["Authorization"].split(" ", 1)[1]
+
+        with self.client.websocket_connect(f"/api/ws/chat?token={token}") as websocket:
+            self.assertIsNone(websocket.accepted_subprotocol)
+            self.assertEqual(websocket.receive_json()["type"], "history")
+
+    def test_course_rooms_require_access(self):
+        user = asyncio.run(self._create_user("alice"))
+        course = asyncio.run(self._create_course("Python"))
+        headers = self._auth_headers(user.id)
+        course_room = f"course:{course.id}"
+
+        rooms = self.client.get("/api/chat/rooms", headers=headers).json()
+        self.assertNotIn(course_room, [room["id"] for room in rooms])
+        denied = self.client.get("/api/chat/messages", headers=headers, params={"room": course_room})
+        self.assertEqual(denied.status_code, 403)
+
+        asyncio.run(self._grant_course(user, course))
+
+        rooms = self.client.get("/api/chat/rooms", headers=headers).json()
+        self.assertIn(course_room, [room["id"] for room in rooms])
+        allowed = self.client.get("/api/chat/messages", headers=headers, params={"room": course_room})
+        self.assertEqual(allowed.status_code, 200)
+
+    def test_messages_fan_out_only_to_their_room(self):
+        alice = asyncio.run(self._create_user("alice"))
+        bob = asyncio.run(self._create_user("bob"))
+        token_a = self._auth_headers(alice.id)["Authorization"].split(" ", 1)[1]
+        token_b = self._auth_headers(bob.id)["Authorization"].split(" ", 1)[1]
+
+        with self.client.websocket_connect(f"/api/ws/chat?token={token_a}&room=general") as socket_a, \
+                self.client.websocket_connect(f"/api/ws/chat?token={token_b}&room=offtopic") as socket_b:
+            self.assertEqual(socket_a.receive_json()["type"], "history")
+            self.assertEqual(socket_b.receive_json()["room"], "offtopic")
+
+            socket_a.send_json({"message": "in general"})
+            self.assertEqual(receive_non_presence(socket_a)["data"]["message"], "in general")
+
+            socket_b.send_json({"message": "in offtopic"})
+            frame = receive_non_presence(socket_b)
+            self.assertEqual(frame["data"]["message"], "in offtopic")
+            self.assertEqual(frame["data"]["room"], "offtopic")
+
+    def test_presence_coalesces_tabs_and_reconnects(self):
+        tracker = PresenceTracker()
+        tracker.add("general", "u1", "alice")
+        tracker.add("general", "u1", "alice")
+        tracker.add("general", "u2", "bob")
+        self.assertEqual(tracker.drain(), {"general": {"joined": ["alice", "bob"], "left": []}})
+
+        # Closing one of two tabs is invisible; a reconnect inside one window cancels out.
+        tracker.remove("general", "u1")
+        tracker.remove("general", "u2")
+        tracker.add("general", "u2", "bob")
+        self.assertEqual(tracker.drain(), {})
+
+        tracker.remove("general", "u1")
+        self.assertEqual(tracker.drain(), {"general": {"joined": [], "left": ["alice"]}})
+        self.assertEqual(tracker.online("general"), [{"user_id": "u2", "username": "bob"}])
+        self.assertEqual(tracker.usernames, {"u2": "bob"})
+
+    def test_online_endpoint_and_presence_frame(self):
+        user = asyncio.run(self._create_user("alice"))
+        headers = self._auth_headers(user.id)
+        token = headers["Authorization"].split(" ", 1)[1]
+
+        with self.client.websocket_connect(f"/api/ws/chat?token={token}") as websocket:
+            history = websocket.receive_json()
+            self.assertEqual(history["online"], [{"user_id": user.id, "username": "alice"}])
+
+            online = self.client.get("/api/chat/online", headers=headers).json()
+            self.assertEqual(online["count"], 1)
+            self.assertEqual(online["users"][0]["username"], "alice")
+
+            presence_frame = websocket.receive_json()
+            self.assertEqual(presence_frame["type"], "presence")
+            self.assertEqual(presence_frame["joined"], ["alice"])
+            self.assertEqual(presence_frame["online_count"], 1)
+
+        self.assertEqual(self.client.get("/api/chat/online", headers=headers).json()["count"], 0)
+
+    def test_reaper_drops_silent_and_idle_connections(self):
+        async def run_reap() -> tuple[list, list]:
+            manager = ConnectionManager()
+            alive, silent, idle = RecordingWebSocket(), RecordingWebSocket(), RecordingWebSocket()
+            for index, websocket in enumerate((alive, silent, idle)):
+                await manager.connect(websocket, f"user-{index}", f"user{index}")
+
+            now = time.monotonic()
+            manager.by_socket[silent]["last_seen"] = now - 120
+            manager.by_socket[idle]["last_active"] = now - 600
+            # A pong keeps the socket alive but does not count as activity.
+            manager.touch(idle, active=False)
+
+            reaped = manager.reap_stale(dead_before=now - 60, idle_before=now - 300)
+            return reaped, [conn["websocket"] for conn in manager.active_connections]
+
+        reaped, remaining = asyncio.run(run_reap())
+        self.assertEqual(len(reaped), 2)
+        self.assertEqual(len(remaining), 1)
+
+    def test_pong_frames_are_not_persisted(self):
+        user = asyncio.run(self._create_user("alice"))
+        token = self._auth_headers(user.id)["Authorization"].split(" ", 1)[1]
+
+        with self.client.websocket_connect(f"/api/ws/chat?token={token}") as websocket:
+            self.assertEqual(websocket.receive_json()["type"], "history")
+            websocket.send_json({"type": "pong"})
+            websocket.send_json({"message": "hello"})
+            self.assertEqual(receive_non_presence(websocket)["data"]["message"], "hello")
+
+        page = self.client.get("/api/chat/messages", headers=self._auth_headers(user.id)).json()
+        self.assertEqual([item["message"] for item in page["messages"]], ["hello"])
+
+    def test_rate_limiter_delays_then_drops(self):
+        limiter = ChatRateLimiter(user_rate=1, user_burst=2, ip_rate=100, ip_burst=100)
+        self.assertEqual(limiter.reserve("u1", "10.0.0.1"), 0)
+        self.assertEqual(limiter.reserve("u1", "10.0.0.1"), 0)
+        self.assertGreater(limiter.reserve("u1", "10.0.0.1", max_wait=5), 0)
+        self.assertIsNone(limiter.reserve("u1", "10.0.0.1", max_wait=0.1))
+        # Another user behind the same address has its own bucket.
+        self.assertEqual(limiter.reserve("u2", "10.0.0.1"), 0)
+        self.assertEqual(limiter.counters["delayed"], 1)
+        self.assertEqual(limiter.counters["dropped"], 1)
+
+    def test_flooding_client_is_throttled(self):
+        user = asyncio.run(self._create_user("alice"))
+        token = self._auth_headers(user.id)["Authorization"].split(" ", 1)[1]
+        original = server_module.chat_rate_limiter
+        server_module.chat_rate_limiter = ChatRateLimiter(user_rate=0.01, user_burst=1)
+
+        try:
+            with self.client.websocket_connect(f"/api/ws/chat?token={token}") as websocket:
+                self.assertEqual(websocket.receive_json()["type"], "history")
+                websocket.send_json({"message": "first"})
+                self.assertEqual(receive_non_presence(websocket)["data"]["message"], "first")
+                websocket.send_json({"message": "second"})
+                self.assertEqual(receive_non_presence(websocket)["code"], "rate_limited")
+            self.assertEqual(server_module.chat_rate_limiter.counters["dropped"], 1)
+        finally:
+            server_module.chat_rate_limiter = original
+
+    def test_pong_flood_is_charged_to_the_control_bucket(self):
+        user = asyncio.run(self._create_user("alice"))
+        token = self._auth_headers(user.id)["Authorization"].split(" ", 1)[1]
+        original = server_module.chat_rate_limiter
+        server_module.chat_rate_limiter = ChatRateLimiter(control_rate=0.01, control_burst=2)
+
+        try:
+            with self.client.websocket_connect(f"/api/ws/chat?token={token}") as websocket:
+                self.assertEqual(websocket.receive_json()["type"], "history")
+                for _ in range(2 + server_module.CHAT_FLOOD_MAX_STRIKES):
+                    websocket.send_json({"type": "pong"})
+                with self.assertRaises(WebSocketDisconnect) as closed:
+                    receive_non_presence(websocket)
+                self.assertEqual(closed.exception.code, 1008)
+
+            counters = server_module.chat_rate_limiter.counters
+            self.assertEqual(counters["control"], 2)
+            self.assertEqual(counters["control_dropped"], server_module.CHAT_FLOOD_MAX_STRIKES)
+            self.assertEqual(counters["accepted"], 0)
+        finally:
+            server_module.chat_rate_limiter = original
+
+    def test_retransmitted_client_id_is_acked_once_and_stored_once(self):
+        user = asyncio.run(self._create_user("alice"))
+        token = self._auth_headers(user.id)["Authorization"].split(" ", 1)[1]
+        frame = {"message": "only once", "client_id": str(uuid.uuid4())}
+
+        with self.client.websocket_connect(f"/api/ws/chat?token={token}") as websocket:
+            self.assertEqual(websocket.receive_json()["type"], "history")
+            websocket.send_json(frame)
+            ack = receive_non_presence(websocket)
+            self.assertEqual(ack["type"], "ack")
+            self.assertEqual(ack["client_id"], frame["client_id"])
+            echo = receive_non_presence(websocket)
+            self.assertEqual(echo["data"]["id"], ack["id"])
+            self.assertEqual(echo["client_id"], frame["client_id"])
+
+        # The client reconnects without knowing whether the first send was stored.
+        with self.client.websocket_connect(f"/api/ws/chat?token={token}") as websocket:
+            history = websocket.receive_json()
+            self.assertEqual([item["message"] for item in history["messages"]], ["only once"])
+            websocket.send_json(frame)
+            retry_ack = receive_non_presence(websocket)
+            self.assertEqual(retry_ack["id"], ack["id"])
+            self.assertTrue(retry_ack["duplicate"])
+
+        async def count_messages() -> int:
+            async with async_session_factory() as session:
+                return (await session.execute(select(func.count()).select_from(ChatMessage))).scalar_one()
+
+        self.assertEqual(asyncio.run(count_messages()), 1)
+
+    def _send_twice_during_rate_limit_wait(self, fail_first_commit: bool) -> tuple[dict, list[str]]:
+        user = asyncio.run(self._create_user("alice"))
+        token = self._auth_headers(user.id)["Authorization"].split(" ", 1)[1]
+        frame = {"message": "slow", "client_id": str(uuid.uuid4())}
+        waits = iter([0.5])
+        failed: list[str] = []
+
+        def fail_first_insert(conn, cursor, statement, parameters, context, executemany):
+            if fail_first_commit and not failed and statement.startswith("INSERT INTO chat_messages"):
+                failed.append(statement)
+                raise RuntimeError("simulated write failure")
+
+        event.listen(engine.sync_engine, "before_cursor_execute", fail_first_insert)
+        try:
+            with mock.patch.object(
+                server_module.chat_rate_limiter, "reserve", side_effect=lambda *args: next(waits, 0.0)
+            ), self.client.websocket_connect(f"/api/ws/chat?token={token}") as first, \
+                    self.client.websocket_connect(f"/api/ws/chat?token={token}") as second:
+                self.assertEqual(first.receive_json()["type"], "history")
+                self.assertEqual(second.receive_json()["type"], "history")
+                first.send_json(frame)
+                time.sleep(0.1)
+                # The first send is still waiting for a rate-limit token when the retransmit arrives.
+                second.send_json(frame)
+                in_progress = receive_non_presence(second)
+                self.assertEqual(in_progress["code"], "in_progress")
+                self.assertTrue(in_progress["retry"])
+
+                time.sleep(0.7)
+                second.send_json(frame)
+                # The original's broadcast may reach this socket before the ack.
+                retry_ack = receive_non_presence(second)
+                while retry_ack["type"] == "message":
+                    retry_ack = receive_non_presence(second)
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", fail_first_insert)
+
+        async def stored_ids() -> list[str]:
+            async with async_session_factory() as session:
+                return list((await session.execute(select(ChatMessage.id))).scalars())
+
+        # Only committed ids are ever acked, and the message is stored exactly once.
+        self.assertEqual(asyncio.run(stored_ids()), [retry_ack["id"]])
+        return retry_ack, failed
+
+    def test_retransmit_during_rate_limit_wait_is_not_stored_twice(self):
+        retry_ack, _ = self._send_twice_during_rate_limit_wait(fail_first_commit=False)
+        self.assertTrue(retry_ack["duplicate"])
+
+    def test_retransmit_is_stored_when_the_pending_original_fails(self):
+        retry_ack, failed = self._send_twice_during_rate_limit_wait(fail_first_commit=True)
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(retry_ack["type"], "ack")
+        self.assertNotIn("duplicate", retry_ack)
+
+    def test_dedupe_cache_expires_old_entries(self):
+        cache = ChatDedupeCache(window_seconds=60, max_entries=2)
+        cache.put("u1", "a", "m1")
+        cache.put("u1", "b", "m2")
+        cache.put("u1", "c", "m3")
+        self.assertIsNone(cache.get("u1", "a"))
+        self.assertEqual(cache.get("u1", "c"), "m3")
+
+        cache.entries[("u1", "b")] = ("m2", time.monotonic() - 120)
+        cache.entries.move_to_end(("u1", "b"), last=False)
+        self.assertIsNone(cache.get("u1", "b"))
+
+    def test_oversized_frame_is_rejected_before_parsing(self):
+        user = asyncio.run(self._create_user("alice"))
+        token = self._auth_headers(user.id)["Authorization"].split(" ", 1)[1]
+
+        with self.client.websocket_connect(f"/api/ws/chat?token={token}") as websocket:
+            self.assertEqual(websocket.receive_json()["type"], "history")
+            websocket.send_text("x" * (CHAT_MAX_FRAME_BYTES + 1))
+            with self.assertRaises(WebSocketDisconnect) as closed:
+                receive_non_presence(websocket)
+            self.assertEqual(closed.exception.code, 1009)
+
+    def test_drain_sends_reconnect_hint_and_refuses_new_sockets(self):
+        user = asyncio.run(self._create_user("alice"))
+        token = self._auth_headers(user.id)["Authorization"].split(" ", 1)[1]
+
+        try:
+            with self.client.websocket_connect(f"/api/ws/chat?token={token}") as websocket:
+                self.assertEqual(websocket.receive_json()["type"], "history")
+                self.client.portal.call(drain_websockets)
+
+                hint = receive_non_presence(websocket)
+                self.assertEqual(hint["type"], "reconnect")
+                self.assertGreaterEqual(hint["retry_after_ms"], 0)
+                with self.assertRaises(WebSocketDisconnect) as closed:
+                    receive_non_presence(websocket)
+                self.assertEqual(closed.exception.code, 1012)
+
+            with self.client.websocket_connect(f"/api/ws/chat?token={token}") as websocket:
+                with self.assertRaises(WebSocketDisconnect) as refused:
+                    websocket.receive_json()
+                self.assertEqual(refused.exception.code, 1013)
+        finally:
+            server_module._websockets_draining = False
+
+    def test_sigterm_drains_sockets_before_uvicorn_closes_them(self):
+        user = asyncio.run(self._create_user("alice"))
+        token = self._auth_headers(user.id)["Authorization"].split(" ", 1)[1]
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning"))
+        frames: list[dict] = []
+
+        async def connect_and_terminate() -> int | None:
+            while not server.started:
+                await asyncio.sleep(0.01)
+            port = server.servers[0].sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://127.0.0.1:{port}/api/ws/chat?token={token}") as websocket:
+                frames.append(json.loads(await websocket.recv()))
+                signal.raise_signal(signal.SIGTERM)
+                try:
+                    async for raw in websocket:
+                        frames.append(json.loads(raw))
+                except websockets.ConnectionClosed:
+                    pass
+                return websocket.close_code
+
+        async def run() -> int | None:
+            serving = asyncio.create_task(server.serve())
+            close_code = await connect_and_terminate()
+            await serving
+            return close_code
+
+        # Uvicorn re-raises the captured signal on exit; keep it from killing the test run.
+        previous_handler = signal.signal(signal.SIGTERM, lambda *args: None)
+        try:
+            close_code = asyncio.run(run())
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+            server_module._websockets_draining = False
+
+        self.assertEqual(frames[0]["type"], "history")
+        self.assertIn("reconnect", [frame["type"] for frame in frames[1:]])
+        self.assertEqual(close_code, 1012)
+
+
+if __name__ == "__main__":
+    unittest.main()
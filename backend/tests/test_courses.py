@@ -0,0 +1,590 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import tempfile
+import unittest
+import uuid
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import delete, event, text
+
+DB_FD, DB_PATH = tempfile.mkstemp(prefix="mydefaultsite-test-", suffix=".db")
+os.close(DB_FD)
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_PATH}"
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from backend.database import (  # noqa: E402
+    Course,
+    CoursePart,
+    CoursePartSection,
+    Purchase,
+    User,
+    async_session_factory,
+    engine,
+    init_models,
+    is_unique_index_built,
+)
+from fastapi import HTTPException  # noqa: E402
+
+from backend.server import (  # noqa: E402
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    _insert_active_purchase,
+    app,
+    course_catalog,
+    create_access_token,
+    entitlement_cache,
+    get_password_hash,
+    purchase_idempotency,
+    read_sbp_statement,
+    reconcile_sbp_payments,
+    split_markdown_sections,
+)
+
+
+@contextmanager
+def count_queries():
+    statements: list[str] = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record)
+
+
+class CourseApiTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._client_context = TestClient(app)
+        cls.client = cls._client_context.__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._client_context.__exit__(None, None, None)
+        asyncio.run(engine.dispose())
+        if os.path.exists(DB_PATH):
+            os.remove(DB_PATH)
+
+    def setUp(self):
+        asyncio.run(self._reset_database())
+        entitlement_cache.clear()
+        course_catalog.clear()
+        purchase_idempotency.clear()
+
+    @staticmethod
+    async def _reset_database():
+        async with async_session_factory() as session:
+            await session.execute(delete(Purchase))
+            await session.execute(delete(CoursePartSection))
+            await session.execute(delete(CoursePart))
+            await session.execute(delete(Course))
+            await session.execute(delete(User))
+            await session.commit()
+
+    @staticmethod
+    async def _create_user(username: str, role: str = "user") -> User:
+        async with async_session_factory() as session:
+            user = User(
+                id=str(uuid.uuid4()),
+                username=username,
+                email=f"{username}@example.com",
+                password_hash=get_password_hash("password123"),
+                role=role,
+                created_at=datetime.now(),
+            )
+            session.add(user)
+            await session.commit()
+            return user
+
+    @staticmethod
+    async def _create_course(part_count: int, price: int = 1000) -> tuple[Course, list[CoursePart]]:
+        async with async_session_factory() as session:
+            course = Course(id=str(uuid.uuid4()), title="Курс", price=price, is_published=True)
+            parts = [
+                CoursePart(
+                    id=str(uuid.uuid4()),
+                    course_id=course.id,
+                    title=f"Часть {index}",
+                    content=f"Содержимое {index}",
+                    price=100,
+                    order=index,
+                    is_preview=index == 0,
+                )
+                for index in range(part_count)
+            ]
+            session.add(course)
+            session.add_all(parts)
+            await session.commit()
+            return course, parts
+
+    @staticmethod
+    async def _add_purchase(
+        user_id: str,
+        status: str,
+        course_id: str | None = None,
+        part_id: str | None = None,
+        created_at: datetime | None = None,
+        amount: int = 100,
+    ) -> Purchase:
+        async with async_session_factory() as session:
+            purchase = Purchase(
+                id=str(uuid.uuid4()),
+                user_id=user_id,
+                course_id=course_id,
+                part_id=part_id,
+                amount=amount,
+                status=status,
+                sbp_comment=f"PRT-{uuid.uuid4().hex[:8].upper()}",
+                created_at=created_at or datetime.now(),
+            )
+            session.add(purchase)
+            await session.commit()
+        # Written behind the API, so the cached entitlements have to be dropped by hand.
+        entitlement_cache.invalidate(user_id)
+        return purchase
+
+    @staticmethod
+    def _auth_headers(user_id: str) -> dict[str, str]:
+        token = create_access_token(
+            {"sub": user_id},
+            expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
+        )
+        return {"Authorization": f"Bearer {token}"}
+
+    def test_course_detail_resolves_entitlements_in_one_query(self):
+        reader = asyncio.run(self._create_user("reader"))
+        headers = self._auth_headers(reader.id)
+        small_course, _ = asyncio.run(self._create_course(2))
+        course, parts = asyncio.run(self._create_course(40))
+        asyncio.run(self._add_purchase(reader.id, "completed", part_id=parts[3].id))
+        asyncio.run(self._add_purchase(reader.id, "pending", part_id=parts[4].id))
+
+        with count_queries() as small:
+            self.client.get(f"/api/courses/{small_course.id}", headers=headers)
+        entitlement_cache.clear()
+        with count_queries() as large:
+            response = self.client.get(f"/api/courses/{course.id}", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(large), len(small))
+
+        access = [part["has_access"] for part in response.json()["parts"]]
+        self.assertEqual([index for index, allowed in enumerate(access) if allowed], [0, 3])
+
+        asyncio.run(self._add_purchase(reader.id, "completed", course_id=course.id))
+        response = self.client.get(f"/api/courses/{course.id}", headers=headers)
+        self.assertTrue(all(part["has_access"] for part in response.json()["parts"]))
+
+        anonymous = self.client.get(f"/api/courses/{course.id}").json()
+        self.assertEqual([part["has_access"] for part in anonymous["parts"]].count(True), 1)
+
+    def test_part_content_requires_completed_purchase(self):
+        reader = asyncio.run(self._create_user("reader"))
+        headers = self._auth_headers(reader.id)
+        course, parts = asyncio.run(self._create_course(3))
+        url = f"/api/courses/{course.id}/parts/{parts[1].id}/content"
+
+        self.assertEqual(self.client.get(url, headers=headers).status_code, 403)
+        asyncio.run(self._add_purchase(reader.id, "completed", part_id=parts[1].id))
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["content"], "Содержимое 1")
+
+    def test_reader_flips_parts_from_cached_entitlements(self):
+        reader = asyncio.run(self._create_user("reader"))
+        admin = asyncio.run(self._create_user("admin", role="admin"))
+        headers = self._auth_headers(reader.id)
+        course, parts = asyncio.run(self._create_course(5))
+        for part in parts[1:4]:
+            asyncio.run(self._add_purchase(reader.id, "completed", part_id=part.id))
+
+        self.client.get(f"/api/courses/{course.id}", headers=headers)
+        with count_queries() as statements:
+            for part in parts[:4]:
+                response = self.client.get(f"/api/courses/{course.id}/parts/{part.id}/content", headers=headers)
+                self.assertEqual(response.status_code, 200)
+        self.assertFalse([statement for statement in statements if "FROM purchases" in statement])
+
+        # Buying through the API and approving the payment are visible immediately.
+        url = f"/api/courses/{course.id}/parts/{parts[4].id}/content"
+        self.assertEqual(self.client.get(url, headers=headers).status_code, 403)
+        purchase = self.client.post(f"/api/courses/{course.id}/parts/{parts[4].id}/purchase", headers=headers).json()
+        self.assertEqual(self.client.get(url, headers=headers).status_code, 403)
+        approved = self.client.put(
+            f"/api/admin/purchases/{purchase['purchase']['id']}/status",
+            headers=self._auth_headers(admin.id),
+            params={"status": "completed"},
+        )
+        self.assertEqual(approved.status_code, 200)
+        self.assertEqual(self.client.get(url, headers=headers).status_code, 200)
+
+    def test_catalog_is_served_from_snapshot_with_etag(self):
+        admin = asyncio.run(self._create_user("admin", role="admin"))
+        admin_headers = self._auth_headers(admin.id)
+        course, _ = asyncio.run(self._create_course(2))
+
+        first = self.client.get("/api/courses")
+        self.assertEqual([item["id"] for item in first.json()], [course.id])
+        etag = first.headers["etag"]
+        with count_queries() as statements:
+            again = self.client.get("/api/courses")
+        self.assertEqual(statements, [])
+        self.assertEqual(again.content, first.content)
+        self.assertEqual(self.client.get("/api/courses", headers={"If-None-Match": etag}).status_code, 304)
+
+        self.client.put(f"/api/courses/{course.id}", headers=admin_headers, json={"title": "Новый курс"})
+        renamed = self.client.get("/api/courses", headers={"If-None-Match": etag})
+        self.assertEqual(renamed.status_code, 200)
+        self.assertEqual(renamed.json()[0]["title"], "Новый курс")
+
+        # Part writes refresh the detail snapshot.
+        self.client.get(f"/api/courses/{course.id}")
+        self.client.post(
+            f"/api/courses/{course.id}/parts",
+            headers=admin_headers,
+            json={"title": "Бонус", "order": 5, "is_preview": True},
+        )
+        detail = self.client.get(f"/api/courses/{course.id}").json()
+        self.assertEqual([part["title"] for part in detail["parts"]][-1], "Бонус")
+        self.assertTrue(detail["parts"][-1]["has_access"])
+
+    def test_markdown_sections_split_at_headings_outside_code(self):
+        content = "Вступление\n\n# Глава\nтекст\n```\n# комментарий\n```\n### Подраздел\n## Итоги\nконец\n"
+        sections = split_markdown_sections(content)
+
+        self.assertEqual([section["title"] for section in sections], ["", "Глава", "Итоги"])
+        self.assertEqual([section["anchor"] for section in sections], ["intro", "глава", "итоги"])
+        self.assertEqual("".join(section["content"] for section in sections), content)
+
+    def test_long_part_is_served_as_toc_sections_and_stream(self):
+        admin = asyncio.run(self._create_user("admin", role="admin"))
+        reader = asyncio.run(self._create_user("reader"))
+        admin_headers = self._auth_headers(admin.id)
+        course, _ = asyncio.run(self._create_course(0))
+        chapters = "".join(f"# Глава {index}\n" + "Абзац текста.\n\n" * 2000 for index in range(3))
+        part = self.client.post(
+            f"/api/courses/{course.id}/parts",
+            headers=admin_headers,
+            json={"title": "Книга", "content": chapters, "price": 100},
+        ).json()
+        base = f"/api/courses/{course.id}/parts/{part['id']}"
+
+        self.assertEqual(self.client.get(f"{base}/toc", headers=self._auth_headers(reader.id)).status_code, 403)
+
+        toc = self.client.get(f"{base}/toc", headers=admin_headers).json()
+        headings = [section["title"] for section in toc["sections"] if not section["is_continuation"]]
+        self.assertEqual(headings, ["Глава 0", "Глава 1", "Глава 2"])
+        self.assertGreater(len(toc["sections"]), 3)
+        self.assertEqual(toc["total_chars"], len(chapters))
+        self.assertLess(len(toc["first_section"]["content"]), len(chapters) // 2)
+
+        fetched = [
+            self.client.get(f"{base}/sections/{section['position']}", headers=admin_headers).json()["content"]
+            for section in toc["sections"]
+        ]
+        self.assertEqual("".join(fetched), chapters)
+        self.assertEqual(self.client.get(f"{base}/sections/999", headers=admin_headers).status_code, 404)
+
+        streamed = self.client.get(f"{base}/content", headers=admin_headers, params={"stream": "true"})
+        self.assertTrue(streamed.headers["content-type"].startswith("text/markdown"))
+        self.assertEqual(streamed.text, chapters)
+
+        self.client.put(base, headers=admin_headers, json={"content": "# Новая глава\nкоротко\n"})
+        toc = self.client.get(f"{base}/toc", headers=admin_headers).json()
+        self.assertEqual([section["title"] for section in toc["sections"]], ["Новая глава"])
+
+    def test_admin_purchases_page_by_keyset_filter_and_export(self):
+        admin = asyncio.run(self._create_user("admin", role="admin"))
+        buyer = asyncio.run(self._create_user("buyer"))
+        other = asyncio.run(self._create_user("other"))
+        headers = self._auth_headers(admin.id)
+        course, parts = asyncio.run(self._create_course(2))
+        other_course, _ = asyncio.run(self._create_course(1))
+        same_second = datetime(2026, 3, 1, 12, 0, 0)
+        expected = [
+            asyncio.run(self._add_purchase(buyer.id, "completed", course_id=course.id, created_at=same_second)).id,
+            asyncio.run(self._add_purchase(buyer.id, "pending", part_id=parts[1].id, created_at=same_second)).id,
+            asyncio.run(self._add_purchase(other.id, "pending", course_id=other_course.id, created_at=same_second)).id,
+            asyncio.run(self._add_purchase(other.id, "cancelled", part_id=parts[0].id, created_at=datetime(2026, 2, 1))).id,
+        ]
+
+        def listing(**params) -> dict:
+            response = self.client.get("/api/admin/purchases", headers=headers, params=params)
+            self.assertEqual(response.status_code, 200)
+            return response.json()
+
+        seen: list[str] = []
+        page = listing(limit=3)
+        while True:
+            seen.extend(item["id"] for item in page["purchases"])
+            if not page["next_cursor"]:
+                break
+            page = listing(limit=3, before=page["next_cursor"])
+        self.assertEqual(sorted(seen[:3], reverse=True), seen[:3])
+        self.assertEqual(sorted(seen), sorted(expected))
+        self.assertEqual(seen[3], expected[3])
+
+        self.assertEqual(len(listing(status="pending")["purchases"]), 2)
+        self.assertEqual(len(listing(course_id=course.id)["purchases"]), 3)
+        self.assertEqual(len(listing(user_id=other.id, created_from="2026-02-15T00:00:00")["purchases"]), 1)
+        self.assertEqual(self.client.get("/api/admin/purchases", headers=headers, params={"status": "x"}).status_code, 400)
+
+        export = self.client.get(
+            "/api/admin/purchases/export", headers=headers, params={"format": "csv", "course_id": course.id}
+        )
+        self.assertEqual(export.status_code, 200)
+        lines = export.text.lstrip("\ufeff").splitlines()
+        self.assertTrue(lines[0].startswith("id,created_at,status"))
+        self.assertEqual(len(lines), 4)
+
+        export = self.client.get("/api/admin/purchases/export", headers=headers, params={"format": "ndjson"})
+        self.assertEqual(len(export.text.splitlines()), 4)
+        self.assertEqual(self.client.get("/api/admin/purchases/export", headers=self._auth_headers(buyer.id)).status_code, 403)
+
+    def test_admin_purchases_course_filter_walks_target_indexes(self):
+        admin = asyncio.run(self._create_user("admin", role="admin"))
+        buyer = asyncio.run(self._create_user("buyer"))
+        course, parts = asyncio.run(self._create_course(2))
+        asyncio.run(self._add_purchase(buyer.id, "pending", course_id=course.id))
+        asyncio.run(self._add_purchase(buyer.id, "pending", part_id=parts[0].id))
+
+        captured: list[tuple] = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if "UNION ALL" in statement:
+                captured.append((statement, parameters))
+
+        event.listen(engine.sync_engine, "before_cursor_execute", record)
+        try:
+            response = self.client.get(
+                "/api/admin/purchases",
+                headers=self._auth_headers(admin.id),
+                params={"course_id": course.id, "limit": 1},
+            )
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", record)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(captured), 1)
+
+        async def query_plan() -> list[tuple]:
+            statement, parameters = captured[0]
+            async with engine.connect() as conn:
+                result = await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+                return [tuple(row) for row in result]
+
+        plan = asyncio.run(query_plan())
+        details = " ".join(row[3] for row in plan)
+        self.assertIn("ix_purchases_course_created_id", details)
+        self.assertEqual(details.count("ix_purchases_part_created_id"), 2)
+        # Each branch reads its index in order; only the merged heads are sorted.
+        self.assertEqual([row[1] for row in plan if "TEMP B-TREE" in row[3]], [0])
+
+    def test_csv_export_neutralizes_formula_cells(self):
+        admin = asyncio.run(self._create_user("admin", role="admin"))
+        attacker = asyncio.run(self._create_user('=HYPERLINK("http://evil.example","x")'))
+        course, _ = asyncio.run(self._create_course(1))
+        asyncio.run(self._add_purchase(attacker.id, "pending", course_id=course.id))
+
+        export = self.client.get(
+            "/api/admin/purchases/export", headers=self._auth_headers(admin.id), params={"format": "csv"}
+        )
+        row = next(csv.DictReader(io.StringIO(export.text.lstrip("\ufeff"))))
+        self.assertEqual(row["username"], '\'=HYPERLINK("http://evil.example","x")')
+        self.assertEqual(row["amount"], "100")
+
+        ndjson = self.client.get(
+            "/api/admin/purchases/export", headers=self._auth_headers(admin.id), params={"format": "ndjson"}
+        )
+        self.assertEqual(json.loads(ndjson.text.splitlines()[0])["username"], attacker.username)
+
+    def test_sbp_statement_reconciles_pending_purchases_in_bulk(self):
+        admin = asyncio.run(self._create_user("admin", role="admin"))
+        buyer = asyncio.run(self._create_user("buyer"))
+        headers = self._auth_headers(admin.id)
+        course, parts = asyncio.run(self._create_course(3))
+        paid = asyncio.run(self._add_purchase(buyer.id, "pending", course_id=course.id, amount=1500))
+        short = asyncio.run(self._add_purchase(buyer.id, "pending", part_id=parts[1].id, amount=300))
+        done = asyncio.run(self._add_purchase(buyer.id, "completed", part_id=parts[2].id))
+
+        statement = "\r\n".join([
+            "Дата;Сумма;Назначение платежа",
+            f"01.03.2026;1 500,00;Оплата курса {paid.sbp_comment.lower()}",
+            f"01.03.2026;200,00;{short.sbp_comment}",
+            f"02.03.2026;100;{done.sbp_comment}",
+            "02.03.2026;999;PRT-00000000",
+            f"03.03.2026;1500;повтор {paid.sbp_comment}",
+            "03.03.2026;50;Перевод без комментария",
+        ]).encode("cp1251")
+
+        def upload(**form) -> dict:
+            response = self.client.post(
+                "/api/admin/purchases/reconcile",
+                headers=headers,
+                files={"file": ("statement.csv", statement, "text/csv")},
+                data=form,
+            )
+            self.assertEqual(response.status_code, 200)
+            return response.json()
+
+        preview = upload(dry_run="true")
+        self.assertFalse(preview["applied"])
+        self.assertEqual(
+            preview["summary"],
+            {
+                "completed": 1,
+                "already_completed": 1,
+                "cancelled": 0,
+                "amount_mismatch": 1,
+                "not_found": 1,
+                "duplicates": 1,
+                "skipped_rows": 1,
+            },
+        )
+        content_url = f"/api/courses/{course.id}/parts/{parts[1].id}/content"
+        buyer_headers = self._auth_headers(buyer.id)
+        self.assertEqual(self.client.get(content_url, headers=buyer_headers).status_code, 403)
+
+        report = upload()
+        self.assertEqual([entry["purchase_id"] for entry in report["completed"]], [paid.id])
+        self.assertEqual(report["amount_mismatch"][0]["paid"], "200.00")
+        statuses = {
+            item["id"]: item["status"]
+            for item in self.client.get("/api/admin/purchases", headers=headers).json()["purchases"]
+        }
+        self.assertEqual(statuses, {paid.id: "completed", short.id: "pending", done.id: "completed"})
+        self.assertEqual(self.client.get(content_url, headers=buyer_headers).status_code, 200)
+
+        self.assertEqual(upload()["summary"]["already_completed"], 2)
+
+    def test_reconcile_reports_purchases_changed_mid_run_and_caps_size(self):
+        buyer = asyncio.run(self._create_user("buyer"))
+        course, parts = asyncio.run(self._create_course(3))
+        paid = asyncio.run(self._add_purchase(buyer.id, "pending", part_id=parts[1].id))
+        raced = asyncio.run(self._add_purchase(buyer.id, "pending", part_id=parts[2].id))
+        interfered: list[str] = []
+
+        def cancel_before_update(conn, cursor, statement, parameters, context, executemany):
+            # An admin cancels one purchase between the reconcile SELECT and its UPDATE.
+            if statement.startswith("UPDATE purchases SET status") and not interfered:
+                interfered.append(raced.id)
+                cursor.execute("UPDATE purchases SET status = 'cancelled' WHERE id = ?", (raced.id,))
+
+        async def reconcile() -> dict:
+            async with async_session_factory() as session:
+                payments = [(2, paid.sbp_comment, Decimal(100)), (3, raced.sbp_comment, Decimal(100))]
+                return await reconcile_sbp_payments(session, payments)
+
+        event.listen(engine.sync_engine, "before_cursor_execute", cancel_before_update)
+        try:
+            report = asyncio.run(reconcile())
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", cancel_before_update)
+        self.assertEqual([entry["purchase_id"] for entry in report["completed"]], [paid.id])
+        self.assertEqual([entry["purchase_id"] for entry in report["cancelled"]], [raced.id])
+        self.assertEqual(report["summary"]["completed"], 1)
+
+        statement = ("Сумма;Назначение\r\n" + "100;PRT-00000000\r\n" * 100).encode("utf-8")
+        with self.assertRaises(HTTPException) as too_large:
+            read_sbp_statement(io.BytesIO(statement), max_bytes=1024)
+        self.assertEqual(too_large.exception.status_code, 413)
+        self.assertEqual(len(read_sbp_statement(io.BytesIO(statement))[0]), 100)
+
+    def test_purchase_is_idempotent_and_unique_per_target(self):
+        buyer = asyncio.run(self._create_user("buyer"))
+        course, parts = asyncio.run(self._create_course(2))
+        headers = {**self._auth_headers(buyer.id), "Idempotency-Key": "checkout-1"}
+        url = f"/api/courses/{course.id}/purchase"
+
+        first = self.client.post(url, headers=headers)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()["purchase"]["status"], "pending")
+        replay = self.client.post(url, headers=headers)
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(replay.json(), first.json())
+
+        without_key = self.client.post(url, headers=self._auth_headers(buyer.id))
+        self.assertEqual(without_key.status_code, 400)
+        reused = self.client.post(f"/api/courses/{course.id}/parts/{parts[1].id}/purchase", headers=headers)
+        self.assertEqual(reused.status_code, 422)
+
+        async def race() -> list[bool]:
+            async def attempt() -> bool:
+                async with async_session_factory() as session:
+                    purchase = Purchase(
+                        id=str(uuid.uuid4()),
+                        user_id=buyer.id,
+                        part_id=parts[1].id,
+                        amount=100,
+                        status="pending",
+                        created_at=datetime.now(),
+                    )
+                    inserted = await _insert_active_purchase(session, purchase)
+                    await session.commit()
+                    return inserted
+
+            return await asyncio.gather(*(attempt() for _ in range(5)))
+
+        self.assertEqual(sorted(asyncio.run(race())), [False] * 4 + [True])
+        purchases = self.client.get("/api/me/purchases", headers=self._auth_headers(buyer.id)).json()
+        self.assertEqual(len(purchases), 2)
+
+    def test_purchases_stay_unique_when_the_index_could_not_be_built(self):
+        buyer = asyncio.run(self._create_user("buyer"))
+        other = asyncio.run(self._create_user("other"))
+        course, parts = asyncio.run(self._create_course(3))
+
+        async def drop_index() -> None:
+            async with engine.begin() as conn:
+                await conn.execute(text("DROP INDEX ux_purchases_active_part"))
+
+        async def race(part_id: str) -> list[bool]:
+            async def attempt() -> bool:
+                async with async_session_factory() as session:
+                    purchase = Purchase(
+                        id=str(uuid.uuid4()),
+                        user_id=buyer.id,
+                        part_id=part_id,
+                        amount=100,
+                        status="pending",
+                        created_at=datetime.now(),
+                    )
+                    inserted = await _insert_active_purchase(session, purchase)
+                    await session.commit()
+                    return inserted
+
+            return await asyncio.gather(*(attempt() for _ in range(5)))
+
+        asyncio.run(drop_index())
+        try:
+            # Duplicates written while the index was missing keep it from being rebuilt.
+            asyncio.run(self._add_purchase(other.id, "pending", part_id=parts[1].id))
+            asyncio.run(self._add_purchase(other.id, "pending", part_id=parts[1].id))
+            with redirect_stdout(io.StringIO()) as output:
+                asyncio.run(init_models())
+            self.assertIn("WARNING: unique index ux_purchases_active_part", output.getvalue())
+            self.assertFalse(is_unique_index_built("ux_purchases_active_part"))
+
+            url = f"/api/courses/{course.id}/parts/{parts[1].id}/purchase"
+            self.assertEqual(self.client.post(url, headers=self._auth_headers(buyer.id)).status_code, 200)
+            self.assertEqual(self.client.post(url, headers=self._auth_headers(buyer.id)).status_code, 400)
+            self.assertEqual(self.client.post(url, headers=self._auth_headers(other.id)).status_code, 400)
+            with count_queries() as statements:
+                self.assertEqual(sorted(asyncio.run(race(parts[2].id))), [False] * 4 + [True])
+            self.assertEqual(statements.count("BEGIN IMMEDIATE"), 5)
+            course_url = f"/api/courses/{course.id}/purchase"
+            self.assertEqual(self.client.post(course_url, headers=self._auth_headers(buyer.id)).status_code, 200)
+        finally:
+            asyncio.run(self._reset_database())
+            asyncio.run(init_models())
+        self.assertTrue(is_unique_index_built("ux_purchases_active_part"))
+
+
+if __name__ == "__main__":
+    unittest.main()
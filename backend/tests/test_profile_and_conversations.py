@@ -1,11 +1,17 @@
 import asyncio
+import io
+import json
 import os
 import tempfile
+import threading
+import time
 import unittest
 import uuid
+from contextlib import contextmanager, redirect_stdout
 from datetime import datetime, timedelta
+from unittest import mock
 
-from sqlalchemy import delete
+from sqlalchemy import delete, event
 
 DB_FD, DB_PATH = tempfile.mkstemp(prefix="mydefaultsite-test-", suffix=".db")
 os.close(DB_FD)
@@ -13,8 +19,40 @@ os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_PATH}"
 
 from fastapi.testclient import TestClient  # noqa: E402
 
-from backend.database import Conversation, DirectMessage, User, UserProfile, async_session_factory, engine  # noqa: E402
-from backend.server import ACCESS_TOKEN_EXPIRE_MINUTES, app, create_access_token, get_password_hash  # noqa: E402
+from backend.database import (  # noqa: E402
+    Conversation,
+    DirectMessage,
+    User,
+    UserProfile,
+    async_session_factory,
+    engine,
+    get_user_search_backend,
+    init_models,
+)
+from backend.server import (  # noqa: E402
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    _encode_cursor,
+    app,
+    create_access_token,
+    dm_manager,
+    get_password_hash,
+    repair_conversation_stats,
+    user_typeahead,
+)
+
+
+@contextmanager
+def count_queries():
+    statements: list[str] = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record)
 
 
 class ProfileAndConversationApiTests(unittest.TestCase):
@@ -99,6 +137,90 @@ class ProfileAndConversationApiTests(unittest.TestCase):
         self.assertEqual(final_profile["display_name"], "Alice Cooper")
         self.assertEqual(final_profile["privacy_dm"], "none")
 
+    def test_user_search_ranks_prefix_first_and_tolerates_typos(self):
+        searcher = asyncio.run(self._create_user("searcher"))
+        for username in ("malex", "alexander", "alex", "bob"):
+            asyncio.run(self._create_user(username))
+        headers = self._auth_headers(searcher.id)
+
+        bob_headers = self._auth_headers(self.client.get(
+            "/api/users/search", headers=headers, params={"q": "bob"}
+        ).json()[0]["id"])
+        self.client.put("/api/me/profile", headers=bob_headers, json={"display_name": "Alexis"})
+
+        def search(query: str) -> list[str]:
+            response = self.client.get("/api/users/search", headers=headers, params={"q": query})
+            self.assertEqual(response.status_code, 200)
+            return [item["username"] for item in response.json()]
+
+        self.assertEqual(search("alex"), ["alex", "alexander", "bob", "malex"])
+        self.assertEqual(search("al")[:2], ["alex", "alexander"])
+        self.assertIn("alexander", search("alexnader"))
+        self.assertEqual(search("xyzzy"), [])
+        self.assertNotIn("searcher", search("search"))
+
+        # Profile edits reach the index without any explicit reindexing.
+        self.client.put("/api/me/profile", headers=bob_headers, json={"display_name": "Zebra"})
+        self.assertEqual(search("zebr"), ["bob"])
+        self.assertNotIn("bob", search("alexis"))
+
+    def test_user_search_falls_back_to_like_without_fts5(self):
+        searcher = asyncio.run(self._create_user("searcher"))
+        for username in ("alexander", "bob"):
+            asyncio.run(self._create_user(username))
+        headers = self._auth_headers(searcher.id)
+
+        try:
+            with mock.patch("backend.database._sqlite_supports_fts5_trigram", return_value=False), \
+                    redirect_stdout(io.StringIO()) as output, count_queries() as statements:
+                asyncio.run(init_models())
+            self.assertIn("WARNING: SQLite lacks FTS5", output.getvalue())
+            self.assertFalse([statement for statement in statements if "fts5" in statement])
+            self.assertIsNone(get_user_search_backend())
+
+            response = self.client.get("/api/users/search", headers=headers, params={"q": "xande"})
+            self.assertEqual([item["username"] for item in response.json()], ["alexander"])
+        finally:
+            asyncio.run(init_models())
+        self.assertEqual(get_user_search_backend(), "fts5")
+
+    def test_typeahead_trie_serves_prefixes_and_follows_profile_edits(self):
+        searcher = asyncio.run(self._create_user("searcher"))
+        alex = asyncio.run(self._create_user("alex"))
+        for username in ("alexander", "malex", "zoeanna", "zorro", "zoe"):
+            asyncio.run(self._create_user(username))
+        asyncio.run(user_typeahead.rebuild())
+        headers = self._auth_headers(searcher.id)
+
+        def typeahead(query: str, **params) -> list[str]:
+            response = self.client.get("/api/users/typeahead", headers=headers, params={"q": query, **params})
+            self.assertEqual(response.status_code, 200)
+            return [item["username"] for item in response.json()]
+
+        self.assertEqual(typeahead("AL"), ["alex", "alexander"])
+        self.assertEqual(typeahead("al", limit=1), ["alex"])
+        self.assertEqual(typeahead("sea"), [])
+        # Shorter names rank first; key order only breaks ties in length.
+        self.assertEqual(typeahead("zo"), ["zoe", "zorro", "zoeanna"])
+
+        # Registration and profile edits update the trie in place.
+        self.client.post("/api/auth/register", json={"username": "alfred", "password": "password123"})
+        self.assertEqual(typeahead("alf"), ["alfred"])
+
+        self.client.put(
+            "/api/me/profile",
+            headers=self._auth_headers(alex.id),
+            json={"display_name": "Sasha Petrov", "privacy_dm": "none"},
+        )
+        self.assertEqual(typeahead("petr"), ["alex"])
+        self.assertEqual(typeahead("sasha p"), ["alex"])
+        self.assertEqual(typeahead("petr", dm_only="true"), [])
+        self.assertEqual(typeahead("al", dm_only="true"), ["alfred", "alexander"])
+
+        report = user_typeahead.memory_report()
+        self.assertEqual(report["users"], 8)
+        self.assertGreater(report["total_bytes"], 0)
+
     def test_conversations_list(self):
         user_a = asyncio.run(self._create_user("alice"))
         user_b = asyncio.run(self._create_user("bob"))
@@ -134,6 +256,321 @@ class ProfileAndConversationApiTests(unittest.TestCase):
         self.assertEqual(empty_list_response.status_code, 200)
         self.assertEqual(empty_list_response.json(), [])
 
+    def test_conversations_list_is_one_query_and_pages_by_activity(self):
+        owner = asyncio.run(self._create_user("owner"))
+        headers = self._auth_headers(owner.id)
+
+        def open_conversations(count: int) -> None:
+            for _ in range(count):
+                partner = asyncio.run(self._create_user(f"user{uuid.uuid4().hex[:8]}"))
+                conversation_id = self.client.post(
+                    "/api/conversations", headers=headers, json={"user_id": partner.id}
+                ).json()["id"]
+                self.client.post(
+                    f"/api/conversations/{conversation_id}/messages",
+                    headers=headers,
+                    json={"text": f"hi {partner.username}"},
+                )
+
+        open_conversations(2)
+        with count_queries() as small:
+            self.client.get("/api/me/conversations", headers=headers)
+        open_conversations(4)
+        with count_queries() as large:
+            listing = self.client.get("/api/me/conversations", headers=headers).json()
+        self.assertEqual(len(large), len(small))
+        self.assertEqual(len(listing), 6)
+        activity = [item["updated_at"] for item in listing]
+        self.assertEqual(activity, sorted(activity, reverse=True))
+
+        paged: list[str] = []
+        cursor = None
+        while True:
+            params = {"limit": 4}
+            if cursor:
+                params["before"] = cursor
+            page = self.client.get("/api/me/conversations", headers=headers, params=params).json()
+            paged += [item["id"] for item in page]
+            if len(page) < 4:
+                break
+            cursor = page[-1]["cursor"]
+        self.assertEqual(paged, [item["id"] for item in listing])
+
+    def test_conversation_messages_cursor_pages_both_ways_over_equal_timestamps(self):
+        user_a = asyncio.run(self._create_user("alice"))
+        user_b = asyncio.run(self._create_user("bob"))
+        headers_a = self._auth_headers(user_a.id)
+        conversation_id = self.client.post(
+            "/api/conversations", headers=headers_a, json={"user_id": user_b.id}
+        ).json()["id"]
+
+        async def insert_same_second(count: int) -> None:
+            created_at = datetime(2024, 1, 1, 12, 0, 0)
+            async with async_session_factory() as session:
+                for index in range(count):
+                    session.add(
+                        DirectMessage(
+                            id=str(uuid.uuid4()),
+                            conversation_id=conversation_id,
+                            sender_id=user_a.id,
+                            text=f"message {index}",
+                            created_at=created_at,
+                        )
+                    )
+                await session.commit()
+
+        asyncio.run(insert_same_second(7))
+        url = f"/api/conversations/{conversation_id}/messages"
+
+        backwards: list[str] = []
+        params = {"limit": 3}
+        while True:
+            page = self.client.get(url, headers=headers_a, params=params).json()
+            backwards = [item["id"] for item in page["messages"]] + backwards
+            if not page["next_cursor"]:
+                break
+            params = {"limit": 3, "before": page["next_cursor"]}
+        self.assertEqual(len(backwards), 7)
+        self.assertEqual(len(set(backwards)), 7)
+
+        forwards = [backwards[0]]
+        params = {"limit": 3, "after": self._cursor_for(backwards[0])}
+        while True:
+            page = self.client.get(url, headers=headers_a, params=params).json()
+            forwards += [item["id"] for item in page["messages"]]
+            params = {"limit": 3, "after": page["next_cursor"]}
+            if not page["has_more"]:
+                break
+        self.assertEqual(forwards, backwards)
+
+        # Caught up: an empty poll keeps the position, and the next one picks up new messages.
+        caught_up = self.client.get(url, headers=headers_a, params=params).json()
+        self.assertEqual(caught_up, {"messages": [], "next_cursor": params["after"], "has_more": False})
+        sent = self.client.post(url, headers=headers_a, json={"text": "newer"}).json()
+        polled = self.client.get(url, headers=headers_a, params=params).json()
+        self.assertEqual([item["id"] for item in polled["messages"]], [sent["id"]])
+        self.assertEqual(polled["next_cursor"], self._cursor_for(sent["id"]))
+
+        invalid = self.client.get(url, headers=headers_a, params={"before": "2024-01-01T12:00:00"})
+        self.assertEqual(invalid.status_code, 400)
+
+    @staticmethod
+    def _cursor_for(message_id: str) -> str:
+        async def load() -> DirectMessage:
+            async with async_session_factory() as session:
+                return await session.get(DirectMessage, message_id)
+
+        message = asyncio.run(load())
+        return _encode_cursor(message.created_at, message.id)
+
+    def test_unread_counters_follow_sends_and_mark_read(self):
+        user_a = asyncio.run(self._create_user("alice"))
+        user_b = asyncio.run(self._create_user("bob"))
+        headers_a = self._auth_headers(user_a.id)
+        headers_b = self._auth_headers(user_b.id)
+        conversation_id = self.client.post(
+            "/api/conversations", headers=headers_a, json={"user_id": user_b.id}
+        ).json()["id"]
+
+        for text in ("one", "two", "three"):
+            self.client.post(f"/api/conversations/{conversation_id}/messages", headers=headers_a, json={"text": text})
+
+        self.assertEqual(self.client.get("/api/me/unread", headers=headers_b).json(), {"total_unread": 3})
+        self.assertEqual(self.client.get("/api/me/unread", headers=headers_a).json(), {"total_unread": 0})
+        self.assertEqual(self.client.get("/api/me/conversations", headers=headers_b).json()[0]["unread_count"], 3)
+
+        read = self.client.post(f"/api/conversations/{conversation_id}/read", headers=headers_b)
+        self.assertEqual(read.status_code, 200)
+        self.assertEqual(read.json()["total_unread"], 0)
+
+        # Replying marks the conversation read for the sender and unread for the partner.
+        self.client.post(f"/api/conversations/{conversation_id}/messages", headers=headers_a, json={"text": "four"})
+        self.client.post(f"/api/conversations/{conversation_id}/messages", headers=headers_b, json={"text": "reply"})
+        self.assertEqual(self.client.get("/api/me/unread", headers=headers_b).json()["total_unread"], 0)
+        self.assertEqual(self.client.get("/api/me/unread", headers=headers_a).json()["total_unread"], 1)
+
+        # The repair job recomputes the same counters from the read markers.
+        asyncio.run(repair_conversation_stats())
+        self.assertEqual(self.client.get("/api/me/unread", headers=headers_a).json()["total_unread"], 1)
+        self.assertEqual(self.client.get("/api/me/unread", headers=headers_b).json()["total_unread"], 0)
+
+    def test_user_cards_are_cached_for_sends_and_invalidated_by_profile_updates(self):
+        user_a = asyncio.run(self._create_user("alice"))
+        user_b = asyncio.run(self._create_user("bob"))
+        headers_a = self._auth_headers(user_a.id)
+        conversation_id = self.client.post(
+            "/api/conversations", headers=headers_a, json={"user_id": user_b.id}
+        ).json()["id"]
+        url = f"/api/conversations/{conversation_id}/messages"
+        self.client.post(url, headers=headers_a, json={"text": "warm up"})
+
+        with count_queries() as statements:
+            sent = self.client.post(url, headers=headers_a, json={"text": "cached"})
+        self.assertEqual(sent.status_code, 200)
+        self.assertFalse([sql for sql in statements if "user_profiles" in sql])
+
+        self.client.put("/api/me/profile", headers=headers_a, json={"display_name": "Alice Cooper"})
+        messages = self.client.get(url, headers=headers_a).json()["messages"]
+        self.assertEqual(messages[-1]["display_name"], "Alice Cooper")
+
+        self.client.put("/api/me/profile", headers=self._auth_headers(user_b.id), json={"privacy_dm": "none"})
+        blocked = self.client.post(url, headers=headers_a, json={"text": "after opt-out"})
+        self.assertEqual(blocked.status_code, 403)
+
+    def test_repair_rebuilds_denormalized_conversation_stats(self):
+        user_a = asyncio.run(self._create_user("alice"))
+        user_b = asyncio.run(self._create_user("bob"))
+        headers_a = self._auth_headers(user_a.id)
+        conversation_id = self.client.post(
+            "/api/conversations", headers=headers_a, json={"user_id": user_b.id}
+        ).json()["id"]
+        self.client.post(f"/api/conversations/{conversation_id}/messages", headers=headers_a, json={"text": "first"})
+
+        async def insert_behind_the_api() -> None:
+            async with async_session_factory() as session:
+                session.add(
+                    DirectMessage(
+                        id=str(uuid.uuid4()),
+                        conversation_id=conversation_id,
+                        sender_id=user_b.id,
+                        text="imported",
+                        created_at=datetime.now() + timedelta(minutes=1),
+                    )
+                )
+                await session.commit()
+
+        asyncio.run(insert_behind_the_api())
+        stale = self.client.get("/api/me/conversations", headers=headers_a).json()[0]
+        self.assertEqual((stale["last_message"], stale["message_count"]), ("first", 1))
+
+        self.assertEqual(asyncio.run(repair_conversation_stats()), 1)
+        repaired = self.client.get("/api/me/conversations", headers=headers_a).json()[0]
+        self.assertEqual((repaired["last_message"], repaired["message_count"]), ("imported", 2))
+
+    def test_direct_messages_pushed_over_websocket(self):
+        user_a = asyncio.run(self._create_user("alice"))
+        user_b = asyncio.run(self._create_user("bob"))
+        headers_a = self._auth_headers(user_a.id)
+        token_b = self._auth_headers(user_b.id)["Authorization"].split(" ", 1)[1]
+
+        conversation_id = self.client.post(
+            "/api/conversations",
+            headers=headers_a,
+            json={"user_id": user_b.id},
+        ).json()["id"]
+
+        with self.client.websocket_connect(f"/api/ws/dm?token={token_b}") as websocket:
+            sync_frame = websocket.receive_json()
+            self.assertEqual(sync_frame["type"], "dm_sync")
+            self.assertEqual(sync_frame["messages"], [])
+
+            self.client.post(
+                f"/api/conversations/{conversation_id}/messages",
+                headers=headers_a,
+                json={"text": "first"},
+            )
+            dm_frame = websocket.receive_json()
+            self.assertEqual(dm_frame["type"], "dm")
+            self.assertEqual(dm_frame["data"]["text"], "first")
+            cursor = dm_frame["cursor"]
+
+        self.client.post(
+            f"/api/conversations/{conversation_id}/messages",
+            headers=headers_a,
+            json={"text": "second"},
+        )
+
+        with self.client.websocket_connect(f"/api/ws/dm?token={token_b}&since={cursor}") as websocket:
+            sync_frame = websocket.receive_json()
+            self.assertEqual(sync_frame["type"], "dm_sync")
+            self.assertEqual([item["text"] for item in sync_frame["messages"]], ["second"])
+
+    def test_direct_message_send_does_not_wait_for_slow_sockets(self):
+        user_a = asyncio.run(self._create_user("alice"))
+        user_b = asyncio.run(self._create_user("bob"))
+        headers_a = self._auth_headers(user_a.id)
+        conversation_id = self.client.post(
+            "/api/conversations",
+            headers=headers_a,
+            json={"user_id": user_b.id},
+        ).json()["id"]
+
+        class SlowSocket:
+            def __init__(self):
+                self.frames: list[str] = []
+
+            async def send_text(self, frame: str) -> None:
+                await asyncio.sleep(1)
+                self.frames.append(frame)
+
+        slow = SlowSocket()
+        dm_manager.connect(slow, user_b.id)
+        try:
+            started = time.monotonic()
+            for text in ("one", "two"):
+                response = self.client.post(
+                    f"/api/conversations/{conversation_id}/messages",
+                    headers=headers_a,
+                    json={"text": text},
+                )
+                self.assertEqual(response.status_code, 200)
+            self.assertLess(time.monotonic() - started, 1)
+
+            deadline = time.monotonic() + 5
+            while len(slow.frames) < 2 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            # Queued frames still reach the socket in send order.
+            self.assertEqual([json.loads(frame)["data"]["text"] for frame in slow.frames], ["one", "two"])
+        finally:
+            dm_manager.disconnect(slow, user_b.id)
+
+    def test_direct_message_long_poll_wakes_on_send(self):
+        user_a = asyncio.run(self._create_user("alice"))
+        user_b = asyncio.run(self._create_user("bob"))
+        headers_a = self._auth_headers(user_a.id)
+        headers_b = self._auth_headers(user_b.id)
+
+        conversation_id = self.client.post(
+            "/api/conversations",
+            headers=headers_a,
+            json={"user_id": user_b.id},
+        ).json()["id"]
+        self.client.post(
+            f"/api/conversations/{conversation_id}/messages",
+            headers=headers_a,
+            json={"text": "already seen"},
+        )
+
+        initial = self.client.get("/api/me/dm/updates", headers=headers_b).json()
+        self.assertEqual(initial["messages"], [])
+        cursor = initial["cursor"]
+
+        results: dict[str, object] = {}
+
+        def long_poll():
+            started = time.monotonic()
+            response = self.client.get(
+                "/api/me/dm/updates",
+                headers=headers_b,
+                params={"since": cursor, "timeout": 20},
+            )
+            results["elapsed"] = time.monotonic() - started
+            results["body"] = response.json()
+
+        poller = threading.Thread(target=long_poll)
+        poller.start()
+        time.sleep(0.3)
+        self.client.post(
+            f"/api/conversations/{conversation_id}/messages",
+            headers=headers_a,
+            json={"text": "fresh"},
+        )
+        poller.join(timeout=20)
+
+        self.assertLess(results["elapsed"], 10)
+        self.assertEqual([item["text"] for item in results["body"]["messages"]], ["fresh"])
+        self.assertNotEqual(results["body"]["cursor"], cursor)
+
 
 if __name__ == "__main__":
     unittest.main()